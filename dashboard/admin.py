@@ -1,9 +1,19 @@
-from django.contrib import admin
+from datetime import datetime, timedelta
+
+from django.contrib import admin, messages
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.db.models import Count, Q
+from django.utils import timezone
 from django.utils.html import format_html
+from django.utils.timesince import timesince
 from .models import (
-    UserProfile, RegularStudent, TemporaryStudent, Guest,
-    AccessLog, LabSession, SystemSettings
+    UserProfile, RegularStudent, TemporaryStudent, Guest, Lab, ScannerStation,
+    AccessLog, LabSession, SystemSettings, StudentIDSequence, IDCard, MaintenanceRun,
+    VisitStats, GuestGroup, ProjectionCheckpoint, person_search
 )
+from .pagination import EstimatedCountPaginator
+from .replica import replica_status, use_replica
+from .thumbnails import thumbnail_url
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
@@ -12,15 +22,66 @@ class UserProfileAdmin(admin.ModelAdmin):
     search_fields = ('user__username', 'user__first_name', 'user__last_name', 'phone_number')
 
 
-class BaseStudentAdmin(admin.ModelAdmin):
-    list_display = ('first_name', 'last_name', 'student_id', 'class_status', 'boarding_status', 'is_active', 'qr_code_preview')
+class ReplicaChangeListMixin:
+    """
+    Read changelist pages from the analytics replica. Only used for logs,
+    where a few minutes of lag is fine; actions and edits use the primary.
+    """
+    def changelist_view(self, request, extra_context=None):
+        if request.method != 'GET':
+            return super().changelist_view(request, extra_context)
+        return self._replica_changelist_view(request, extra_context)
+
+    @use_replica()
+    def _replica_changelist_view(self, request, extra_context):
+        status = replica_status()
+        if status['in_use']:
+            messages.info(request, f"Showing data as of {timesince(status['as_of'])} ago.")
+        response = super().changelist_view(request, extra_context)
+        # Render now, while reads still go to the replica
+        if hasattr(response, 'render'):
+            response.render()
+        return response
+
+
+class VisitStatsColumnsMixin:
+    """Sortable visit count and last seen columns read from VisitStats."""
+    list_select_related = ('visit_stats',)
+
+    def total_visits(self, obj):
+        stats = getattr(obj, 'visit_stats', None)
+        return stats.total_visits if stats else 0
+
+    def last_seen(self, obj):
+        stats = getattr(obj, 'visit_stats', None)
+        return stats.last_seen if stats else None
+
+    total_visits.short_description = 'Visits'
+    total_visits.admin_order_field = 'visit_stats__total_visits'
+    last_seen.short_description = 'Last Seen'
+    last_seen.admin_order_field = 'visit_stats__last_seen'
+
+
+class BaseStudentAdmin(VisitStatsColumnsMixin, admin.ModelAdmin):
+    list_display = ('photo_preview', 'first_name', 'last_name', 'student_id', 'class_status', 'boarding_status',
+                    'is_active', 'total_visits', 'last_seen', 'qr_code_preview')
     list_filter = ('boarding_status', 'class_status', 'year_joined', 'is_active')
     search_fields = ('first_name', 'last_name', 'student_id')
     readonly_fields = ('qr_code_preview',)
 
+    def photo_preview(self, obj):
+        if obj.photo:
+            return format_html(
+                '<img src="{}" width="40" height="40" loading="lazy" style="border-radius: 50%; object-fit: cover" />',
+                thumbnail_url(obj.photo, 'avatar'),
+            )
+        return ""
+
+    photo_preview.short_description = 'Photo'
+
     def qr_code_preview(self, obj):
-        if obj.qr_code:
-            return format_html('<img src="{}" width="50" height="50" />', obj.qr_code.url)
+        if obj.pk:
+            return format_html('<img src="{}?size=4" width="50" height="50" loading="lazy" />', obj.qr_code_url)
         return "No QR Code"
 
     qr_code_preview.short_description = 'QR Code'
@@ -75,9 +136,9 @@ class TemporaryStudentAdmin(BaseStudentAdmin):
 
 
 @admin.register(Guest)
-class GuestAdmin(admin.ModelAdmin):
+class GuestAdmin(VisitStatsColumnsMixin, admin.ModelAdmin):
     list_display = ('first_name', 'last_name', 'school_or_organization',
-                    'created_at', 'guest_id', 'qr_code_preview')
+                    'created_at', 'guest_id', 'total_visits', 'last_seen', 'qr_code_preview')
     list_filter = ('school_or_organization', 'created_at')
     search_fields = ('first_name', 'last_name', 'school_or_organization', 'guest_id')
     readonly_fields = ('qr_code_preview', 'guest_id')
@@ -98,21 +159,131 @@ class GuestAdmin(admin.ModelAdmin):
     )
 
     def qr_code_preview(self, obj):
-        if obj.qr_code:
-            return format_html('<img src="{}" width="50" height="50" />', obj.qr_code.url)
+        if obj.pk:
+            return format_html('<img src="{}?size=4" width="50" height="50" loading="lazy" />', obj.qr_code_url)
         return "No QR Code"
 
     qr_code_preview.short_description = 'QR Code'
 
 
-@admin.register(AccessLog)
-class AccessLogAdmin(admin.ModelAdmin):
-    list_display = ('get_name', 'user_type', 'log_type', 'timestamp', 'recorded_by')
-    list_filter = ('user_type', 'log_type', 'timestamp', 'recorded_by')
+@admin.register(GuestGroup)
+class GuestGroupAdmin(admin.ModelAdmin):
+    list_display = ('name', 'school_or_organization', 'group_id', 'member_count', 'created_at')
+    search_fields = ('name', 'school_or_organization', 'group_id')
+    readonly_fields = ('group_id',)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(member_count=Count('members'))
+
+    def member_count(self, obj):
+        return obj.member_count
+
+    member_count.short_description = 'Members'
+    member_count.admin_order_field = 'member_count'
+
+
+class ScannerStationInline(admin.TabularInline):
+    model = ScannerStation
+    extra = 0
+
+
+@admin.register(Lab)
+class LabAdmin(admin.ModelAdmin):
+    list_display = ('name', 'code', 'capacity', 'occupants', 'is_active')
+    list_filter = ('is_active',)
+    search_fields = ('name', 'code')
+    prepopulated_fields = {'code': ('name',)}
+    inlines = (ScannerStationInline,)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            occupants=Count('sessions', filter=Q(sessions__exit_time__isnull=True))
+        )
+
+    def occupants(self, obj):
+        return obj.occupants
+
+    occupants.short_description = 'Inside now'
+    occupants.admin_order_field = 'occupants'
+
+
+@admin.register(ScannerStation)
+class ScannerStationAdmin(admin.ModelAdmin):
+    list_display = ('name', 'lab', 'is_active', 'created_at')
+    list_filter = ('lab', 'is_active')
+    list_select_related = ('lab',)
+    search_fields = ('name', 'lab__name')
+
+
+class RecentMonthFilter(admin.SimpleListFilter):
+    """
+    Drill down by calendar month over the last year. The months are worked
+    out from today, not by asking the table which dates it holds.
+    """
+    title = 'month'
+    parameter_name = 'month'
+    date_field = None
+    months = 12
+
+    def lookups(self, request, model_admin):
+        month = timezone.localdate().replace(day=1)
+        choices = []
+        for _ in range(self.months):
+            choices.append((month.strftime('%Y-%m'), month.strftime('%B %Y')))
+            month = (month - timedelta(days=1)).replace(day=1)
+        return choices
+
+    def queryset(self, request, queryset):
+        if not self.value():
+            return queryset
+        try:
+            start = datetime.strptime(self.value(), '%Y-%m')
+        except ValueError:
+            raise IncorrectLookupParameters(f"Invalid month: {self.value()}")
+        end = (start + timedelta(days=32)).replace(day=1)
+        tz = timezone.get_current_timezone()
+        return queryset.filter(**{
+            f'{self.date_field}__gte': timezone.make_aware(start, tz),
+            f'{self.date_field}__lt': timezone.make_aware(end, tz),
+        })
+
+
+class AccessLogMonthFilter(RecentMonthFilter):
+    date_field = 'timestamp'
+
+
+class LabSessionMonthFilter(RecentMonthFilter):
+    date_field = 'entry_time'
+
+
+class LargeLogAdminMixin:
+    """
+    Changelist settings for the log tables, which grow by every scan: no
+    full count, no dates read from the table, people picked by autocomplete
+    and searched through their own tables.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    autocomplete_fields = ('regular_student', 'temporary_student', 'guest')
+    # Shown as the search box; get_search_results does the searching
     search_fields = ('regular_student__first_name', 'regular_student__last_name',
-                    'temporary_student__first_name', 'temporary_student__last_name',
-                    'guest__first_name', 'guest__last_name')
-    date_hierarchy = 'timestamp'
+                     'temporary_student__first_name', 'temporary_student__last_name',
+                     'guest__first_name', 'guest__last_name')
+    search_help_text = 'Name or ID of the student or guest'
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term.strip():
+            return queryset, False
+        return queryset.filter(person_search(search_term)), False
+
+
+@admin.register(AccessLog)
+class AccessLogAdmin(LargeLogAdminMixin, ReplicaChangeListMixin, admin.ModelAdmin):
+    list_display = ('get_name', 'user_type', 'log_type', 'timestamp', 'lab', 'station', 'recorded_by')
+    list_filter = ('lab', 'user_type', 'log_type', 'timestamp', AccessLogMonthFilter, 'recorded_by')
+    list_select_related = ('regular_student', 'temporary_student', 'guest', 'recorded_by', 'lab', 'station')
+    autocomplete_fields = LargeLogAdminMixin.autocomplete_fields + ('recorded_by',)
+    raw_id_fields = ('paired_log',)
 
     def get_name(self, obj):
         return obj.get_user_name()
@@ -121,13 +292,11 @@ class AccessLogAdmin(admin.ModelAdmin):
 
 
 @admin.register(LabSession)
-class LabSessionAdmin(admin.ModelAdmin):
-    list_display = ('get_name', 'user_type', 'entry_time', 'exit_time', 'get_duration')
-    list_filter = ('user_type', 'entry_time', 'exit_time')
-    search_fields = ('regular_student__first_name', 'regular_student__last_name',
-                    'temporary_student__first_name', 'temporary_student__last_name',
-                    'guest__first_name', 'guest__last_name')
-    date_hierarchy = 'entry_time'
+class LabSessionAdmin(LargeLogAdminMixin, ReplicaChangeListMixin, admin.ModelAdmin):
+    list_display = ('get_name', 'user_type', 'lab', 'entry_time', 'exit_time', 'get_duration')
+    list_filter = ('lab', 'user_type', 'entry_time', 'exit_time', LabSessionMonthFilter)
+    list_select_related = ('regular_student', 'temporary_student', 'guest', 'lab')
+    raw_id_fields = ('entry_log', 'exit_log')
 
     def get_name(self, obj):
         if obj.regular_student:
@@ -148,31 +317,70 @@ class LabSessionAdmin(admin.ModelAdmin):
     get_duration.short_description = 'Duration'
 
 
-# @admin.register(IDCard)
-# class IDCardAdmin(admin.ModelAdmin):
-#     list_display = ('get_name', 'get_id', 'generated_at', 'printed')
-#     list_filter = ('generated_at', 'printed')
-
-#     def get_name(self, obj):
-#         if obj.regular_student:
-#             return f"{obj.regular_student.first_name} {obj.regular_student.last_name}"
-#         elif obj.temporary_student:
-#             return f"{obj.temporary_student.first_name} {obj.temporary_student.last_name}"
-#         elif obj.guest:
-#             return f"{obj.guest.first_name} {obj.guest.last_name}"
-#         return "Unknown"
-
-#     def get_id(self, obj):
-#         if obj.regular_student:
-#             return obj.regular_student.student_id
-#         elif obj.temporary_student:
-#             return obj.temporary_student.student_id
-#         elif obj.guest:
-#             return obj.guest.guest_id
-#         return "Unknown"
-
-#     get_name.short_description = 'Name'
-#     get_id.short_description = 'ID'
+@admin.register(StudentIDSequence)
+class StudentIDSequenceAdmin(admin.ModelAdmin):
+    list_display = ('year_joined', 'type_prefix', 'last_number')
+    list_filter = ('type_prefix',)
+    ordering = ('-year_joined', 'type_prefix')
+
+
+@admin.register(IDCard)
+class IDCardAdmin(admin.ModelAdmin):
+    list_display = ('get_name', 'get_id', 'generated_at', 'printed')
+    list_filter = ('generated_at', 'printed')
+    list_select_related = ('regular_student', 'temporary_student', 'guest')
+    readonly_fields = ('fingerprint', 'generated_at')
+
+    def get_name(self, obj):
+        if obj.regular_student:
+            return f"{obj.regular_student.first_name} {obj.regular_student.last_name}"
+        elif obj.temporary_student:
+            return f"{obj.temporary_student.first_name} {obj.temporary_student.last_name}"
+        elif obj.guest:
+            return f"{obj.guest.first_name} {obj.guest.last_name}"
+        return "Unknown"
+
+    def get_id(self, obj):
+        if obj.regular_student:
+            return obj.regular_student.student_id
+        elif obj.temporary_student:
+            return obj.temporary_student.student_id
+        elif obj.guest:
+            return obj.guest.guest_id
+        return "Unknown"
+
+    get_name.short_description = 'Name'
+    get_id.short_description = 'ID'
+
+
+@admin.register(VisitStats)
+class VisitStatsAdmin(ReplicaChangeListMixin, admin.ModelAdmin):
+    list_display = ('__str__', 'total_visits', 'total_duration', 'last_seen')
+    list_select_related = ('regular_student', 'temporary_student', 'guest')
+    ordering = ('-total_visits',)
+    readonly_fields = ('regular_student', 'temporary_student', 'guest', 'total_visits', 'total_duration', 'last_seen')
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(MaintenanceRun)
+class MaintenanceRunAdmin(admin.ModelAdmin):
+    list_display = ('job', 'started_at', 'duration', 'rows_affected', 'status')
+    list_filter = ('job', 'status')
+    readonly_fields = ('job', 'started_at', 'finished_at', 'duration', 'rows_affected', 'status', 'message')
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(ProjectionCheckpoint)
+class ProjectionCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('name', 'position', 'updated_at')
+    readonly_fields = ('name', 'position', 'updated_at')
+
+    def has_add_permission(self, request):
+        return False
 
 
 @admin.register(SystemSettings)
@@ -0,0 +1,95 @@
+"""
+Admission control for scans.
+
+At a class change dozens of stations scan at once. Only one of them can
+write to SQLite at a time; the rest wait in SQLite's busy handler, which
+sleeps in growing steps, so the lock often sits free while every waiter is
+asleep, and a scan that waits past the busy timeout fails after holding a
+worker thread for all of it. PostgreSQL copes better, but its connection
+pool runs out just the same.
+
+Scans are therefore let in through a gate: at most SCAN_CONCURRENCY are
+handled at once in each worker process, up to SCAN_QUEUE_SIZE more wait
+their turn, in order, for at most SCAN_QUEUE_TIMEOUT seconds, and the rest
+are turned away straight away with ``Overloaded``. The scan endpoint answers
+those with a 503 and Retry-After, which the scan page retries, so a burst is
+spread over a few seconds instead of piling onto the database.
+"""
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+
+from django.conf import settings
+
+from .metrics import record_scan_admission, record_scan_queue
+
+
+class Overloaded(Exception):
+    """No room to handle the scan now; try again after ``retry_after`` seconds."""
+    def __init__(self, retry_after):
+        super().__init__(f'Too many scans at once; retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class Gate:
+    def __init__(self, limit, queue_size, timeout):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = deque()
+
+    @contextmanager
+    def admit(self):
+        """Hold one of the ``limit`` places for the block, or raise Overloaded."""
+        started = time.perf_counter()
+        with self._condition:
+            if self._active >= self.limit or self._waiting:
+                self._wait_turn(started)
+            self._active += 1
+            record_scan_queue(self._active, len(self._waiting))
+        record_scan_admission(time.perf_counter() - started)
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                record_scan_queue(self._active, len(self._waiting))
+                self._condition.notify_all()
+
+    def _wait_turn(self, started):
+        if len(self._waiting) >= self.queue_size:
+            raise Overloaded(settings.SCAN_RETRY_AFTER)
+
+        turn = object()
+        self._waiting.append(turn)
+        record_scan_queue(self._active, len(self._waiting))
+        try:
+            deadline = started + self.timeout
+            while self._active >= self.limit or self._waiting[0] is not turn:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise Overloaded(settings.SCAN_RETRY_AFTER)
+                self._condition.wait(remaining)
+        finally:
+            self._waiting.remove(turn)
+            record_scan_queue(self._active, len(self._waiting))
+            # The next in line may be able to go now
+            self._condition.notify_all()
+
+
+_gate = None
+_gate_lock = threading.Lock()
+
+
+def scan_gate():
+    """The gate for this worker process, built from the settings on first use."""
+    global _gate
+    if _gate is None:
+        with _gate_lock:
+            if _gate is None:
+                _gate = Gate(settings.SCAN_CONCURRENCY, settings.SCAN_QUEUE_SIZE, settings.SCAN_QUEUE_TIMEOUT)
+    return _gate
@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+
+from .metrics import record_cache_lookup
+
+
+def user_cache_key(user_id):
+    return f'dashboard:auth_user:{user_id}'
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend that keeps the signed-in user in the cache for a short time,
+    so authenticated requests such as scans don't read the user table each
+    time. Saving or deleting a user drops the cached copy, and Django still
+    checks the session's password hash against it, so logging out and
+    changing the password take effect immediately.
+
+    That only holds when every worker shares the cache, so without
+    AUTH_USER_CACHE (off for the per-process cache) this is a plain
+    ModelBackend.
+    """
+    def get_user(self, user_id):
+        if not settings.AUTH_USER_CACHE:
+            return super().get_user(user_id)
+        key = user_cache_key(user_id)
+        user = cache.get(key)
+        record_cache_lookup('auth_user', user is not None)
+        if user is None:
+            user = super().get_user(user_id)
+            if user is None:
+                return None
+            cache.set(key, user, settings.AUTH_USER_CACHE_TIMEOUT)
+        return user if self.user_can_authenticate(user) else None
+
+
+def forget_cached_user(user_id):
+    cache.delete(user_cache_key(user_id))
+
@@ -0,0 +1,20 @@
+from django.utils.functional import SimpleLazyObject
+
+from .models import SystemSettings, UserProfile
+
+
+def dashboard(request):
+    """
+    The signed-in user's name and profile and the system settings, for every
+    page. Both are read lazily from the cache, so a page that doesn't use
+    them costs no queries.
+    """
+    context = {
+        'system_settings': SimpleLazyObject(SystemSettings.load),
+    }
+
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        context['username'] = user.username
+        context['profile'] = SimpleLazyObject(lambda: UserProfile.for_user(user))
+    return context
@@ -0,0 +1,138 @@
+"""
+Bulk registration of visiting guest groups from a pasted list or a CSV file.
+"""
+import csv
+import io
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+
+from .models import Guest, GuestGroup
+from .roster_sync import record_changes
+
+
+class GuestGroupImportError(Exception):
+    """Raised when a member list cannot be read at all."""
+
+
+class GuestGroupRegistrar:
+    """
+    Parses a member list, then creates the group and all of its guests with
+    a single batch of inserts. QR codes are rendered on demand later.
+    """
+    MAX_MEMBERS = 200
+
+    COLUMNS = ('first_name', 'last_name', 'contact_number', 'email')
+
+    def __init__(self, created_by):
+        self.created_by = created_by
+
+    def parse_members(self, text='', roster_file=None):
+        """
+        Read members from pasted text and/or a CSV file. Pasted lines are
+        either "First Last" or "first, last[, contact number][, email]"; a CSV
+        file needs a header row with at least first_name and last_name.
+
+        Returns ``(members, errors)`` where each member is a dict of Guest
+        fields and each error is ``{'row': ..., 'messages': [...]}``.
+        """
+        members = []
+        errors = []
+
+        for line_number, line in enumerate((text or '').splitlines(), start=1):
+            if not line.strip():
+                continue
+            if ',' in line:
+                values = dict(zip(self.COLUMNS, next(csv.reader([line]))))
+            else:
+                first_name, _, last_name = line.strip().rpartition(' ')
+                values = {'first_name': first_name, 'last_name': last_name}
+            self._add_member(f'Line {line_number}', values, members, errors)
+
+        if roster_file:
+            for row_number, values in self._read_csv(roster_file):
+                self._add_member(f'Row {row_number}', values, members, errors)
+
+        if not members and not errors:
+            errors.append({'row': '-', 'messages': ['Add at least one group member.']})
+        elif len(members) > self.MAX_MEMBERS:
+            errors.append({'row': '-', 'messages': [f'A group can have at most {self.MAX_MEMBERS} members.']})
+        return members, errors
+
+    def register(self, name, school_or_organization, purpose, members):
+        """
+        Create the group and its guests. Every guest gets an ID up front so
+        the whole group is inserted with one bulk insert.
+        """
+        with transaction.atomic():
+            group = GuestGroup.objects.create(
+                name=name,
+                school_or_organization=school_or_organization,
+                purpose=purpose,
+                created_by=self.created_by,
+            )
+
+            guests = []
+            for member in members:
+                guest = Guest(
+                    school_or_organization=school_or_organization,
+                    purpose=purpose,
+                    created_by=self.created_by,
+                    group=group,
+                    **member
+                )
+                guest.guest_id = guest.generate_guest_id()
+                guests.append(guest)
+            Guest.objects.bulk_create(guests)
+            # bulk_create sends no post_save signals
+            record_changes(guest.guest_id for guest in guests)
+        return group
+
+    def _add_member(self, label, values, members, errors):
+        member = {name: str(values.get(name) or '').strip() for name in self.COLUMNS}
+
+        messages = []
+        if not member['first_name'] or not member['last_name']:
+            messages.append('First and last name are required.')
+        for name in ('first_name', 'last_name'):
+            if len(member[name]) > 60:
+                messages.append(f'{name.replace("_", " ").capitalize()} must be at most 60 characters.')
+        if len(member['contact_number']) > 15:
+            messages.append('Contact number must be at most 15 characters.')
+        if len(member['email']) > 254:
+            messages.append('Email must be at most 254 characters.')
+        elif member['email']:
+            try:
+                validate_email(member['email'])
+            except ValidationError:
+                messages.append('Enter a valid email address.')
+
+        if messages:
+            errors.append({'row': label, 'messages': messages})
+            return
+
+        member['contact_number'] = member['contact_number'] or None
+        member['email'] = member['email'] or None
+        members.append(member)
+
+    @classmethod
+    def _read_csv(cls, roster_file):
+        content = roster_file.read()
+        if isinstance(content, bytes):
+            try:
+                content = content.decode('utf-8-sig')
+            except UnicodeDecodeError:
+                raise GuestGroupImportError('CSV files must be UTF-8 encoded.')
+
+        reader = csv.reader(io.StringIO(content))
+        header = [str(name).strip().lower().replace(' ', '_') for name in next(reader, [])]
+        if 'first_name' not in header or 'last_name' not in header:
+            raise GuestGroupImportError('The CSV file needs first_name and last_name columns.')
+
+        # Row 1 is the header, so data starts on row 2 as in a spreadsheet
+        return [
+            (row_number, dict(zip(header, record)))
+            for row_number, record in enumerate(reader, start=2)
+            if any(value.strip() for value in record)
+        ]
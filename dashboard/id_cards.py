@@ -0,0 +1,330 @@
+"""
+Rendering of printable ID cards and A4 sheets of cards.
+
+Each card is composed from the person's photo, name, ID and QR code together
+with the school name and logo from SystemSettings. Rendered cards are cached
+on disk and only re-rendered when something drawn on them changes. Pillow is
+imported by the functions that draw, not when the module loads.
+
+The sheets page never draws cards inside a request: missing cards are drawn
+by a background thread (``queue_render``) or by ``render_id_cards``, and the
+page only tiles cards that are already current.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from django.db import connection
+from django.utils import timezone
+
+from .models import Guest, IDCard, RegularStudent, SystemSettings, TemporaryStudent
+from .qr import render_qr_png, write_atomic
+
+# Bump when the layout changes so every cached card is re-rendered
+LAYOUT_VERSION = 1
+
+DPI = 300
+# CR80 card (85.6 x 54 mm) and A4 page (210 x 297 mm) at 300 DPI
+CARD_SIZE = (1011, 638)
+PAGE_SIZE = (2480, 3508)
+SHEET_COLUMNS = 2
+SHEET_ROWS = 5
+
+logger = logging.getLogger(__name__)
+
+# Selections being drawn in the background, so repeated requests don't queue them twice
+_pending = set()
+_lock = threading.Lock()
+
+# person type -> (IDCard field, attribute holding the printed ID)
+PERSON_TYPES = {
+    RegularStudent: ('regular_student', 'student_id'),
+    TemporaryStudent: ('temporary_student', 'student_id'),
+    Guest: ('guest', 'guest_id'),
+}
+
+
+def card_spec(person, system_settings):
+    """
+    Collect everything drawn on a person's card into a plain, picklable dict.
+    """
+    _, id_attr = PERSON_TYPES[type(person)]
+    person_id = getattr(person, id_attr)
+
+    if isinstance(person, Guest):
+        title = 'GUEST PASS'
+        details = [
+            f'Organization: {person.school_or_organization[:28]}',
+        ]
+    else:
+        title = 'TEMPORARY ACCESS CARD' if isinstance(person, TemporaryStudent) else 'AUTHORIZATION CARD'
+        details = [
+            f'Year Batch: {person.year_batch}',
+            f'Residential Status: {person.boarding_status.upper()}',
+            f'Class: {person.class_status.upper()}',
+        ]
+        if isinstance(person, TemporaryStudent):
+            details.append(f'Valid Until: {person.valid_until:%Y-%m-%d}')
+
+    return {
+        'layout': LAYOUT_VERSION,
+        'school_name': system_settings.school_name.upper(),
+        'title': title,
+        'name': f'{person.last_name} {person.first_name}'.upper(),
+        'person_id': person_id,
+        'details': details,
+        'photo': _file_info(getattr(person, 'photo', None)),
+        'logo': _file_info(system_settings.school_logo),
+    }
+
+
+def card_fingerprint(spec):
+    """Hash of a card spec, used to tell whether a cached card is still current."""
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def render_card(spec, path):
+    """
+    Draw a single card and atomically write it to ``path`` as a PNG. Runs in a
+    worker process, so it only touches the spec and the filesystem.
+    """
+    from PIL import Image, ImageDraw
+
+    card = Image.new('RGB', CARD_SIZE, 'white')
+    draw = ImageDraw.Draw(card)
+    width, height = CARD_SIZE
+
+    # Header band with logo, school name and card title
+    draw.rectangle((0, 0, width, 150), fill=(30, 64, 175))
+    text_left = 40
+    if spec['logo']:
+        logo = _open_image(spec['logo']['path'], (120, 120))
+        if logo:
+            logo = logo.convert('RGBA')
+            card.paste(logo, (30, 15), logo)
+            text_left = 170
+    draw.text((text_left, 30), spec['school_name'], font=_font(44), fill='white')
+    draw.text((text_left, 90), spec['title'], font=_font(32), fill='white')
+
+    # Photo, or a placeholder with initials
+    photo_box = (40, 190, 290, 590)
+    photo = _open_image(spec['photo']['path'], (250, 400)) if spec['photo'] else None
+    if photo:
+        card.paste(photo.convert('RGB'), photo_box[:2])
+    else:
+        draw.rectangle(photo_box, fill=(229, 231, 235))
+        initials = ''.join(part[:1] for part in spec['name'].split()[:2])
+        draw.text((165, 390), initials, font=_font(96), fill=(107, 114, 128), anchor='mm')
+
+    # Name, ID and the remaining details
+    draw.text((320, 190), spec['name'], font=_font(38), fill='black')
+    draw.text((320, 245), spec['person_id'], font=_font(34), fill=(30, 64, 175))
+    for line_number, line in enumerate(spec['details']):
+        draw.text((320, 310 + line_number * 45), line, font=_font(26), fill=(55, 65, 81))
+
+    qr_code = Image.open(BytesIO(render_qr_png(spec['person_id'], box_size=8))).convert('RGB')
+    qr_code = qr_code.resize((210, 210), Image.NEAREST)
+    card.paste(qr_code, (width - 230, height - 230))
+
+    output = BytesIO()
+    card.save(output, format='PNG', dpi=(DPI, DPI))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomic(path, output.getvalue())
+    return path
+
+
+def _render_card_job(job):
+    return render_card(*job)
+
+
+def queue_render(person_type, years=None, group_id=None):
+    """Draw the missing cards of a selection in a background thread; repeated calls are ignored."""
+    selection = (person_type, tuple(sorted(years or ())), group_id)
+    with _lock:
+        if selection in _pending:
+            return
+        _pending.add(selection)
+    threading.Thread(target=_render_selection, args=(selection,), name='id_cards', daemon=True).start()
+
+
+def _render_selection(selection):
+    person_type, years, group_id = selection
+    try:
+        # Drawn in this thread: forking a process pool from a threaded web
+        # worker can deadlock the children on locks other threads held
+        IDCardRenderer(workers=1).render(people_for_cards(person_type, years, group_id=group_id))
+    except Exception:
+        logger.exception("Could not render ID cards for %s", selection)
+    finally:
+        with _lock:
+            _pending.discard(selection)
+        connection.close()
+
+
+def people_for_cards(person_type, years=None, include_inactive=False, group_id=None):
+    """Queryset of the people whose cards should be printed together."""
+    model = {'regular': RegularStudent, 'temporary': TemporaryStudent, 'guest': Guest}[person_type]
+    if model is Guest:
+        guests = model.objects.order_by('last_name', 'first_name')
+        if group_id:
+            guests = guests.filter(group__group_id=group_id)
+        return guests
+
+    people = model.objects.order_by('year_joined', 'last_name', 'first_name')
+    if years:
+        people = people.filter(year_joined__in=years)
+    if not include_inactive:
+        people = people.filter(is_active=True)
+    return people
+
+
+class IDCardRenderer:
+    """
+    Renders ID cards for many people at once, reusing cached cards whose
+    fingerprint has not changed and rendering the rest in a process pool.
+    """
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.system_settings = SystemSettings.load()
+        self.storage = IDCard._meta.get_field('card_image').storage
+
+    def render(self, people):
+        """
+        Return the file paths of up-to-date cards for ``people``, in order.
+        """
+        paths, jobs, to_create, to_update = self._plan(people)
+        for card, name in to_update:
+            self._delete_stale_image(card)
+            card.card_image = name
+            card.printed = False
+            card.generated_at = timezone.now()
+
+        self._run(jobs)
+        IDCard.objects.bulk_create(to_create)
+        IDCard.objects.bulk_update([card for card, _ in to_update], ['card_image', 'fingerprint', 'printed', 'generated_at'])
+        return paths
+
+    def current_cards(self, people):
+        """
+        The file paths of ``people``'s cards, in order, and how many of them
+        are missing or out of date. Draws nothing.
+        """
+        paths, jobs, _, _ = self._plan(people)
+        return paths, len(jobs)
+
+    def _plan(self, people):
+        people = list(people)
+        cards = self._existing_cards(people)
+
+        jobs = []
+        to_create = []
+        to_update = []
+        paths = []
+        for person in people:
+            field_name, id_attr = PERSON_TYPES[type(person)]
+            spec = card_spec(person, self.system_settings)
+            fingerprint = card_fingerprint(spec)
+            card = cards.get((field_name, person.pk))
+
+            if card and card.fingerprint == fingerprint and card.card_image \
+                    and os.path.exists(self.storage.path(card.card_image.name)):
+                paths.append(self.storage.path(card.card_image.name))
+                continue
+
+            name = f'id_cards/card_{getattr(person, id_attr)}_{fingerprint[:12]}.png'
+            path = self.storage.path(name)
+            jobs.append((spec, path))
+            paths.append(path)
+
+            if card is None:
+                to_create.append(IDCard(**{field_name: person}, card_image=name, fingerprint=fingerprint))
+            else:
+                card.fingerprint = fingerprint
+                to_update.append((card, name))
+        return paths, jobs, to_create, to_update
+
+    def write_sheets(self, card_paths, output_path):
+        """
+        Tile cards onto A4 pages and write them as a multi-page PDF, holding
+        only one page in memory at a time.
+        """
+        from PIL import Image
+
+        per_page = SHEET_COLUMNS * SHEET_ROWS
+        margin_x = (PAGE_SIZE[0] - SHEET_COLUMNS * CARD_SIZE[0]) // (SHEET_COLUMNS + 1)
+        margin_y = (PAGE_SIZE[1] - SHEET_ROWS * CARD_SIZE[1]) // (SHEET_ROWS + 1)
+
+        pages = 0
+        for start in range(0, max(len(card_paths), 1), per_page):
+            page = Image.new('RGB', PAGE_SIZE, 'white')
+            for index, card_path in enumerate(card_paths[start:start + per_page]):
+                column, row = index % SHEET_COLUMNS, index // SHEET_COLUMNS
+                with Image.open(card_path) as card:
+                    page.paste(card.convert('RGB'), (
+                        margin_x + column * (CARD_SIZE[0] + margin_x),
+                        margin_y + row * (CARD_SIZE[1] + margin_y),
+                    ))
+            page.save(output_path, format='PDF', resolution=DPI, append=pages > 0)
+            pages += 1
+        return pages
+
+    def _existing_cards(self, people):
+        lookups = {}
+        for person in people:
+            field_name, _ = PERSON_TYPES[type(person)]
+            lookups.setdefault(field_name, []).append(person.pk)
+
+        cards = {}
+        for field_name, pks in lookups.items():
+            for card in IDCard.objects.filter(**{f'{field_name}__in': pks}):
+                cards[(field_name, getattr(card, f'{field_name}_id'))] = card
+        return cards
+
+    def _run(self, jobs):
+        if len(jobs) < 2 or self.workers == 1:
+            for job in jobs:
+                _render_card_job(job)
+            return
+
+        workers = self.workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_render_card_job, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+
+    def _delete_stale_image(self, card):
+        if card.card_image and self.storage.exists(card.card_image.name):
+            self.storage.delete(card.card_image.name)
+
+
+def _file_info(field_file):
+    """Identify an image file by path, size and modification time."""
+    if not field_file:
+        return None
+    try:
+        path = field_file.path
+        stat = os.stat(path)
+    except (NotImplementedError, OSError, ValueError):
+        return None
+    return {'path': path, 'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+
+def _open_image(path, size):
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(path) as image:
+            return ImageOps.fit(ImageOps.exif_transpose(image), size)
+    except OSError:
+        return None
+
+
+def _font(size):
+    from PIL import ImageFont
+
+    try:
+        return ImageFont.truetype('DejaVuSans-Bold.ttf', size)
+    except OSError:
+        return ImageFont.load_default(size=size)
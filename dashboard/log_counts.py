@@ -0,0 +1,324 @@
+"""
+Cached counts for the access log view.
+
+Counting filtered logs on every page load reads every matching row, and each
+facet (how many entries, exits, guests...) would read them again. Instead the
+logs matching a lab and a search are counted once per day, split by log type
+and user type, and cached under that filter signature. The total for any type
+filter and both facets are then sums over those day buckets, so changing the
+user type or log type filter, or paging, costs no count query at all.
+
+Days before the last LOG_COUNT_OPEN_DAYS are closed: scans only add logs for
+now, and sessions left open are closed at the end of their day by the next
+run of ``close_stale_sessions``, so a closed day's counts don't change. The
+``store_daily_log_counts`` job counts each closed day once into DailyLogCount,
+so a cold cache, e.g. in a freshly started worker, is filled from those rows
+instead of from millions of logs. Open days are cached along with the newest
+log id and counted again once a newer log exists.
+
+Anything else that changes old logs must call ``logs_changed``: saves and
+deletes of logs do so through signals, bulk writes of back-dated logs through
+``logs_added``. Renaming or deleting a person changes which logs a search
+matches, so it calls ``invalidate_searches``.
+
+Cache keys include a generation kept in the database, not in the cache: with
+the per-process cache, a change made by the maintenance process or by one
+web worker must still retire the counts every other worker has cached.
+"""
+import hashlib
+import threading
+import time
+from datetime import date, datetime, time as day_time, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, DateField, F, Min, Sum, Value
+from django.utils import timezone
+
+from .models import AccessLog, DailyLogCount, ProjectionCheckpoint, person_search
+from .projections import latest_log_id
+
+CHECKPOINT = 'daily_log_counts'
+
+# ProjectionCheckpoint rows whose position changes whenever cached counts, or
+# only those of searches, are out of date
+GENERATION = 'log_counts_generation'
+SEARCH_GENERATION = 'log_counts_search_generation'
+
+# Days counted per query; SQLite allows 500 SELECTs in one UNION
+DAYS_PER_QUERY = 100
+
+# Days whose stored counts are out of date, counted again on commit
+_pending = threading.local()
+
+
+def day_start(day):
+    """Midnight, local time, at the start of ``day``."""
+    return timezone.make_aware(datetime.combine(day, day_time.min))
+
+
+def logs_added(timestamps):
+    """Note logs written in bulk, recounting any closed days among them."""
+    first_open = _first_open_day()
+    if any(timezone.localdate(timestamp) < first_open for timestamp in timestamps):
+        logs_changed(timestamps)
+
+
+def logs_changed(timestamps):
+    """
+    Note that logs at ``timestamps`` were changed or deleted. Once the
+    current transaction commits their days are counted again and every
+    cached count is dropped.
+    """
+    if not hasattr(_pending, 'days'):
+        _pending.days = set()
+    _pending.days.update(timezone.localdate(timestamp) for timestamp in timestamps)
+    # A deleted person's logs arrive one by one; the first callback recounts them all
+    transaction.on_commit(_recount_pending)
+
+
+def invalidate_searches():
+    """Drop the cached counts for searches, in every worker, once the current transaction commits."""
+    _bump(SEARCH_GENERATION)
+
+
+def reset():
+    """Forget every stored and cached count, for when logs were rewritten wholesale."""
+    DailyLogCount.objects.all().delete()
+    ProjectionCheckpoint.objects.filter(name=CHECKPOINT).delete()
+    _bump(GENERATION)
+
+
+def store_closed_days():
+    """Store the counts of closed days not stored yet. Returns how many days were counted."""
+    checkpoint, _ = ProjectionCheckpoint.objects.get_or_create(name=CHECKPOINT)
+    if checkpoint.position:
+        start = date.fromordinal(checkpoint.position) + timedelta(days=1)
+    else:
+        first = AccessLog.objects.order_by('timestamp').values_list('timestamp', flat=True).first()
+        if first is None:
+            return 0
+        start = timezone.localdate(first)
+
+    days = _days(start, _first_open_day() - timedelta(days=1))
+    for offset in range(0, len(days), DAYS_PER_QUERY):
+        chunk = days[offset:offset + DAYS_PER_QUERY]
+        with transaction.atomic():
+            _store(chunk)
+            checkpoint.position = chunk[-1].toordinal()
+            checkpoint.save(update_fields=['position', 'updated_at'])
+    return len(days)
+
+
+def summary(lab=None, query='', start=None, end=None, user_type='', log_type=''):
+    """
+    The number of logs matching the filters, and how they split by log type
+    and by user type. Each facet applies every filter except its own, so it
+    shows what picking another value would list.
+    """
+    cells = _cells(lab, ' '.join(sorted(set(query.lower().split()))), start, end)
+    return {
+        'total': sum(
+            n for (lt, ut), n in cells.items()
+            if (not log_type or lt == log_type) and (not user_type or ut == user_type)
+        ),
+        'log_types': _facet(cells, 0, user_type, 1),
+        'user_types': _facet(cells, 1, log_type, 0),
+    }
+
+
+def _facet(cells, position, other_value, other_position):
+    counts = {}
+    for cell, n in cells.items():
+        if not other_value or cell[other_position] == other_value:
+            counts[cell[position]] = counts.get(cell[position], 0) + n
+    return counts
+
+
+def _cells(lab, query, start, end):
+    """Logs from ``start`` to ``end`` (inclusive) by (log type, user type)."""
+    today = timezone.localdate()
+    end = min(end or today, today)
+    state = _state()
+    generation = state.get(GENERATION, 0)
+    start = start or _first_log_day(generation)
+    if start is None or start > end:
+        return {}
+
+    signature = hashlib.sha1(repr((lab.pk if lab else None, query)).encode()).hexdigest()
+    key = f'dashboard:log_counts:{generation}:{signature}'
+    if query:
+        key += f':{state.get(SEARCH_GENERATION, 0)}'
+    entry = cache.get(key) or {'closed': {}, 'latest': None, 'open': {}}
+    latest = latest_log_id()
+    if entry['latest'] != latest:
+        entry['latest'], entry['open'] = latest, {}
+
+    first_open = _first_open_day()
+    if query:
+        # A search is narrowed by the people it matches rather than by date, so
+        # splitting it by day saves nothing: its closed days are one bucket and
+        # its open days another
+        buckets = [
+            span for span in ((start, min(end, first_open - timedelta(days=1))), (max(start, first_open), end))
+            if span[0] <= span[1]
+        ]
+    else:
+        buckets = _days(start, end)
+
+    def part(bucket):
+        return 'closed' if (bucket[1] if query else bucket) < first_open else 'open'
+
+    missing = [bucket for bucket in buckets if bucket not in entry[part(bucket)]]
+    if missing:
+        stored = date.fromordinal(state[CHECKPOINT]) if state.get(CHECKPOINT) else None
+        counted = _count_spans(lab, query, missing) if query else _count(lab, missing, stored)
+        for bucket, cells in counted.items():
+            entry[part(bucket)][bucket] = cells
+        # Every search term gets its own entry; let those that aren't reused expire
+        cache.set(key, entry, settings.LOG_COUNT_SEARCH_TIMEOUT if query else None)
+
+    totals = {}
+    for bucket in buckets:
+        for cell, n in entry[part(bucket)][bucket].items():
+            totals[cell] = totals.get(cell, 0) + n
+    return totals
+
+
+def _count(lab, days, stored):
+    """
+    Logs on each of ``days`` by (log type, user type), from the counts stored
+    through the day ``stored`` where possible.
+    """
+    counted = {day: {} for day in days}
+    if stored and days[0] <= stored:
+        counts = DailyLogCount.objects.filter(day__gte=days[0], day__lte=min(days[-1], stored))
+        if lab:
+            counts = counts.filter(lab=lab)
+        days = [day for day in days if day > stored]
+    else:
+        counts = DailyLogCount.objects.none()
+
+    logs = AccessLog.objects.all()
+    if lab:
+        logs = logs.filter(lab=lab)
+    for rows in (
+        counts.values_list('day', 'log_type', 'user_type').annotate(n=Sum('count')).order_by(),
+        _count_days(logs, days, ('log_type', 'user_type')),
+    ):
+        for day, log_type, user_type, n in rows:
+            if day in counted:
+                counted[day][log_type, user_type] = n
+    return counted
+
+
+def _count_spans(lab, query, spans):
+    """Logs matching a search in each (first day, last day) span by (log type, user type)."""
+    logs = AccessLog.objects.filter(person_search(query))
+    if lab:
+        logs = logs.filter(lab=lab)
+
+    counted = {}
+    for first, last in spans:
+        span_logs = logs.filter(timestamp__gte=day_start(first), timestamp__lt=day_start(last + timedelta(days=1)))
+        if first >= _first_open_day():
+            # The people's indexes end in the log id, so a lower bound on it
+            # lets them seek straight to the recent logs instead of reading
+            # everything those people ever logged
+            # (MIN(id + 0) reads the timestamp index; MIN(id) would walk the
+            # primary key from the oldest log on SQLite)
+            first_id = AccessLog.objects.filter(timestamp__gte=day_start(first)).aggregate(
+                first=Min(F('id') + 0)
+            )['first']
+            span_logs = span_logs.filter(id__gte=first_id or 0)
+        rows = span_logs.values_list('log_type', 'user_type').annotate(n=Count('id')).order_by()
+        counted[first, last] = {(log_type, user_type): n for log_type, user_type, n in rows}
+    return counted
+
+
+def _count_days(logs, days, fields):
+    """
+    (day, *fields, count) rows for ``logs`` on ``days``. Each day is its own
+    range of the timestamp index, which beats grouping every row by its local
+    date (a Python function call per row on SQLite), and the days are sent
+    DAYS_PER_QUERY at a time.
+    """
+    rows = []
+    for offset in range(0, len(days), DAYS_PER_QUERY):
+        queries = [
+            logs.filter(timestamp__gte=day_start(day), timestamp__lt=day_start(day + timedelta(days=1))).annotate(
+                day=Value(day, output_field=DateField())
+            ).values_list('day', *fields).annotate(n=Count('id')).order_by()
+            for day in days[offset:offset + DAYS_PER_QUERY]
+        ]
+        rows.extend(queries[0].union(*queries[1:], all=True))
+    return rows
+
+
+def _store(days):
+    DailyLogCount.objects.filter(day__in=days).delete()
+    # A recount committed by another worker since the delete may already
+    # have stored some of these rows; both counted the same logs
+    DailyLogCount.objects.bulk_create(
+        [
+            DailyLogCount(day=day, lab_id=lab_id, log_type=log_type, user_type=user_type, count=n)
+            for day, lab_id, log_type, user_type, n in _count_days(
+                AccessLog.objects.all(), days, ('lab_id', 'log_type', 'user_type')
+            )
+        ],
+        update_conflicts=True,
+        unique_fields=['day', 'lab', 'log_type', 'user_type'],
+        update_fields=['count'],
+    )
+
+
+def _recount_pending():
+    days = getattr(_pending, 'days', set())
+    if not days:
+        return
+    _pending.days = set()
+
+    position = ProjectionCheckpoint.objects.filter(name=CHECKPOINT).values_list('position', flat=True).first()
+    recount = sorted(day for day in days if position and day.toordinal() <= position)
+    with transaction.atomic():
+        if recount:
+            _store(recount)
+        _bump(GENERATION)
+
+
+def _state():
+    """
+    Positions of the stored counts' checkpoint and of both generations, by
+    name. Read from the database on every count, so each worker sees changes
+    made by the others.
+    """
+    return dict(
+        ProjectionCheckpoint.objects.filter(
+            name__in=(CHECKPOINT, GENERATION, SEARCH_GENERATION)
+        ).values_list('name', 'position')
+    )
+
+
+def _bump(name):
+    ProjectionCheckpoint.objects.update_or_create(name=name, defaults={'position': time.time_ns()})
+
+
+def _days(start, end):
+    return [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+
+
+def _first_open_day():
+    return timezone.localdate() - timedelta(days=settings.LOG_COUNT_OPEN_DAYS - 1)
+
+
+def _first_log_day(generation):
+    key = f'dashboard:log_counts:{generation}:first_day'
+    first = cache.get(key)
+    if first is None:
+        timestamp = AccessLog.objects.order_by('timestamp').values_list('timestamp', flat=True).first()
+        if timestamp is None:
+            return None
+        first = timezone.localdate(timestamp)
+        cache.set(key, first, None)
+    return first
@@ -0,0 +1,228 @@
+"""
+Periodic maintenance jobs.
+
+Each job is a set-based operation registered with ``@job`` and an interval.
+``run_due_jobs`` runs every job whose interval has elapsed since its last
+recorded run, and every run is stored as a MaintenanceRun with its timing.
+A job only runs while its MaintenanceLock is held, so schedulers started on
+several machines (or a manual run during a scheduled one) never overlap.
+"""
+from datetime import datetime, time, timedelta
+import time as clock
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from . import log_counts, projections, qr
+from .models import (
+    AccessLog, LabSession, MaintenanceLock, MaintenanceRun, RosterChange, TemporaryStudent, VisitStats,
+)
+from .projections import close_session, exit_log_for
+from .replica import refresh_sqlite_replica, uses_sqlite_snapshot
+
+JOBS = {}
+
+BATCH_SIZE = 1000
+
+# A lock left behind by a process that died is taken over after this long,
+# so it must be longer than any job runs
+LOCK_TIMEOUT = timedelta(hours=1)
+
+
+class MaintenanceJob:
+    def __init__(self, name, func, interval, description):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.description = description
+
+    def is_due(self, last_run, now):
+        return last_run is None or last_run + self.interval <= now
+
+
+def job(name, interval):
+    """Register a maintenance job that should run every ``interval``."""
+    def register(func):
+        JOBS[name] = MaintenanceJob(name, func, interval, (func.__doc__ or '').strip())
+        return func
+    return register
+
+
+def last_runs():
+    """Start time of the most recent run of each job."""
+    return dict(
+        MaintenanceRun.objects.values('job').annotate(last=Max('started_at')).values_list('job', 'last')
+    )
+
+
+def run_job(name, due_at=None):
+    """
+    Run a single job now and record how it went. Returns None without running
+    it while another process runs the same job, or when ``due_at`` is given
+    and another process has run it since it became due.
+    """
+    maintenance_job = JOBS[name]
+    owner = _lock(name)
+    if owner is None:
+        return None
+
+    try:
+        if due_at and not maintenance_job.is_due(last_runs().get(name), due_at):
+            return None
+
+        started_at = timezone.now()
+        started = clock.monotonic()
+        try:
+            rows_affected = maintenance_job.func(started_at) or 0
+            status, message = 'success', ''
+        except Exception as e:
+            rows_affected, status, message = 0, 'failed', f'{type(e).__name__}: {e}'
+
+        return MaintenanceRun.objects.create(
+            job=name,
+            started_at=started_at,
+            finished_at=timezone.now(),
+            duration=timedelta(seconds=clock.monotonic() - started),
+            rows_affected=rows_affected,
+            status=status,
+            message=message,
+        )
+    finally:
+        _unlock(name, owner)
+
+
+def run_due_jobs(now=None):
+    """Run every job whose interval has elapsed. Returns the recorded runs."""
+    now = now or timezone.now()
+    previous = last_runs()
+    runs = [
+        run_job(name, due_at=now) for name, maintenance_job in JOBS.items()
+        if maintenance_job.is_due(previous.get(name), now)
+    ]
+    return [run for run in runs if run]
+
+
+def seconds_until_next_job(now=None):
+    """How long a scheduler loop can sleep before another job is due."""
+    now = now or timezone.now()
+    previous = last_runs()
+    waits = [
+        (previous[name] + maintenance_job.interval - now).total_seconds() if name in previous else 0
+        for name, maintenance_job in JOBS.items()
+    ]
+    return max(min(waits, default=60), 0)
+
+
+def _lock(name):
+    """
+    Take the job's lock unless another process holds it. Returns the token
+    that releases it, or None. A conditional UPDATE rather than SELECT ... FOR
+    UPDATE, so no transaction stays open while the job runs and SQLite is
+    covered too.
+    """
+    MaintenanceLock.objects.get_or_create(job=name)
+    owner = uuid.uuid4().hex
+    now = timezone.now()
+    taken = MaintenanceLock.objects.filter(
+        Q(locked_until__isnull=True) | Q(locked_until__lte=now), job=name
+    ).update(owner=owner, locked_until=now + LOCK_TIMEOUT)
+    return owner if taken else None
+
+
+def _unlock(name, owner):
+    MaintenanceLock.objects.filter(job=name, owner=owner).update(owner='', locked_until=None)
+
+
+@job('deactivate_expired_temporary_students', interval=timedelta(minutes=5))
+def deactivate_expired_temporary_students(now):
+    """Mark temporary students whose access has expired as inactive."""
+    # Not a roster change: stations already hold each student's validity window
+    return TemporaryStudent.objects.filter(is_active=True, valid_until__lt=now).update(
+        is_active=False, updated_at=now
+    )
+
+
+@job('close_stale_sessions', interval=timedelta(hours=1))
+def close_stale_sessions(now):
+    """Close sessions left open from a previous day with an exit at the end of that day."""
+    start_of_today = timezone.make_aware(datetime.combine(timezone.localdate(now), time.min))
+    stale = LabSession.objects.filter(exit_time__isnull=True, entry_time__lt=start_of_today).select_related(
+        'entry_log'
+    ).order_by('pk')
+
+    closed = 0
+    while True:
+        sessions = list(stale[:BATCH_SIZE])
+        if not sessions:
+            return closed
+
+        with transaction.atomic():
+            exit_logs = []
+            for session in sessions:
+                end_of_day = timezone.make_aware(
+                    datetime.combine(timezone.localdate(session.entry_time), time.max)
+                )
+                exit_logs.append(exit_log_for(session, end_of_day, recorded_by_id=session.entry_log.recorded_by_id))
+            AccessLog.objects.bulk_create(exit_logs)
+            # Exits for days before yesterday change counts that were final
+            log_counts.logs_added([exit_log.timestamp for exit_log in exit_logs])
+
+            for session, exit_log in zip(sessions, exit_logs):
+                close_session(session, exit_log)
+            LabSession.objects.bulk_update(sessions, ['exit_time', 'exit_log', 'duration'])
+            VisitStats.record_visits(sessions)
+
+        closed += len(sessions)
+
+
+@job('store_daily_log_counts', interval=timedelta(hours=1))
+def store_daily_log_counts(now):
+    """Count the access logs of each day that closed since the last run, for the access log page."""
+    return log_counts.store_closed_days()
+
+
+@job('prune_qr_cache', interval=timedelta(days=1))
+def prune_qr_cache(now):
+    """Delete cached QR images that haven't been served for QR_CACHE_MAX_AGE_DAYS days."""
+    return qr.prune_disk_cache(timedelta(days=settings.QR_CACHE_MAX_AGE_DAYS).total_seconds())
+
+
+@job('catch_up_lab_sessions', interval=timedelta(minutes=5))
+def catch_up_lab_sessions(now):
+    """
+    Replay the access logs added since the last catch-up onto the lab
+    sessions, so logs written without their sessions are reflected.
+    """
+    counts = projections.catch_up()
+    return counts['created'] + counts['updated'] + counts['deleted'] + counts['repaired']
+
+
+@job('refresh_analytics_replica', interval=timedelta(seconds=settings.REPLICA_REFRESH_INTERVAL))
+def refresh_analytics_replica(now):
+    """Copy the SQLite database to the read-only analytics replica."""
+    # A PostgreSQL standby keeps itself up to date
+    if uses_sqlite_snapshot():
+        refresh_sqlite_replica()
+
+
+@job('prune_maintenance_history', interval=timedelta(days=1))
+def prune_maintenance_history(now):
+    """Delete maintenance run history older than 90 days."""
+    deleted, _ = MaintenanceRun.objects.filter(started_at__lt=now - timedelta(days=90)).delete()
+    return deleted
+
+
+@job('prune_roster_changes', interval=timedelta(days=1))
+def prune_roster_changes(now):
+    """
+    Delete roster changes older than ROSTER_CHANGE_RETENTION days. Stations
+    that haven't synced since then download the whole roster instead.
+    """
+    latest = RosterChange.objects.aggregate(latest=Max('id'))['latest']
+    deleted, _ = RosterChange.objects.filter(
+        created_at__lt=now - timedelta(days=settings.ROSTER_CHANGE_RETENTION)
+    ).exclude(pk=latest).delete()
+    return deleted
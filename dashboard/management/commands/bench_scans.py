@@ -0,0 +1,153 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import random
+import statistics
+import threading
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from dashboard.models import RegularStudent
+from dashboard.scanning_logic import QRCodeScanner
+
+
+class Command(BaseCommand):
+    help = "Measure scan throughput against the configured database with concurrent scanners"
+
+    BENCH_USERNAME = 'scan-benchmark'
+    # Benchmark students get IDs of their own instead of numbers from the
+    # shared ID sequences, so a run never uses up or collides with real IDs
+    BENCH_ID_PREFIX = 'BENCH-'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help="Concurrent scanners")
+        parser.add_argument('--scans', type=int, default=200, help="Scans per scanner")
+        parser.add_argument('--people', type=int, default=100, help="Students to scan in and out")
+        parser.add_argument('--keep', action='store_true', help="Keep the benchmark students and logs afterwards")
+        parser.add_argument(
+            '--view', action='store_true',
+            help="Send scans through the scan endpoint, as stations do, instead of calling the scanner directly"
+        )
+
+    def handle(self, *args, **options):
+        supervisor, student_ids = self._setup(options['people'])
+        self.stdout.write(f"Database profile: {self._describe_profile()}")
+
+        latencies = []
+        errors = {}
+        retries = []
+        lock = threading.Lock()
+
+        def scanner_thread(seed):
+            if options['view']:
+                scan = self._view_scanner(supervisor, lambda: retries.append(1))
+            else:
+                scan = QRCodeScanner(supervisor).process_scan
+            rng = random.Random(seed)
+            try:
+                for _ in range(options['scans']):
+                    started = time.perf_counter()
+                    try:
+                        result = scan(rng.choice(student_ids))
+                        outcome = None if result['status'] == 'success' else result['message']
+                    except Exception as e:
+                        outcome = f'{type(e).__name__}: {e}'
+                    elapsed = time.perf_counter() - started
+                    with lock:
+                        latencies.append(elapsed)
+                        if outcome:
+                            errors[outcome] = errors.get(outcome, 0) + 1
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+            list(pool.map(scanner_thread, range(options['threads'])))
+        wall_time = time.perf_counter() - started
+
+        total = len(latencies)
+        failed = sum(errors.values())
+        quantiles = statistics.quantiles(latencies, n=100) if total > 1 else latencies * 99
+        self.stdout.write(
+            f"{total} scans from {options['threads']} scanners in {wall_time:.2f}s: "
+            f"{(total - failed) / wall_time:.0f} successful scans/s"
+        )
+        self.stdout.write(
+            f"Latency p50 {quantiles[49] * 1000:.1f}ms, p95 {quantiles[94] * 1000:.1f}ms, "
+            f"p99 {quantiles[98] * 1000:.1f}ms, max {max(latencies, default=0) * 1000:.1f}ms"
+        )
+        if retries:
+            self.stdout.write(f"{len(retries)} scans turned away as busy and sent again")
+        for message, count in sorted(errors.items(), key=lambda item: -item[1]):
+            self.stdout.write(self.style.ERROR(f"{count} failed: {message}"))
+
+        if not options['keep']:
+            # Cascades to the benchmark students, their logs and sessions
+            supervisor.delete()
+
+    @staticmethod
+    def _view_scanner(supervisor, on_retry):
+        """
+        Scan through the endpoint with a signed-in client of its own. Scans
+        turned away as busy are sent again after Retry-After, as the scan page
+        does, so their latency includes the wait.
+        """
+        client = Client(HTTP_HOST='localhost')
+        client.force_login(supervisor)
+
+        def scan(code):
+            while True:
+                response = client.post(
+                    reverse('process_scan'), data=json.dumps({'qr_code': code}), content_type='application/json'
+                )
+                if response.status_code != 503:
+                    return response.json()
+                on_retry()
+                time.sleep(float(response['Retry-After']) * random.uniform(0.5, 1.5))
+        return scan
+
+    def _setup(self, people):
+        supervisor, _ = User.objects.get_or_create(username=self.BENCH_USERNAME)
+        # Unique per run, so students kept with --keep don't clash with the next run's
+        run = uuid.uuid4().hex[:8]
+        year = timezone.localdate().year
+
+        with transaction.atomic():
+            students = [
+                RegularStudent(
+                    first_name='Bench',
+                    last_name=f'Student{number}',
+                    student_id=f'{self.BENCH_ID_PREFIX}{run}-{number:05d}',
+                    class_status='Benchmark',
+                    boarding_status='Day',
+                    year_joined=year,
+                    year_completed=year + 3,
+                    created_by=supervisor,
+                )
+                for number in range(people)
+            ]
+            RegularStudent.objects.bulk_create(students)
+        return supervisor, [student.student_id for student in students]
+
+    def _describe_profile(self):
+        settings_dict = connection.settings_dict
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                journal_mode = cursor.execute('PRAGMA journal_mode').fetchone()[0]
+                synchronous = cursor.execute('PRAGMA synchronous').fetchone()[0]
+                busy_timeout = cursor.execute('PRAGMA busy_timeout').fetchone()[0]
+            return (
+                f"sqlite journal_mode={journal_mode} synchronous={synchronous} "
+                f"busy_timeout={busy_timeout}ms transaction_mode={connection.transaction_mode}"
+            )
+
+        pool = settings_dict.get('OPTIONS', {}).get('pool')
+        if pool:
+            return f"{connection.vendor} pooled connections {pool}"
+        return f"{connection.vendor} CONN_MAX_AGE={settings_dict['CONN_MAX_AGE']}"
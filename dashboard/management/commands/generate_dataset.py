@@ -0,0 +1,301 @@
+from datetime import date, datetime, time, timedelta
+import math
+import random
+import time as clock
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.duration import duration_microseconds
+
+from dashboard import log_counts
+from dashboard.models import AccessLog, Guest, Lab, LabSession, RegularStudent, TemporaryStudent
+from dashboard.projections import advance_checkpoint, latest_log_id
+from dashboard.roster_sync import record_reset
+
+FIRST_NAMES = (
+    'Amina', 'Brian', 'Chloe', 'David', 'Esther', 'Felix', 'Grace', 'Hassan', 'Irene', 'James',
+    'Kofi', 'Linda', 'Moses', 'Naomi', 'Oscar', 'Priya', 'Quinn', 'Ruth', 'Samuel', 'Tendai',
+    'Umar', 'Violet', 'Wanjiru', 'Xavier', 'Yusuf', 'Zawadi',
+)
+LAST_NAMES = (
+    'Achieng', 'Banda', 'Chen', 'Diallo', 'Evans', 'Fofana', 'Garcia', 'Hughes', 'Ibrahim', 'Juma',
+    'Kamau', 'Lopez', 'Mensah', 'Njoroge', 'Okafor', 'Patel', 'Quaye', 'Rossi', 'Smith', 'Tembo',
+    'Usman', 'Varga', 'Wanjala', 'Xu', 'Yeboah', 'Zulu',
+)
+ORGANIZATIONS = ('Hill School', 'City Academy', 'Lakeside College', 'Tech Hub', 'Ministry of Education')
+
+# Share of the average daily traffic on each weekday, Monday first
+WEEKDAY_TRAFFIC = (1.15, 1.15, 1.15, 1.15, 1.0, 0.35, 0.05)
+
+# Traffic rows are written with executemany; building millions of model
+# instances for bulk_create spends most of the time in the ORM
+PERSON_COLUMNS = {
+    'regular': lambda pk: (pk, None, None),
+    'temporary': lambda pk: (None, pk, None),
+    'guest': lambda pk: (None, None, pk),
+}
+ACCESS_LOG_COLUMNS = (
+    'id', 'regular_student_id', 'temporary_student_id', 'guest_id', 'user_type', 'log_type', 'timestamp',
+    'recorded_by_id', 'session_id', 'paired_log_id', 'lab_id',
+)
+LAB_SESSION_COLUMNS = (
+    'id', 'regular_student_id', 'temporary_student_id', 'guest_id', 'user_type', 'entry_time', 'exit_time',
+    'duration', 'entry_log_id', 'exit_log_id', 'lab_id',
+)
+
+# The lab is open 07:00-19:00; visits start in the first ten hours
+OPENING_TIME = time(7)
+CLOSING_TIME = time(19)
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the database with a reproducible synthetic dataset of students, guests and daily lab "
+        "traffic for benchmarking. Use a scratch database."
+    )
+
+    GENERATOR_USERNAME = 'dataset-generator'
+    # Rows per executemany call, and visits written per transaction
+    BATCH_SIZE = 2000
+    VISITS_PER_TRANSACTION = 50000
+
+    def add_arguments(self, parser):
+        parser.add_argument('--years', type=int, default=3, help="Years of traffic to generate")
+        parser.add_argument(
+            '--students-per-year', type=int, default=None,
+            help="Regular students joining each year (default: at least 300, and enough for --logs)",
+        )
+        parser.add_argument('--temporary-per-year', type=int, default=40, help="Temporary students each year")
+        parser.add_argument('--guests-per-year', type=int, default=150, help="Guests visiting each year")
+        parser.add_argument('--logs', type=int, default=200000, help="Approximate number of access logs to create")
+        parser.add_argument('--seed', type=int, default=1, help="Random seed; the same seed gives the same data")
+        parser.add_argument(
+            '--end-date', type=date.fromisoformat, default=None,
+            help="Traffic is generated for the days before this date (YYYY-MM-DD, default today)",
+        )
+
+    def handle(self, *args, **options):
+        if options['years'] < 1 or options['logs'] < 0:
+            raise CommandError("--years must be at least 1 and --logs can't be negative.")
+
+        rng = random.Random(options['seed'])
+        end_date = options['end_date'] or timezone.localdate()
+        start_date = end_date - timedelta(days=365 * options['years'])
+        started = clock.perf_counter()
+
+        # Four cohorts are at school at once and nobody visits twice a day, so the
+        # busiest days need a few more students than visits
+        busiest_day = options['logs'] / 2 / (end_date - start_date).days * max(WEEKDAY_TRAFFIC)
+        students_per_year = options['students_per_year'] or max(300, math.ceil(busiest_day * 1.5 / 4))
+
+        supervisor, _ = User.objects.get_or_create(username=self.GENERATOR_USERNAME)
+        regular = self._create_regular_students(rng, supervisor, start_date, end_date, students_per_year)
+        temporary = self._create_temporary_students(rng, supervisor, start_date, end_date, options['temporary_per_year'])
+        guests = self._create_guests(rng, supervisor, start_date, end_date, options['guests_per_year'])
+        self.stdout.write(
+            f"Created {len(regular)} regular students, {len(temporary)} temporary students "
+            f"and {len(guests)} guests in {clock.perf_counter() - started:.1f}s"
+        )
+
+        logs = self._create_traffic(rng, supervisor, start_date, end_date, options['logs'], regular, temporary, guests)
+        self.stdout.write(f"Created {logs} access logs in {clock.perf_counter() - started:.1f}s")
+
+        call_command('rebuild_visit_stats', stdout=self.stdout)
+        # The sessions were written with their logs; catch-up needn't replay them
+        advance_checkpoint(latest_log_id())
+        # People were bulk inserted without signals; stations must fetch the whole roster
+        record_reset()
+        # So were the back-dated logs; count their days from scratch
+        log_counts.reset()
+        log_counts.store_closed_days()
+        self.stdout.write(self.style.SUCCESS(f"Dataset ready in {clock.perf_counter() - started:.1f}s"))
+
+    def _create_regular_students(self, rng, supervisor, start_date, end_date, per_year):
+        # Cohorts that are still at school when the traffic starts joined up to three years earlier
+        students = []
+        for year_joined in range(start_date.year - 3, end_date.year + 1):
+            joined_at = self._aware(date(year_joined, 1, 1), OPENING_TIME)
+            for _ in range(per_year):
+                students.append(RegularStudent(
+                    first_name=rng.choice(FIRST_NAMES),
+                    last_name=rng.choice(LAST_NAMES),
+                    class_status=f'Form {rng.randint(1, 4)}',
+                    boarding_status=rng.choice(('Day', 'Boarding')),
+                    year_joined=year_joined,
+                    year_completed=year_joined + 3,
+                    is_active=year_joined + 3 >= end_date.year,
+                    created_by=supervisor,
+                    created_at=joined_at,
+                ))
+        RegularStudent.allocate_student_ids(students)
+        return self._insert_people(RegularStudent, students)
+
+    def _create_temporary_students(self, rng, supervisor, start_date, end_date, per_year):
+        students = []
+        for _ in range(per_year * (end_date.year - start_date.year + 1)):
+            valid_from = start_date + timedelta(days=rng.randrange((end_date - start_date).days))
+            valid_until = valid_from + timedelta(days=rng.randint(7, 60))
+            students.append(TemporaryStudent(
+                first_name=rng.choice(FIRST_NAMES),
+                last_name=rng.choice(LAST_NAMES),
+                class_status='Visiting',
+                boarding_status=rng.choice(('Day', 'Boarding')),
+                year_joined=valid_from.year,
+                year_completed=valid_from.year + 3,
+                valid_from=self._aware(valid_from, OPENING_TIME),
+                valid_until=self._aware(valid_until, CLOSING_TIME),
+                is_active=valid_until >= end_date,
+                reason=rng.choice(('Exchange programme', 'Holiday course', 'Project work')),
+                created_by=supervisor,
+                created_at=self._aware(valid_from, OPENING_TIME),
+            ))
+        TemporaryStudent.allocate_student_ids(students)
+        return self._insert_people(TemporaryStudent, students)
+
+    def _create_guests(self, rng, supervisor, start_date, end_date, per_year):
+        taken = set(Guest.objects.values_list('guest_id', flat=True))
+        guests = []
+        for _ in range(per_year * (end_date.year - start_date.year + 1)):
+            guest_id = f'GUEST-{rng.getrandbits(32):08X}'
+            while guest_id in taken:
+                guest_id = f'GUEST-{rng.getrandbits(32):08X}'
+            taken.add(guest_id)
+
+            # Guests register on the day they visit
+            visit_day = start_date + timedelta(days=rng.randrange((end_date - start_date).days))
+            guests.append(Guest(
+                first_name=rng.choice(FIRST_NAMES),
+                last_name=rng.choice(LAST_NAMES),
+                school_or_organization=rng.choice(ORGANIZATIONS),
+                purpose='Visit',
+                guest_id=guest_id,
+                created_by=supervisor,
+                created_at=self._aware(visit_day, OPENING_TIME),
+            ))
+        return self._insert_people(Guest, guests)
+
+    def _insert_people(self, model, people):
+        # created_at is auto_now_add, so bulk_create stamps "now"; put the generated dates back
+        created_at = [person.created_at for person in people]
+        with transaction.atomic():
+            model.objects.bulk_create(people, batch_size=self.BATCH_SIZE)
+            for person, value in zip(people, created_at):
+                person.created_at = value
+            model.objects.bulk_update(people, ['created_at'], batch_size=self.BATCH_SIZE)
+        return people
+
+    def _create_traffic(self, rng, supervisor, start_date, end_date, target_logs, regular, temporary, guests):
+        days = (end_date - start_date).days
+        # Two logs per visit, spread by weekday around the average
+        average_visits = target_logs / 2 / days
+
+        # Who can visit on a given day
+        regular_by_year = {}
+        for student in regular:
+            for year in range(student.year_joined, student.year_completed + 1):
+                regular_by_year.setdefault(year, []).append(student.pk)
+        temporary_by_day = {}
+        for student in temporary:
+            day = student.valid_from.date()
+            while day <= min(student.valid_until.date(), end_date):
+                temporary_by_day.setdefault(day, []).append(student.pk)
+                day += timedelta(days=1)
+        guests_by_day = {}
+        for guest in guests:
+            guests_by_day.setdefault(timezone.localdate(guest.created_at), []).append(guest.pk)
+
+        next_log_id = (AccessLog.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+        next_session_id = (LabSession.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+        lab_id = Lab.default().pk
+        # The per-value adapters Django would call cost more than the inserts, so
+        # values are converted the same way here once per database
+        features = connection.features
+        adapt_datetime = (lambda value: value) if features.supports_timezones else (
+            lambda value: str(value.replace(tzinfo=None))
+        )
+        adapt_uuid = (lambda value: value) if features.has_native_uuid_field else (lambda value: value.hex)
+        adapt_duration = (lambda value: value) if features.has_native_duration_field else duration_microseconds
+        logs, sessions = [], []
+        total_logs = 0
+
+        for offset in range(days):
+            day = start_date + timedelta(days=offset)
+            expected = average_visits * WEEKDAY_TRAFFIC[day.weekday()]
+            visit_count = max(int(rng.gauss(expected, expected ** 0.5)), 0)
+
+            # Everyone who registered today comes in, temporary students often do, and
+            # the rest are regular students still at school, each at most once a day
+            visitors = [('guest', pk) for pk in guests_by_day.get(day, ())]
+            visitors += [('temporary', pk) for pk in temporary_by_day.get(day, ()) if rng.random() < 0.5]
+            eligible = regular_by_year.get(day.year, ())
+            visitors += [
+                ('regular', pk)
+                for pk in rng.sample(eligible, min(max(visit_count - len(visitors), 0), len(eligible)))
+            ]
+
+            opening = self._aware(day, OPENING_TIME).astimezone(connection.timezone)
+            closing = self._aware(day, CLOSING_TIME).astimezone(connection.timezone)
+            for user_type, person_id in visitors:
+                entry_time = opening + timedelta(seconds=rng.randrange(10 * 3600))
+                exit_time = min(entry_time + timedelta(minutes=rng.randint(10, 180)), closing)
+                person = PERSON_COLUMNS[user_type](person_id)
+                entered_at, exited_at = adapt_datetime(entry_time), adapt_datetime(exit_time)
+                session_uuid = adapt_uuid(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+                logs.append((
+                    next_log_id, *person, user_type, 'entry', entered_at, supervisor.pk, session_uuid, None, lab_id,
+                ))
+                logs.append((
+                    next_log_id + 1, *person, user_type, 'exit', exited_at, supervisor.pk, session_uuid, next_log_id,
+                    lab_id,
+                ))
+                sessions.append((
+                    next_session_id, *person, user_type, entered_at, exited_at,
+                    adapt_duration(exit_time - entry_time), next_log_id, next_log_id + 1, lab_id,
+                ))
+                next_log_id += 2
+                next_session_id += 1
+
+            if len(sessions) >= self.VISITS_PER_TRANSACTION:
+                total_logs += self._write_traffic(logs, sessions)
+                logs, sessions = [], []
+                self.stdout.write(f"  {total_logs} access logs, up to {day}")
+
+        total_logs += self._write_traffic(logs, sessions)
+        self._reset_sequences()
+        return total_logs
+
+    def _write_traffic(self, logs, sessions):
+        with transaction.atomic(), connection.cursor() as cursor:
+            for model, columns, rows in (
+                (AccessLog, ACCESS_LOG_COLUMNS, logs),
+                (LabSession, LAB_SESSION_COLUMNS, sessions),
+            ):
+                sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+                    connection.ops.quote_name(model._meta.db_table),
+                    ', '.join(connection.ops.quote_name(column) for column in columns),
+                    ', '.join(['%s'] * len(columns)),
+                )
+                for start in range(0, len(rows), self.BATCH_SIZE):
+                    cursor.executemany(sql, rows[start:start + self.BATCH_SIZE])
+        return len(logs)
+
+    @staticmethod
+    def _reset_sequences():
+        # IDs were assigned here, so sequence-backed databases have to catch up
+        statements = connection.ops.sequence_reset_sql(no_style(), [AccessLog, LabSession])
+        if statements:
+            with connection.cursor() as cursor:
+                for sql in statements:
+                    cursor.execute(sql)
+
+    @staticmethod
+    def _aware(day, at):
+        return timezone.make_aware(datetime.combine(day, at))
+
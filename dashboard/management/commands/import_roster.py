@@ -0,0 +1,43 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard.roster_import import RosterImporter, RosterImportError
+
+
+class Command(BaseCommand):
+    help = "Bulk import students from a CSV or .xlsx roster file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Path to the .csv or .xlsx roster")
+        parser.add_argument('--type', dest='student_type', default='regular',
+                            choices=sorted(RosterImporter.MODELS), help="Type of students in the roster")
+        parser.add_argument('--user', required=True, help="Username recorded as the creator of the students")
+        parser.add_argument('--dry-run', action='store_true', help="Validate the roster without saving anything")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"User '{options['user']}' does not exist")
+
+        importer = RosterImporter(user, options['student_type'])
+        started = time.monotonic()
+        try:
+            with open(options['path'], 'rb') as roster_file:
+                result = importer.import_file(roster_file, options['path'], dry_run=options['dry_run'])
+        except OSError as e:
+            raise CommandError(f"Could not open roster: {e}")
+        except RosterImportError as e:
+            raise CommandError(str(e))
+
+        for error in result['errors']:
+            for message in error['messages']:
+                self.stderr.write(f"Row {error['row']}: {message}")
+
+        if result['status'] != 'success':
+            raise CommandError(result['message'])
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(f"{result['message']} ({elapsed:.2f}s)"))
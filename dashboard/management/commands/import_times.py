@@ -0,0 +1,81 @@
+import os
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# What a worker imports before it can serve a request: the apps, the
+# middleware chain and the URLconf with every view module behind it
+STARTUP = '''
+import django
+django.setup()
+from django.core.handlers.wsgi import WSGIHandler
+from django.urls import get_resolver
+WSGIHandler()
+get_resolver().url_patterns
+'''
+
+
+class Command(BaseCommand):
+    help = "Profile how long a worker spends importing modules at startup, per module and per package"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20, help="Modules to list")
+        parser.add_argument(
+            '--sort', choices=('cumulative', 'self'), default='cumulative',
+            help="Rank modules by time including their own imports, or excluding them"
+        )
+        parser.add_argument('--budget', type=float, help="Fail if imports take longer than this many milliseconds")
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get(
+            'DJANGO_SETTINGS_MODULE', settings.SETTINGS_MODULE
+        ))
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', STARTUP],
+            env=env, capture_output=True, text=True,
+        )
+        elapsed = (time.perf_counter() - started) * 1000
+        if result.returncode:
+            raise CommandError(f"Startup failed:\n{result.stderr}")
+
+        modules = self._parse(result.stderr)
+        # Top-level imports' cumulative times add up to the whole import phase
+        total = sum(cumulative for _, _, cumulative, depth in modules if depth == 0) / 1000
+
+        packages = {}
+        for name, own, _, _ in modules:
+            package = name.split('.')[0]
+            packages[package] = packages.get(package, 0) + own
+
+        self.stdout.write(f"Process start to ready: {elapsed:.0f} ms, of which imports: {total:.0f} ms "
+                          f"({len(modules)} modules)\n")
+        self.stdout.write("By package (own time):")
+        for package, own in sorted(packages.items(), key=lambda item: -item[1])[:options['top']]:
+            self.stdout.write(f"  {own / 1000:>8.1f} ms  {package}")
+
+        column = 1 if options['sort'] == 'self' else 2
+        self.stdout.write(f"\nSlowest modules ({options['sort']}):")
+        for name, own, cumulative, _ in sorted(modules, key=lambda item: -item[column])[:options['top']]:
+            self.stdout.write(f"  {cumulative / 1000:>8.1f} ms  {own / 1000:>8.1f} ms own  {name}")
+
+        if options['budget'] is not None and total > options['budget']:
+            raise CommandError(f"Imports took {total:.0f} ms, over the {options['budget']:.0f} ms budget")
+
+    @staticmethod
+    def _parse(output):
+        """(module, own us, cumulative us, nesting depth) for each line of -X importtime output."""
+        modules = []
+        for line in output.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            own, cumulative, name = line[len('import time:'):].split('|')
+            if not own.strip().isdigit():
+                # The header line
+                continue
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            modules.append((name.strip(), int(own), int(cumulative), depth))
+        return modules
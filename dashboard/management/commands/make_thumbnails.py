@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from dashboard.thumbnails import IMAGE_FIELDS, make_thumbnails
+
+
+class Command(BaseCommand):
+    help = "Create thumbnails for every uploaded photo and logo that doesn't have them yet"
+
+    def handle(self, *args, **options):
+        created = failed = 0
+        for model, field in IMAGE_FIELDS.items():
+            names = model.objects.exclude(**{f'{field}__isnull': True}).exclude(**{field: ''}).values_list(
+                field, flat=True
+            )
+            for name in names.iterator():
+                path = model._meta.get_field(field).storage.path(name)
+                try:
+                    make_thumbnails(path)
+                    created += 1
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f"{name}: {type(e).__name__}: {e}")
+
+        self.stdout.write(self.style.SUCCESS(f"Thumbnails ready for {created} images, {failed} failed"))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from dashboard.models import VisitStats
+
+
+class Command(BaseCommand):
+    help = "Rebuild every person's visit statistics from their closed lab sessions"
+
+    def handle(self, *args, **options):
+        count = VisitStats.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt visit statistics for {count} people"))
@@ -0,0 +1,150 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard import qr
+from dashboard.models import Guest, GuestGroup, RegularStudent, TemporaryStudent
+
+
+class Command(BaseCommand):
+    help = (
+        "Draw QR codes into the disk cache the QR code view serves from, in parallel, "
+        "resuming after interruptions"
+    )
+
+    # type -> (model, field holding the QR payload)
+    TYPES = {
+        'regular': (RegularStudent, 'student_id'),
+        'temporary': (TemporaryStudent, 'student_id'),
+        'guest': (Guest, 'guest_id'),
+        'group': (GuestGroup, 'group_id'),
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('--type', dest='types', action='append', choices=sorted(self.TYPES),
+                            help="Only regenerate this type (repeatable, defaults to all)")
+        parser.add_argument('--year', dest='years', action='append', type=int,
+                            help="Only regenerate students who joined in this year (repeatable)")
+        parser.add_argument('--format', dest='formats', action='append', choices=sorted(qr.FORMATS),
+                            help="Image format to draw (repeatable, defaults to png)")
+        parser.add_argument('--size', type=int, default=qr.DEFAULT_BOX_SIZE, help="QR box size in pixels")
+        parser.add_argument('--error-correction', choices=qr.ERROR_CORRECTION_LEVELS,
+                            default=settings.QR_ERROR_CORRECTION,
+                            help="Error correction level (defaults to QR_ERROR_CORRECTION). Draw a new level "
+                                 "ahead of changing the setting so the switch starts with a warm cache")
+        parser.add_argument('--force', action='store_true', help="Redraw images that are already cached")
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Rendering processes (defaults to the CPU count)")
+        parser.add_argument('--batch-size', type=int, default=500, help="Records per database update")
+        parser.add_argument('--resume', action='store_true',
+                            help="Continue from the checkpoint left by an interrupted run")
+        parser.add_argument('--checkpoint', default=os.path.join(settings.MEDIA_ROOT, 'qr_regenerate.json'),
+                            help="File recording progress between batches")
+
+    def handle(self, *args, **options):
+        self.checkpoint_path = options['checkpoint']
+        self.selection = self._selection(options)
+        self.checkpoint = self._load_checkpoint() if options['resume'] else {}
+        workers = options['workers'] or os.cpu_count() or 1
+
+        total = 0
+        started = time.monotonic()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for student_type in options['types'] or sorted(self.TYPES):
+                total += self._regenerate(pool, workers, student_type, options)
+
+        elapsed = time.monotonic() - started
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        self.stdout.write(self.style.SUCCESS(
+            f"Drew {total} QR code images in {elapsed:.1f}s "
+            f"({total / elapsed if elapsed else 0:.0f}/s with {workers} workers)"
+        ))
+
+    def _regenerate(self, pool, workers, student_type, options):
+        model, payload_field = self.TYPES[student_type]
+
+        queryset = model.objects.order_by('pk')
+        if options['years']:
+            if student_type in ('guest', 'group'):
+                return 0
+            queryset = queryset.filter(year_joined__in=options['years'])
+
+        formats = options['formats'] or ['png']
+        size = max(1, min(options['size'], qr.MAX_BOX_SIZE))
+        error_correction = options['error_correction']
+
+        last_pk = self.checkpoint.get(student_type, 0)
+        if last_pk:
+            self.stdout.write(f"Resuming {student_type} after id {last_pk}")
+
+        done = 0
+        while True:
+            # Keyset pagination keeps every batch query cheap however far in we are
+            batch = list(queryset.filter(pk__gt=last_pk).values_list('pk', payload_field)[:options['batch_size']])
+            if not batch:
+                break
+
+            batch_started = time.monotonic()
+            jobs = [
+                (qr.disk_cache_path(payload, fmt, size, error_correction), payload, fmt)
+                for _, payload in batch for fmt in formats
+            ]
+            if not options['force']:
+                jobs = [job for job in jobs if not os.path.exists(job[0])]
+
+            if jobs:
+                paths, payloads, job_formats = zip(*jobs)
+                chunksize = max(1, len(jobs) // (workers * 4))
+                list(pool.map(
+                    qr.write_qr_image, paths, payloads, job_formats,
+                    [size] * len(jobs), [error_correction] * len(jobs), chunksize=chunksize,
+                ))
+
+            last_pk = batch[-1][0]
+            done += len(jobs)
+            self.checkpoint[student_type] = last_pk
+            self._save_checkpoint()
+
+            # A batch that was already cached can finish within the clock's resolution
+            rate = len(jobs) / max(time.monotonic() - batch_started, 1e-6)
+            self.stdout.write(f"{student_type}: {done} drawn, up to id {last_pk} ({rate:.0f}/s)")
+
+        return done
+
+    def _selection(self, options):
+        """The options that decide which images a run draws, as stored in its checkpoint."""
+        return {
+            'types': sorted(options['types'] or self.TYPES),
+            'years': sorted(options['years'] or []),
+            'formats': sorted(options['formats'] or ['png']),
+            'size': options['size'],
+            'error_correction': options['error_correction'],
+        }
+
+    def _load_checkpoint(self):
+        """Last id done per type, if the checkpoint was left by a run drawing the same selection."""
+        try:
+            with open(self.checkpoint_path) as checkpoint:
+                checkpoint = json.load(checkpoint)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            raise CommandError(f"Checkpoint {self.checkpoint_path} is corrupt; rerun without --resume")
+
+        # Resuming with other filters would skip rows the interrupted run never reached
+        if not isinstance(checkpoint, dict) or checkpoint.get('selection') != self.selection:
+            raise CommandError(
+                f"Checkpoint {self.checkpoint_path} was left by a run with different --type, --year, --format, "
+                "--size or --error-correction options; resume with the same options or rerun without --resume"
+            )
+        return checkpoint['positions']
+
+    def _save_checkpoint(self):
+        os.makedirs(os.path.dirname(self.checkpoint_path) or '.', exist_ok=True)
+        checkpoint = {'selection': self.selection, 'positions': self.checkpoint}
+        qr.write_atomic(self.checkpoint_path, json.dumps(checkpoint).encode())
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard.id_cards import IDCardRenderer, people_for_cards
+
+
+class Command(BaseCommand):
+    help = "Render ID cards for a cohort and tile them onto printable A4 PDF sheets"
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="Path of the PDF to write")
+        parser.add_argument('--type', dest='person_type', default='regular',
+                            choices=['regular', 'temporary', 'guest'])
+        parser.add_argument('--year', dest='years', action='append', type=int,
+                            help="Only students who joined in this year (repeatable)")
+        parser.add_argument('--include-inactive', action='store_true', help="Also print cards for inactive students")
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Rendering processes (defaults to the CPU count)")
+
+    def handle(self, *args, **options):
+        people = people_for_cards(options['person_type'], options['years'], options['include_inactive'])
+        if not people.exists():
+            raise CommandError("No matching people to print cards for")
+
+        started = time.monotonic()
+        renderer = IDCardRenderer(workers=options['workers'])
+        card_paths = renderer.render(people)
+        pages = renderer.write_sheets(card_paths, options['output'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {len(card_paths)} cards on {pages} pages to {options['output']} "
+            f"in {time.monotonic() - started:.1f}s"
+        ))
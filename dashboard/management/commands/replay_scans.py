@@ -0,0 +1,65 @@
+from datetime import date, datetime, time
+import time as clock
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from dashboard import projections
+from dashboard.models import LabSession
+
+
+def moment(value):
+    """A date (midnight, local time) or a date and time"""
+    try:
+        parsed = parse_datetime(value) or datetime.combine(date.fromisoformat(value), time.min)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValueError(value)
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild lab sessions, their durations and visit stats from the access log. "
+        "Without options, replays only the logs added since the last catch-up."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=moment, help="Rebuild sessions starting at or after this date or time")
+        parser.add_argument('--until', type=moment, help="Rebuild sessions starting before this date or time")
+        parser.add_argument('--all', action='store_true', help="Rebuild every session from the whole access log")
+
+    def handle(self, *args, **options):
+        since, until = options['since'], options['until']
+        if options['all'] and (since or until):
+            raise CommandError("--all replays everything; leave out --since and --until")
+        if since and until and since >= until:
+            raise CommandError("--since must be before --until")
+
+        started = clock.perf_counter()
+        if options['all'] or since or until:
+            counts = projections.replay(since=since, until=until)
+        else:
+            counts = projections.catch_up()
+        elapsed = clock.perf_counter() - started
+
+        self.stdout.write(
+            f"Replayed {counts['logs']} access logs in {elapsed:.1f} s "
+            f"({counts['logs'] / elapsed if elapsed else 0:.0f} logs/s)"
+        )
+        self.stdout.write(
+            f"  sessions: {counts['created']} created, {counts['updated']} updated, {counts['deleted']} deleted"
+        )
+        self.stdout.write(
+            f"  logs: {counts['repaired']} re-paired, {counts['unpaired']} exits without an open session"
+        )
+
+        occupancy = LabSession.objects.filter(exit_time__isnull=True).values('lab__name').annotate(
+            inside=Count('id')
+        ).order_by('lab__name')
+        for row in occupancy:
+            self.stdout.write(f"  {row['lab__name']}: {row['inside']} inside")
+        self.stdout.write(self.style.SUCCESS("Lab sessions are up to date"))
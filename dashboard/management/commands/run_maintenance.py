@@ -0,0 +1,61 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from dashboard import maintenance
+
+
+class Command(BaseCommand):
+    help = "Run scheduled maintenance jobs, once (for cron) or continuously with --loop"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job', dest='jobs', action='append', choices=sorted(maintenance.JOBS),
+                            help="Run this job now whether or not it is due (repeatable)")
+        parser.add_argument('--list', action='store_true', help="List jobs and when they last ran")
+        parser.add_argument('--loop', action='store_true', help="Keep running jobs as they become due")
+        parser.add_argument('--max-sleep', type=int, default=60,
+                            help="Longest time in seconds the loop sleeps between checks")
+
+    def handle(self, *args, **options):
+        if options['list']:
+            previous = maintenance.last_runs()
+            for name, job in maintenance.JOBS.items():
+                last = previous.get(name)
+                self.stdout.write(
+                    f"{name} (every {job.interval}) last run: {last:%Y-%m-%d %H:%M:%S}" if last
+                    else f"{name} (every {job.interval}) last run: never"
+                )
+                self.stdout.write(f"    {job.description}")
+            return
+
+        if options['jobs']:
+            for name in options['jobs']:
+                run = maintenance.run_job(name)
+                if run is None:
+                    self.stderr.write(self.style.WARNING(f"{name}: already running elsewhere, skipped"))
+                else:
+                    self._report(run)
+            return
+
+        if not options['loop']:
+            for run in maintenance.run_due_jobs():
+                self._report(run)
+            return
+
+        self.stdout.write("Maintenance scheduler started")
+        try:
+            while True:
+                close_old_connections()
+                for run in maintenance.run_due_jobs():
+                    self._report(run)
+                time.sleep(min(maintenance.seconds_until_next_job(), options['max_sleep']) or 1)
+        except KeyboardInterrupt:
+            self.stdout.write("Maintenance scheduler stopped")
+
+    def _report(self, run):
+        line = f"{run.job}: {run.rows_affected} rows in {run.duration.total_seconds():.3f}s"
+        if run.status == 'success':
+            self.stdout.write(self.style.SUCCESS(line))
+        else:
+            self.stderr.write(self.style.ERROR(f"{line} - {run.message}"))
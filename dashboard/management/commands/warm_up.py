@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from dashboard.warmup import warm_up
+
+
+class Command(BaseCommand):
+    help = "Fill the settings, user and profile caches and compile the busiest templates"
+
+    def handle(self, *args, **options):
+        timings = warm_up()
+        for name, milliseconds in timings.items():
+            self.stdout.write(f"{name:<12} {milliseconds:>8.1f} ms")
+        self.stdout.write(self.style.SUCCESS(f"Warmed up in {sum(timings.values()):.1f} ms"))
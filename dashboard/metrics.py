@@ -0,0 +1,167 @@
+"""
+Prometheus metrics for the scraper at ``/metrics``.
+
+Scans are counted by result and timed, along with how many are being handled
+or are queued for admission (see ``admission``) and how long they queued.
+Database queries made while handling requests are timed, and cache lookups
+are counted as hits or misses. Current
+occupancy of each lab is read from the database when the endpoint is scraped. Rates
+such as scans per second come from ``rate()`` over the counters.
+
+With several worker processes, set PROMETHEUS_MULTIPROC_DIR to an empty,
+writable directory before the workers start. Every process then writes its
+samples there, and the endpoint adds them up. Without prometheus_client
+installed, recording does nothing and the endpoint returns 503.
+"""
+from contextlib import ExitStack
+import os
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.models import Count
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+SCAN_RESULTS = ('success', 'invalid', 'denied', 'suppressed', 'busy', 'error')
+
+# Where /metrics may be scraped from without METRICS_TOKEN
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+if prometheus_client is not None:
+    from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+    from prometheus_client.core import GaugeMetricFamily
+
+    SCANS = Counter('smartcheck_scans', 'QR code scans by result', ['result'])
+    SCAN_LATENCY = Histogram(
+        'smartcheck_scan_duration_seconds', 'Time taken to process a QR code scan',
+        buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+    )
+    # Summed over the worker processes while they're alive
+    SCANS_IN_PROGRESS = Gauge(
+        'smartcheck_scans_in_progress', 'Scans being handled now', multiprocess_mode='livesum'
+    )
+    SCAN_QUEUE_DEPTH = Gauge(
+        'smartcheck_scan_queue_depth', 'Scans waiting for their turn to be handled', multiprocess_mode='livesum'
+    )
+    SCAN_QUEUE_WAIT = Histogram(
+        'smartcheck_scan_queue_wait_seconds', 'Time scans waited for their turn before being handled',
+        buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+    )
+    DB_QUERY_TIME = Histogram(
+        'smartcheck_db_query_duration_seconds', 'Time taken by database queries made for requests', ['database'],
+        buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+    )
+    CACHE_LOOKUPS = Counter('smartcheck_cache_lookups', 'Cache lookups by cache and result', ['cache', 'result'])
+
+    # Export every result from the start so rate() sees the first scan
+    for result in SCAN_RESULTS:
+        SCANS.labels(result)
+
+
+def record_scan(result, seconds):
+    """Count a scan with one of SCAN_RESULTS and record how long it took."""
+    if prometheus_client is not None:
+        SCANS.labels(result).inc()
+        SCAN_LATENCY.observe(seconds)
+
+
+def record_scan_queue(in_progress, waiting):
+    if prometheus_client is not None:
+        SCANS_IN_PROGRESS.set(in_progress)
+        SCAN_QUEUE_DEPTH.set(waiting)
+
+
+def record_scan_admission(seconds):
+    """Record how long an admitted scan waited for its turn."""
+    if prometheus_client is not None:
+        SCAN_QUEUE_WAIT.observe(seconds)
+
+
+def record_cache_lookup(cache_name, hit):
+    if prometheus_client is not None:
+        CACHE_LOOKUPS.labels(cache_name, 'hit' if hit else 'miss').inc()
+
+
+def scan_result(result):
+    """Classify a QRCodeScanner result as one of SCAN_RESULTS."""
+    if result['status'] == 'success':
+        return 'success'
+    # Unknown codes carry no person; everything else was refused for a known one
+    return 'invalid' if result['data'] is None else 'denied'
+
+
+class DatabaseMetricsMiddleware:
+    """Time every query made while handling a request, per database."""
+    def __init__(self, get_response):
+        if prometheus_client is None:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self._time_query))
+            return self.get_response(request)
+
+    @staticmethod
+    def _time_query(execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            DB_QUERY_TIME.labels(context['connection'].alias).observe(time.perf_counter() - started)
+
+
+class OccupancyCollector:
+    """People in each lab right now, by user type, read at scrape time."""
+    def collect(self):
+        from .models import AccessLog, Lab, LabSession
+
+        occupancy = GaugeMetricFamily(
+            'smartcheck_occupancy', 'People currently in each lab', labels=['lab', 'user_type']
+        )
+        counts = {
+            (lab_id, user_type): count
+            for lab_id, user_type, count in LabSession.objects.filter(exit_time__isnull=True).values(
+                'lab', 'user_type'
+            ).annotate(count=Count('id')).values_list('lab', 'user_type', 'count').order_by()
+        }
+        for lab in Lab.load_all():
+            for user_type, _ in AccessLog.USER_TYPES:
+                occupancy.add_metric([lab.code, user_type], counts.get((lab.pk, user_type), 0))
+        yield occupancy
+
+
+def metrics(request):
+    """Text exposition of every metric, for Prometheus-compatible scrapers."""
+    if prometheus_client is None:
+        return HttpResponse('Metrics require the prometheus_client package.\n', status=503, content_type='text/plain')
+
+    if settings.METRICS_TOKEN:
+        expected = f'Bearer {settings.METRICS_TOKEN}'
+        if not constant_time_compare(request.headers.get('Authorization', ''), expected):
+            return HttpResponse('Unauthorized\n', status=401, content_type='text/plain')
+    elif not settings.DEBUG and request.META.get('REMOTE_ADDR') not in LOCAL_ADDRESSES:
+        # Occupancy is live data about who is where; don't serve it to anyone who asks
+        return HttpResponse('Forbidden\n', status=403, content_type='text/plain')
+
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+
+    live = CollectorRegistry()
+    live.register(OccupancyCollector())
+
+    output = prometheus_client.generate_latest(registry) + prometheus_client.generate_latest(live)
+    return HttpResponse(output, content_type=prometheus_client.CONTENT_TYPE_LATEST)
@@ -0,0 +1,48 @@
+# Generated by Django 5.1.4 on 2026-10-19 01:21
+
+import re
+
+from django.db import migrations, models
+
+
+def seed_sequences(apps, schema_editor):
+    """Start each cohort's sequence after the highest number already issued."""
+    StudentIDSequence = apps.get_model('dashboard', 'StudentIDSequence')
+    trailing_number = re.compile(r'(\d+)$')
+
+    sequences = {}
+    for model_name, type_prefix in (('RegularStudent', ''), ('TemporaryStudent', 'TMP')):
+        model = apps.get_model('dashboard', model_name)
+        for year_joined, student_id in model.objects.values_list('year_joined', 'student_id').iterator():
+            match = trailing_number.search(student_id or '')
+            number = int(match.group(1)) if match else 0
+            key = (year_joined, type_prefix)
+            sequences[key] = max(sequences.get(key, 0), number)
+
+    StudentIDSequence.objects.bulk_create(
+        StudentIDSequence(year_joined=year_joined, type_prefix=type_prefix, last_number=last_number)
+        for (year_joined, type_prefix), last_number in sequences.items()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StudentIDSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year_joined', models.IntegerField()),
+                ('type_prefix', models.CharField(blank=True, max_length=10)),
+                ('last_number', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('year_joined', 'type_prefix'), name='unique_student_id_sequence')],
+            },
+        ),
+        migrations.RunPython(seed_sequences, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.4 on 2026-10-19 01:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0002_student_id_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IDCard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generated_at', models.DateTimeField(auto_now=True)),
+                ('card_image', models.ImageField(blank=True, null=True, upload_to='id_cards/')),
+                ('fingerprint', models.CharField(blank=True, max_length=64)),
+                ('printed', models.BooleanField(default=False)),
+                ('guest', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='dashboard.guest')),
+                ('regular_student', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='dashboard.regularstudent')),
+                ('temporary_student', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='dashboard.temporarystudent')),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.4 on 2026-10-19 01:27
+
+import datetime
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0004_maintenance_run'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VisitStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_visits', models.PositiveIntegerField(db_index=True, default=0)),
+                ('total_duration', models.DurationField(default=datetime.timedelta)),
+                ('last_seen', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('guest', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='visit_stats', to='dashboard.guest')),
+                ('regular_student', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='visit_stats', to='dashboard.regularstudent')),
+                ('temporary_student', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='visit_stats', to='dashboard.temporarystudent')),
+            ],
+            options={
+                'verbose_name_plural': 'Visit stats',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-19 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0007_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='labsession',
+            name='entry_time',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,98 @@
+# Generated by Django 5.1.4 on 2026-10-19 10:12
+
+import dashboard.models
+import django.db.models.deletion
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import migrations, models
+
+MAIN_LAB_ID = 1
+
+
+def create_main_lab(apps, schema_editor):
+    """Existing logs and sessions all happened in the one lab there was."""
+    Lab = apps.get_model('dashboard', 'Lab')
+    Lab.objects.get_or_create(id=MAIN_LAB_ID, defaults={'name': 'Main Lab', 'code': 'main'})
+    # The id was given explicitly, so PostgreSQL's sequence hasn't moved past it
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Lab]):
+            cursor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0008_lab_session_entry_time_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Lab',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('code', models.SlugField(max_length=20, unique=True)),
+                ('capacity', models.PositiveIntegerField(default=50)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['pk'],
+            },
+        ),
+        migrations.RunPython(create_main_lab, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='ScannerStation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['lab', 'name'],
+            },
+        ),
+        migrations.AddField(
+            model_name='accesslog',
+            name='lab',
+            field=models.ForeignKey(default=MAIN_LAB_ID, on_delete=django.db.models.deletion.PROTECT, related_name='access_logs', to='dashboard.lab'),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='accesslog',
+            name='lab',
+            field=models.ForeignKey(default=dashboard.models.default_lab_id, on_delete=django.db.models.deletion.PROTECT, related_name='access_logs', to='dashboard.lab'),
+        ),
+        migrations.AddField(
+            model_name='labsession',
+            name='lab',
+            field=models.ForeignKey(default=MAIN_LAB_ID, on_delete=django.db.models.deletion.PROTECT, related_name='sessions', to='dashboard.lab'),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='labsession',
+            name='lab',
+            field=models.ForeignKey(default=dashboard.models.default_lab_id, on_delete=django.db.models.deletion.PROTECT, related_name='sessions', to='dashboard.lab'),
+        ),
+        migrations.AddIndex(
+            model_name='labsession',
+            index=models.Index(condition=models.Q(('exit_time__isnull', True)), fields=['lab', 'user_type'], name='labsession_open_by_lab'),
+        ),
+        migrations.AddField(
+            model_name='scannerstation',
+            name='lab',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='stations', to='dashboard.lab'),
+        ),
+        migrations.AddField(
+            model_name='accesslog',
+            name='station',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='access_logs', to='dashboard.scannerstation'),
+        ),
+        migrations.AddIndex(
+            model_name='accesslog',
+            index=models.Index(fields=['lab', 'timestamp'], name='accesslog_lab_time'),
+        ),
+    ]
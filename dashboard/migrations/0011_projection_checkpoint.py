@@ -0,0 +1,35 @@
+# Generated by Django 5.1.4 on 2026-10-19 11:05
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def start_at_latest_log(apps, schema_editor):
+    """
+    Existing sessions were written alongside their logs, so catch-up starts
+    after the latest log rather than replaying the whole history.
+    """
+    AccessLog = apps.get_model('dashboard', 'AccessLog')
+    ProjectionCheckpoint = apps.get_model('dashboard', 'ProjectionCheckpoint')
+    position = AccessLog.objects.aggregate(position=Max('id'))['position'] or 0
+    ProjectionCheckpoint.objects.get_or_create(name='lab_sessions', defaults={'position': position})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0010_roster_change'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProjectionCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('position', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(start_at_latest_log, migrations.RunPython.noop),
+    ]
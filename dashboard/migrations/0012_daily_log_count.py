@@ -0,0 +1,28 @@
+# Generated by Django 5.1.4 on 2026-10-19 13:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0011_projection_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyLogCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('log_type', models.CharField(choices=[('entry', 'Entry'), ('exit', 'Exit')], max_length=10)),
+                ('user_type', models.CharField(choices=[('regular', 'Regular Student'), ('temporary', 'Temporary Student'), ('guest', 'Guest')], max_length=20)),
+                ('count', models.PositiveIntegerField()),
+                ('lab', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_log_counts', to='dashboard.lab')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'lab', 'log_type', 'user_type'), name='dailylogcount_unique')],
+            },
+        ),
+    ]
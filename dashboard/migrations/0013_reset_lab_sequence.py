@@ -0,0 +1,24 @@
+# Generated by Django 5.1.4 on 2026-10-19 14:05
+
+from django.core.management.color import no_style
+from django.db import migrations
+
+
+def reset_lab_sequence(apps, schema_editor):
+    """0009 created the main lab with an explicit id; move PostgreSQL's sequence past it."""
+    Lab = apps.get_model('dashboard', 'Lab')
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Lab]):
+            cursor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0012_daily_log_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(reset_lab_sequence, migrations.RunPython.noop),
+    ]
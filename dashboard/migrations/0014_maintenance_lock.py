@@ -0,0 +1,21 @@
+# Generated by Django 5.1.4 on 2026-10-19 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0013_reset_lab_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MaintenanceLock',
+            fields=[
+                ('job', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('owner', models.CharField(blank=True, max_length=32)),
+                ('locked_until', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -1,13 +1,17 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, Q
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.urls import reverse
 from django.utils import timezone
 from datetime import timedelta
-import qrcode
-from io import BytesIO
 from django.core.files.base import ContentFile
 import uuid
 import os
 
+from .metrics import record_cache_lookup
+from .qr import render_qr_png
+
 class UserProfile(models.Model):
     """Extends the built-in User model with additional fields"""
     USER_TYPES = [
@@ -19,11 +23,74 @@ class UserProfile(models.Model):
     phone_number = models.CharField(max_length=15, blank=True, null=True)
     profile_photo = models.ImageField(upload_to='profile_photos/', blank=True, null=True)
 
+    # Cached profiles are refreshed at least this often (seconds)
+    CACHE_TIMEOUT = 300
+
+    @staticmethod
+    def cache_key(user_id):
+        return f'dashboard:user_profile:{user_id}'
+
+    @classmethod
+    def for_user(cls, user):
+        """The user's profile from the cache, or None if they don't have one"""
+        key = cls.cache_key(user.pk)
+        profile = cache.get(key)
+        record_cache_lookup('user_profile', profile is not None)
+        if profile is None:
+            # Cache a missing profile too, as False, so it isn't looked up every time
+            profile = cls.objects.filter(user_id=user.pk).first() or False
+            cache.set(key, profile, cls.CACHE_TIMEOUT)
+        return profile or None
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        cache.delete(self.cache_key(self.user_id))
+
+    def delete(self, *args, **kwargs):
+        cache.delete(self.cache_key(self.user_id))
+        return super().delete(*args, **kwargs)
+
     def __str__(self):
         return f"{self.user.get_full_name()} - {self.get_user_type_display()}"
 
+class StudentIDSequence(models.Model):
+    """Last student number issued for each cohort and student type"""
+    year_joined = models.IntegerField()
+    type_prefix = models.CharField(max_length=10, blank=True)
+    last_number = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['year_joined', 'type_prefix'], name='unique_student_id_sequence'),
+        ]
+
+    @classmethod
+    def allocate(cls, year_joined, type_prefix, count=1):
+        """
+        Atomically reserves ``count`` consecutive numbers for a cohort and
+        returns the first one.
+        """
+        sequence = cls.objects.filter(year_joined=year_joined, type_prefix=type_prefix)
+        with transaction.atomic():
+            # Write first so the row lock is taken before the read below
+            if not sequence.update(last_number=F('last_number') + count):
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(year_joined=year_joined, type_prefix=type_prefix, last_number=count)
+                except IntegrityError:
+                    # Another process created the row first
+                    sequence.update(last_number=F('last_number') + count)
+            last_number = sequence.values_list('last_number', flat=True).get()
+        return last_number - count + 1
+
+    def __str__(self):
+        return f"{self.year_joined} {self.type_prefix or 'REG'}: {self.last_number}"
+
 class BaseStudent(models.Model):
     """Base abstract model for common student fields"""
+    # Inserted between the year and the initials of generated student IDs
+    ID_TYPE_PREFIX = "UNK"
+
     BOARDING_CHOICES = [
         ('Day', 'Day'),
         ('Boarding', 'Boarding'),
@@ -53,47 +120,49 @@ class BaseStudent(models.Model):
 
     def generate_student_id(self):
         """Generates a unique student ID based on initials, year, and student type."""
-        initials = (self.first_name[0] + self.last_name[0]).upper()
-        init_year = self.year_joined + 3
-        year = str(init_year)[-2:]
-
-        from .models import RegularStudent, TemporaryStudent
-
-        if isinstance(self, TemporaryStudent):
-            type_prefix = "TMP"
-            relevant_students = list(TemporaryStudent.objects.filter(year_joined=self.year_joined))
-        elif isinstance(self, RegularStudent):
-            type_prefix = ""
-            relevant_students = list(RegularStudent.objects.filter(year_joined=self.year_joined))
-        else:
-            type_prefix = "UNK"
-            relevant_students = []
+        number = StudentIDSequence.allocate(self.year_joined, self.ID_TYPE_PREFIX)
+        return self.format_student_id(self.first_name, self.last_name, self.year_joined, number)
+
+    @classmethod
+    def format_student_id(cls, first_name, last_name, year_joined, number):
+        """Builds a student ID such as PRPC27-TMPJD004 from its parts."""
+        initials = (first_name[0] + last_name[0]).upper()
+        year = str(year_joined + 3)[-2:]
+        return f"PRPC{year}-{cls.ID_TYPE_PREFIX}{initials}{str(number).zfill(3)}"
+
+    @classmethod
+    def allocate_student_ids(cls, students):
+        """
+        Assigns student IDs to a batch of unsaved students, reserving the
+        numbers for each cohort with a single sequence update.
+        """
+        cohorts = {}
+        for student in students:
+            if not student.student_id:
+                cohorts.setdefault(student.year_joined, []).append(student)
+
+        for year_joined, cohort in cohorts.items():
+            number = StudentIDSequence.allocate(year_joined, cls.ID_TYPE_PREFIX, count=len(cohort))
+            for student in cohort:
+                student.student_id = cls.format_student_id(
+                    student.first_name, student.last_name, year_joined, number
+                )
+                number += 1
 
-        relevant_students.sort(key=lambda x: x.created_at)
-
-        if relevant_students and relevant_students[-1].student_id:
-            try:
-                last_number = int(relevant_students[-1].student_id[-3:])
-            except ValueError:
-                last_number = 0
-            new_number = str(last_number + 1).zfill(3)
-        else:
-            new_number = "001"
-
-        return f"PRPC{year}-{type_prefix}{initials}{new_number}"
+    @property
+    def qr_filename(self):
+        return f'qrcode_{self.student_id}.png'
 
+    @property
+    def qr_code_url(self):
+        """URL of the QR code, rendered on first request and cached after that"""
+        return reverse('qr_code_image', args=[self.student_id])
 
     def generate_qr_code(self):
         """Generates a QR code based on the student ID."""
-        # Create a QR code with student_id as the data
-        qr = qrcode.make(self.student_id)
-        qr_io = BytesIO()
-        qr.save(qr_io, format="PNG")
-
         # Save the QR code to the model's image field
-        filename = f'qrcode_{self.student_id}.png'
-        self.qr_code.save(filename, ContentFile(qr_io.getvalue()), save=False)
-        
+        self.qr_code.save(self.qr_filename, ContentFile(render_qr_png(self.student_id)), save=False)
+
     @property
     def year_batch(self):
         """Returns the calculated graduation year (Year Joined + 3)"""
@@ -105,21 +174,22 @@ class BaseStudent(models.Model):
 
 class RegularStudent(BaseStudent):
     """Regular students with permanent access to the lab"""
+    ID_TYPE_PREFIX = ""
+
     additional_notes = models.TextField(blank=True, null=True)
 
     def save(self, *args, **kwargs):
         if not self.student_id:
             self.student_id = self.generate_student_id()
         super().save(*args, **kwargs)
-        if not self.qr_code:
-            self.generate_qr_code()
-            super().save(update_fields=['qr_code'])
 
 
 class TemporaryStudent(BaseStudent):
     """Temporary students with limited-time access to the lab"""
+    ID_TYPE_PREFIX = "TMP"
+
     valid_from = models.DateTimeField(default=timezone.now)
-    valid_until = models.DateTimeField()
+    valid_until = models.DateTimeField(db_index=True)
     reason = models.CharField(max_length=255)
 
     @property
@@ -135,15 +205,40 @@ class TemporaryStudent(BaseStudent):
     def save(self, *args, **kwargs):
         if not self.student_id:
             self.student_id = self.generate_student_id()
-        super().save(*args, **kwargs)
-        if not self.qr_code:
-            self.generate_qr_code()
-            super().save(update_fields=['qr_code'])
         if self.valid_until < timezone.now():
             self.is_active = False
         super().save(*args, **kwargs)
 
 
+class GuestGroup(models.Model):
+    """A visiting party, such as a school trip, that is checked in and out together"""
+    ID_PREFIX = 'GROUP-'
+
+    name = models.CharField(max_length=100)
+    school_or_organization = models.CharField(max_length=100)
+    purpose = models.TextField()
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='guest_groups_created')
+    created_at = models.DateTimeField(auto_now_add=True)
+    group_id = models.CharField(max_length=50, unique=True, blank=True)
+
+    def generate_group_id(self):
+        """Generate a unique group ID"""
+        return f"{self.ID_PREFIX}{uuid.uuid4().hex[:8].upper()}"
+
+    @property
+    def qr_code_url(self):
+        """URL of the group QR code that checks every member in or out"""
+        return reverse('qr_code_image', args=[self.group_id])
+
+    def save(self, *args, **kwargs):
+        if not self.group_id:
+            self.group_id = self.generate_group_id()
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.name} - {self.school_or_organization}"
+
+
 class Guest(models.Model):
     """External visitors to the lab"""
     first_name = models.CharField(max_length=60)
@@ -153,36 +248,136 @@ class Guest(models.Model):
     contact_number = models.CharField(max_length=15, blank=True, null=True)
     email = models.EmailField(blank=True, null=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='guest_created')
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     guest_id = models.CharField(max_length=50, unique=True, blank=True)
     qr_code = models.ImageField(upload_to='guest_qrcodes/', blank=True, null=True)
+    group = models.ForeignKey(GuestGroup, on_delete=models.SET_NULL, null=True, blank=True, related_name='members')
 
     def generate_guest_id(self):
         """Generate a unique guest ID"""
         return f"GUEST-{uuid.uuid4().hex[:8].upper()}"
 
+    @property
+    def qr_filename(self):
+        return f'guest_qrcode_{self.guest_id}.png'
+
+    @property
+    def qr_code_url(self):
+        """URL of the QR code, rendered on first request and cached after that"""
+        return reverse('qr_code_image', args=[self.guest_id])
+
     def generate_qr_code(self):
         """Generates a QR code for temporary guest access."""
-        qr = qrcode.make(self.guest_id)
-        qr_io = BytesIO()
-        qr.save(qr_io, format="PNG")
-        filename = f'guest_qrcode_{self.guest_id}.png'
-        self.qr_code.save(filename, ContentFile(qr_io.getvalue()), save=False)
+        self.qr_code.save(self.qr_filename, ContentFile(render_qr_png(self.guest_id)), save=False)
 
     def save(self, *args, **kwargs):
         if not self.guest_id:
             self.guest_id = self.generate_guest_id()
         super().save(*args, **kwargs)
-        if not self.qr_code:
-            self.generate_qr_code()
-            super().save(update_fields=['qr_code'])
 
     def __str__(self):
         return f"{self.first_name} {self.last_name} - {self.school_or_organization}"
 
 
+class Lab(models.Model):
+    """A room with its own scanners, sessions and occupancy"""
+    name = models.CharField(max_length=100, unique=True)
+    # Short name used in URLs, e.g. /dashboard/?lab=science
+    code = models.SlugField(max_length=20, unique=True)
+    capacity = models.PositiveIntegerField(default=50)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    CACHE_KEY = 'dashboard:labs'
+    # Other worker processes with their own cache pick up changes within this time (seconds)
+    CACHE_TIMEOUT = 300
+
+    class Meta:
+        ordering = ['pk']
+
+    @classmethod
+    def load_all(cls):
+        """Every lab, in creation order, from the cache when possible"""
+        labs = cache.get(cls.CACHE_KEY)
+        record_cache_lookup('labs', labs is not None)
+        if labs is None:
+            labs = list(cls.objects.order_by('pk'))
+            cache.set(cls.CACHE_KEY, labs, cls.CACHE_TIMEOUT)
+        return labs
+
+    @classmethod
+    def default(cls):
+        """The first lab, which scans without a lab or station are recorded in"""
+        labs = cls.load_all()
+        if labs:
+            return labs[0]
+        lab, _ = cls.objects.get_or_create(code='main', defaults={'name': 'Main Lab'})
+        return lab
+
+    @classmethod
+    def for_code(cls, code, include_inactive=False):
+        """The active lab with this code, or None; reports also find closed labs"""
+        return next(
+            (lab for lab in cls.load_all() if lab.code == code and (lab.is_active or include_inactive)), None
+        )
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        cache.delete(self.CACHE_KEY)
+
+    def delete(self, *args, **kwargs):
+        cache.delete(self.CACHE_KEY)
+        return super().delete(*args, **kwargs)
+
+    def __str__(self):
+        return self.name
+
+
+def default_lab_id():
+    return Lab.default().pk
+
+
+class ScannerStation(models.Model):
+    """A phone, tablet or kiosk that scans codes at one lab's door"""
+    name = models.CharField(max_length=100)
+    lab = models.ForeignKey(Lab, on_delete=models.PROTECT, related_name='stations')
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['lab', 'name']
+
+    def __str__(self):
+        return f"{self.name} ({self.lab})"
+
+
+def person_search(query):
+    """
+    Filter for logs and sessions of people whose name or ID contains every
+    word of ``query``. People are matched in their own tables first, so the
+    log table is narrowed by its indexed foreign keys instead of LIKEs across
+    three joins.
+    """
+    students = Q()
+    guests = Q()
+    for word in query.split():
+        students &= Q(first_name__icontains=word) | Q(last_name__icontains=word) | Q(student_id__icontains=word)
+        guests &= (
+            Q(first_name__icontains=word) | Q(last_name__icontains=word) |
+            Q(guest_id__icontains=word) | Q(school_or_organization__icontains=word)
+        )
+    return (
+        Q(regular_student__in=RegularStudent.objects.filter(students).values('pk')) |
+        Q(temporary_student__in=TemporaryStudent.objects.filter(students).values('pk')) |
+        Q(guest__in=Guest.objects.filter(guests).values('pk'))
+    )
+
+
 class AccessLog(models.Model):
-    """Records every entry and exit from the lab"""
+    """
+    Records every entry and exit from the lab. Scans only ever add logs; lab
+    sessions and visit stats are derived from them (see ``projections``).
+    """
     LOG_TYPES = [
         ('entry', 'Entry'),
         ('exit', 'Exit'),
@@ -201,13 +396,27 @@ class AccessLog(models.Model):
 
     user_type = models.CharField(max_length=20, choices=USER_TYPES)
     log_type = models.CharField(max_length=10, choices=LOG_TYPES)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add so that maintenance jobs can back-date synthetic logs
+    timestamp = models.DateTimeField(default=timezone.now, db_index=True)
     recorded_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='recorded_logs')
 
-    # For pairing entry and exit logs
+    lab = models.ForeignKey(Lab, on_delete=models.PROTECT, default=default_lab_id, related_name='access_logs')
+    station = models.ForeignKey(
+        ScannerStation, on_delete=models.SET_NULL, null=True, blank=True, related_name='access_logs'
+    )
+
+    # An entry gets a new session_id; the exit that closes its session copies
+    # it and points paired_log at the entry, so a log is complete when written.
+    # replay_scans repairs any that disagree with the sessions.
     session_id = models.UUIDField(blank=True, null=True)
     paired_log = models.OneToOneField('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='paired_entry')
 
+    class Meta:
+        indexes = [
+            # A lab's recent logs without reading the other labs'
+            models.Index(fields=['lab', 'timestamp'], name='accesslog_lab_time'),
+        ]
+
     def get_user_name(self):
         """Return the name of the person who entered/exited"""
         if self.regular_student:
@@ -233,18 +442,33 @@ class AccessLog(models.Model):
 
 
 class LabSession(models.Model):
-    """Tracks a complete lab session from entry to exit"""
+    """
+    Tracks a complete lab session from entry to exit. Derived from the access
+    log: ``replay_scans`` rebuilds sessions from the logs of any period.
+    """
     regular_student = models.ForeignKey(RegularStudent, on_delete=models.CASCADE, null=True, blank=True)
     temporary_student = models.ForeignKey(TemporaryStudent, on_delete=models.CASCADE, null=True, blank=True)
     guest = models.ForeignKey(Guest, on_delete=models.CASCADE, null=True, blank=True)
 
     user_type = models.CharField(max_length=20, choices=AccessLog.USER_TYPES)
-    entry_time = models.DateTimeField()
-    exit_time = models.DateTimeField(null=True, blank=True)
+    # Indexed for the admin's month filter
+    entry_time = models.DateTimeField(db_index=True)
+    # Indexed so the open sessions (exit_time IS NULL) are found without a table scan
+    exit_time = models.DateTimeField(null=True, blank=True, db_index=True)
     duration = models.DurationField(null=True, blank=True)
 
     entry_log = models.OneToOneField(AccessLog, on_delete=models.CASCADE, related_name='entry_session')
     exit_log = models.OneToOneField(AccessLog, on_delete=models.CASCADE, null=True, blank=True, related_name='exit_session')
+    lab = models.ForeignKey(Lab, on_delete=models.PROTECT, default=default_lab_id, related_name='sessions')
+
+    class Meta:
+        indexes = [
+            # Only open sessions are indexed, so occupancy stays cheap however
+            # many closed sessions pile up
+            models.Index(
+                fields=['lab', 'user_type'], condition=Q(exit_time__isnull=True), name='labsession_open_by_lab'
+            ),
+        ]
 
     def save(self, *args, **kwargs):
         if self.entry_time and self.exit_time:
@@ -263,24 +487,231 @@ class LabSession(models.Model):
         return f"{user_name} - {self.entry_time.strftime('%Y-%m-%d %H:%M')}"
 
 
-# class IDCard(models.Model):
-#     """Stores metadata for generated ID cards"""
-#     regular_student = models.OneToOneField(RegularStudent, on_delete=models.CASCADE, null=True, blank=True)
-#     temporary_student = models.OneToOneField(TemporaryStudent, on_delete=models.CASCADE, null=True, blank=True)
-#     guest = models.OneToOneField(Guest, on_delete=models.CASCADE, null=True, blank=True)
+class VisitStats(models.Model):
+    """Running visit totals for one person, updated as each session closes"""
+    # AccessLog user_type -> the field pointing at that kind of person
+    PERSON_FIELDS = {
+        'regular': 'regular_student',
+        'temporary': 'temporary_student',
+        'guest': 'guest',
+    }
+
+    regular_student = models.OneToOneField(RegularStudent, on_delete=models.CASCADE, null=True, blank=True, related_name='visit_stats')
+    temporary_student = models.OneToOneField(TemporaryStudent, on_delete=models.CASCADE, null=True, blank=True, related_name='visit_stats')
+    guest = models.OneToOneField(Guest, on_delete=models.CASCADE, null=True, blank=True, related_name='visit_stats')
+
+    total_visits = models.PositiveIntegerField(default=0, db_index=True)
+    total_duration = models.DurationField(default=timedelta)
+    last_seen = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        verbose_name_plural = "Visit stats"
+
+    @property
+    def average_duration(self):
+        if not self.total_visits:
+            return None
+        return self.total_duration / self.total_visits
+
+    @classmethod
+    def record_visit(cls, session):
+        """Add a closed session to its person's totals with a single UPDATE."""
+        field = cls.PERSON_FIELDS[session.user_type]
+        person_id = getattr(session, f'{field}_id')
+        duration = session.duration or timedelta()
+        stats = cls.objects.filter(**{field: person_id})
+        changes = {
+            'total_visits': F('total_visits') + 1,
+            'total_duration': F('total_duration') + duration,
+            'last_seen': session.exit_time,
+        }
+
+        with transaction.atomic():
+            if stats.update(**changes):
+                return
+            try:
+                with transaction.atomic():
+                    cls.objects.create(**{field + '_id': person_id}, total_visits=1,
+                                       total_duration=duration, last_seen=session.exit_time)
+            except IntegrityError:
+                # Another request created the row first
+                stats.update(**changes)
+
+    @classmethod
+    def record_visits(cls, sessions):
+        """
+        Add many closed sessions to their people's totals with a fixed number
+        of queries per person type, however many sessions there are.
+        """
+        totals = {}
+        for session in sessions:
+            field = cls.PERSON_FIELDS[session.user_type]
+            key = (field, getattr(session, f'{field}_id'))
+            visits, duration, last_seen = totals.get(key, (0, timedelta(), session.exit_time))
+            totals[key] = (visits + 1, duration + (session.duration or timedelta()), max(last_seen, session.exit_time))
+
+        with transaction.atomic():
+            for field in cls.PERSON_FIELDS.values():
+                person_ids = [person_id for key_field, person_id in totals if key_field == field]
+                if not person_ids:
+                    continue
+
+                cls.objects.bulk_create(
+                    [cls(**{field + '_id': person_id}) for person_id in person_ids],
+                    ignore_conflicts=True,
+                )
+                rows = list(cls.objects.select_for_update().filter(**{f'{field}__in': person_ids}))
+                for stats in rows:
+                    visits, duration, last_seen = totals[(field, getattr(stats, f'{field}_id'))]
+                    stats.total_visits += visits
+                    stats.total_duration += duration
+                    stats.last_seen = max(stats.last_seen, last_seen) if stats.last_seen else last_seen
+                cls.objects.bulk_update(rows, ['total_visits', 'total_duration', 'last_seen'])
+
+    @classmethod
+    def rebuild(cls, people=None):
+        """
+        Recompute totals from closed lab sessions, for everyone or only for
+        ``people``, a mapping of person field to person ids. Returns how many
+        people have stats afterwards.
+        """
+        closed = LabSession.objects.filter(exit_time__isnull=False)
+        stats = []
+        with transaction.atomic():
+            for user_type, field in cls.PERSON_FIELDS.items():
+                totals = closed.filter(user_type=user_type, **{f'{field}__isnull': False})
+                existing = cls.objects.filter(**{f'{field}__isnull': False})
+                if people is not None:
+                    person_ids = list(people.get(field, ()))
+                    if not person_ids:
+                        continue
+                    totals = totals.filter(**{f'{field}__in': person_ids})
+                    existing = existing.filter(**{f'{field}__in': person_ids})
+
+                totals = totals.values(field).annotate(
+                    visits=models.Count('id'), duration=models.Sum('duration'), last_seen=models.Max('exit_time')
+                ).order_by()
+                for row in totals.iterator():
+                    stats.append(cls(**{
+                        f'{field}_id': row[field],
+                        'total_visits': row['visits'],
+                        'total_duration': row['duration'] or timedelta(),
+                        'last_seen': row['last_seen'],
+                    }))
+                existing.delete()
+            cls.objects.bulk_create(stats, batch_size=1000)
+        return len(stats)
+
+    def __str__(self):
+        return f"{self.total_visits} visits"
+
+
+class IDCard(models.Model):
+    """Stores metadata for generated ID cards"""
+    regular_student = models.OneToOneField(RegularStudent, on_delete=models.CASCADE, null=True, blank=True)
+    temporary_student = models.OneToOneField(TemporaryStudent, on_delete=models.CASCADE, null=True, blank=True)
+    guest = models.OneToOneField(Guest, on_delete=models.CASCADE, null=True, blank=True)
+
+    generated_at = models.DateTimeField(auto_now=True)
+    card_image = models.ImageField(upload_to='id_cards/', blank=True, null=True)
+    # Hash of everything drawn on the card; the image is only re-rendered when it changes
+    fingerprint = models.CharField(max_length=64, blank=True)
+    printed = models.BooleanField(default=False)
+
+    def __str__(self):
+        if self.regular_student:
+            return f"ID Card: {self.regular_student.student_id}"
+        elif self.temporary_student:
+            return f"Temp ID Card: {self.temporary_student.student_id}"
+        elif self.guest:
+            return f"Guest Pass: {self.guest.guest_id}"
+        return "Unknown ID Card"
+
+
+class MaintenanceRun(models.Model):
+    """History of scheduled maintenance job runs"""
+    STATUSES = [
+        ('success', 'Success'),
+        ('failed', 'Failed'),
+    ]
+
+    job = models.CharField(max_length=100, db_index=True)
+    started_at = models.DateTimeField()
+    finished_at = models.DateTimeField()
+    duration = models.DurationField()
+    rows_affected = models.IntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUSES)
+    message = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['-started_at']
 
-#     generated_at = models.DateTimeField(auto_now_add=True)
-#     card_image = models.ImageField(upload_to='id_cards/', blank=True, null=True)
-#     printed = models.BooleanField(default=False)
+    def __str__(self):
+        return f"{self.job} - {self.started_at.strftime('%Y-%m-%d %H:%M')} - {self.get_status_display()}"
 
-#     def __str__(self):
-#         if self.regular_student:
-#             return f"ID Card: {self.regular_student.student_id}"
-#         elif self.temporary_student:
-#             return f"Temp ID Card: {self.temporary_student.student_id}"
-#         elif self.guest:
-#             return f"Guest Pass: {self.guest.guest_id}"
-#         return "Unknown ID Card"
+
+class MaintenanceLock(models.Model):
+    """
+    Held by the process running a maintenance job, so schedulers on several
+    machines never run the same job at once. A lock whose holder died is
+    free again after ``locked_until``.
+    """
+    job = models.CharField(max_length=100, primary_key=True)
+    owner = models.CharField(max_length=32, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.job
+
+
+class RosterChange(models.Model):
+    """
+    A person or group whose scanner roster entry may have changed. The id is
+    the roster version: stations ask for the changes after the last one they
+    saw. A blank code means everything may have changed.
+    """
+    code = models.CharField(max_length=50, blank=True)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.pk}: {self.code or 'everything'}"
+
+
+class ProjectionCheckpoint(models.Model):
+    """
+    How far a projection of the access log has been brought up to date:
+    every log up to ``position`` has been applied to it. The position is an
+    AccessLog id, or for ``daily_log_counts`` the ordinal of the last day
+    counted. The ``log_counts_*generation`` rows are not checkpoints: their
+    position changes whenever cached access log counts go out of date.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    position = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} at {self.position}"
+
+
+class DailyLogCount(models.Model):
+    """
+    How many logs of each type a lab recorded on a closed day (see
+    ``log_counts``). Days up to the ``daily_log_counts`` checkpoint without
+    a row had no such logs.
+    """
+    day = models.DateField()
+    lab = models.ForeignKey(Lab, on_delete=models.CASCADE, related_name='daily_log_counts')
+    log_type = models.CharField(max_length=10, choices=AccessLog.LOG_TYPES)
+    user_type = models.CharField(max_length=20, choices=AccessLog.USER_TYPES)
+    count = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'lab', 'log_type', 'user_type'], name='dailylogcount_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.lab_id} {self.log_type} {self.user_type}: {self.count}"
 
 
 class SystemSettings(models.Model):
@@ -291,8 +722,30 @@ class SystemSettings(models.Model):
     require_supervisor_confirmation = models.BooleanField(default=True)
     temporary_access_max_days = models.IntegerField(default=30)
 
+    CACHE_KEY = 'dashboard:system_settings'
+    # Other worker processes with their own cache pick up changes within this time (seconds)
+    CACHE_TIMEOUT = 300
+
     class Meta:
         verbose_name_plural = "System Settings"
 
+    @classmethod
+    def load(cls):
+        """The settings row, from the cache when possible"""
+        system_settings = cache.get(cls.CACHE_KEY)
+        record_cache_lookup('system_settings', system_settings is not None)
+        if system_settings is None:
+            system_settings, _ = cls.objects.get_or_create(id=1)
+            cache.set(cls.CACHE_KEY, system_settings, cls.CACHE_TIMEOUT)
+        return system_settings
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        cache.delete(self.CACHE_KEY)
+
+    def delete(self, *args, **kwargs):
+        cache.delete(self.CACHE_KEY)
+        return super().delete(*args, **kwargs)
+
     def __str__(self):
         return "System Settings"
@@ -0,0 +1,54 @@
+"""
+Pagination for tables too big to count.
+
+``COUNT(*)`` over millions of access logs reads every row just to print how
+many pages there are. For an unfiltered changelist an estimate from the
+database's own bookkeeping is close enough: PostgreSQL keeps one in
+``pg_class.reltuples`` after each ANALYZE, and on SQLite the highest rowid is
+the row count less whatever has been deleted. Filtered lists touch fewer rows
+and are still counted exactly.
+"""
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+# Below this many rows an exact count is cheap and avoids an odd last page
+EXACT_COUNT_BELOW = 100_000
+
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        estimate = self._estimate()
+        if estimate is None or estimate < EXACT_COUNT_BELOW:
+            return super().count
+        return estimate
+
+    def _estimate(self):
+        queryset = self.object_list
+        query = getattr(queryset, 'query', None)
+        if query is None or query.where or query.distinct or query.is_sliced:
+            return None
+
+        connection = connections[queryset.db]
+        table = queryset.model._meta.db_table
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+            elif connection.vendor == 'sqlite':
+                cursor.execute(f'SELECT MAX(rowid) FROM {connection.ops.quote_name(table)}')
+            else:
+                return None
+            row = cursor.fetchone()
+        # reltuples is -1 until the table has been analyzed
+        if row is None or row[0] is None or row[0] < 0:
+            return None
+        return int(row[0])
+
+
+class KnownCountPaginator(Paginator):
+    """Paginates a list whose length was counted elsewhere, e.g. by ``log_counts``."""
+
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count = count
@@ -0,0 +1,138 @@
+"""
+Per-request query profiling for staff.
+
+With QUERY_PROFILER enabled, every request made by a staff user records its
+query count, total database time and how often each query shape ran. A shape
+that runs QUERY_PROFILER_N_PLUS_ONE times or more in one request is flagged
+as a likely N+1. The slowest requests are kept in memory per worker and shown
+by ``query_profile``. When the setting is off the middleware removes itself,
+so it costs nothing.
+"""
+from contextlib import ExitStack
+import heapq
+import itertools
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import JsonResponse
+from django.urls import reverse
+from django.utils import timezone
+
+# Literals and placeholder lists vary between runs of the same query
+_IN_LIST = re.compile(r'\bIN \((?:%s|\?)(?:, (?:%s|\?))*\)', re.IGNORECASE)
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+_slowest = []
+_slowest_lock = threading.Lock()
+_sequence = itertools.count()
+
+
+def fingerprint(sql):
+    """The shape of a query with literal values and IN lists collapsed."""
+    sql = _LITERAL.sub('?', sql)
+    return _IN_LIST.sub('IN (...)', sql)
+
+
+class QueryRecorder:
+    """``execute_wrapper`` that times each query and groups them by shape."""
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = {}
+        self.exact = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.duration += elapsed
+
+            shape = self.shapes.setdefault(fingerprint(sql), [0, 0.0])
+            shape[0] += 1
+            shape[1] += elapsed
+            key = (sql, repr(params))
+            self.exact[key] = self.exact.get(key, 0) + 1
+
+    def summary(self):
+        threshold = settings.QUERY_PROFILER_N_PLUS_ONE
+        repeated = sorted(
+            (
+                {'query': shape, 'count': count, 'time_ms': round(duration * 1000, 2)}
+                for shape, (count, duration) in self.shapes.items() if count >= threshold
+            ),
+            key=lambda item: -item['count'],
+        )
+        return {
+            'queries': self.count,
+            'db_time_ms': round(self.duration * 1000, 2),
+            'duplicates': sum(count - 1 for count in self.exact.values()),
+            'n_plus_one': repeated,
+        }
+
+
+class QueryProfilerMiddleware:
+    """Profile the queries behind each staff request; see the module docstring."""
+    def __init__(self, get_response):
+        if not settings.QUERY_PROFILER:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not request.user.is_staff or request.path == reverse('query_profile'):
+            return self.get_response(request)
+
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        summary = recorder.summary()
+        response['Server-Timing'] = (
+            f'db;dur={summary["db_time_ms"]};desc="{summary["queries"]} queries", '
+            f'total;dur={elapsed * 1000:.2f}'
+        )
+        _remember({
+            'method': request.method,
+            'path': request.get_full_path(),
+            'status': response.status_code,
+            'at': timezone.now().isoformat(),
+            'duration_ms': round(elapsed * 1000, 2),
+            **summary,
+        })
+        return response
+
+
+def _remember(entry):
+    """Keep the QUERY_PROFILER_SLOWEST slowest requests seen by this worker."""
+    item = (entry['duration_ms'], next(_sequence), entry)
+    with _slowest_lock:
+        if len(_slowest) < settings.QUERY_PROFILER_SLOWEST:
+            heapq.heappush(_slowest, item)
+        else:
+            heapq.heappushpop(_slowest, item)
+
+
+def slowest_requests():
+    with _slowest_lock:
+        return [entry for _, _, entry in sorted(_slowest, key=lambda item: -item[0])]
+
+
+def query_profile(request):
+    """Slowest profiled requests in this worker, slowest first. Staff only."""
+    if not request.user.is_staff:
+        return JsonResponse({'status': 'error', 'message': 'Staff only.'}, status=403)
+    return JsonResponse({
+        'status': 'success',
+        'enabled': settings.QUERY_PROFILER,
+        'data': slowest_requests(),
+    })
@@ -0,0 +1,376 @@
+"""
+Lab sessions as a projection of the access log.
+
+The access log is the record of what happened: scans only ever add to it.
+Lab sessions, their durations, each lab's occupancy and the visit stats are
+derived from it, always by the same rules:
+
+- an entry opens a session in its lab and gets a new session_id;
+- the person's next exit in that lab closes the session, copies its
+  session_id and points paired_log at the entry;
+- an entry while a session is still open closes that one at the time of the
+  entry, with no exit log, since the person evidently left without scanning
+  out;
+- an exit with no open session in its lab closes nothing and stays unpaired.
+
+The scanner applies these rules as it logs each scan, through
+``open_session``, ``exit_log_for`` and ``close_session``. ``replay`` applies
+them to the logs of any period in one pass in time order, and writes only the
+sessions and log pairings that come out different. To fix a bad toggle, fix
+or delete the log and replay from its time. ``catch_up`` replays the logs
+added since the checkpoint, starting from the earliest time among them. That
+is usually a few minutes ago, so it is cheap to run often.
+"""
+import uuid
+
+from django.db import connection, transaction
+from django.db.models import Max, Min, Q
+
+from .models import AccessLog, LabSession, ProjectionCheckpoint, VisitStats
+
+CHECKPOINT = 'lab_sessions'
+
+# Sessions written per transaction
+BATCH_SIZE = 2000
+# Logs read per query
+PAGE_SIZE = 10000
+
+LOG_FIELDS = (
+    'id', 'regular_student_id', 'temporary_student_id', 'guest_id', 'user_type', 'log_type', 'timestamp',
+    'lab_id', 'session_id', 'paired_log_id',
+)
+# Person columns, in the order of the person tuples used as keys below
+PERSON_FIELDS = ('regular_student', 'temporary_student', 'guest')
+SESSION_FIELDS = (
+    'regular_student_id', 'temporary_student_id', 'guest_id', 'user_type', 'lab_id', 'entry_time', 'exit_time',
+    'duration', 'exit_log_id',
+)
+
+
+def open_session(entry_log):
+    """The lab session an entry log opens"""
+    return LabSession(
+        regular_student_id=entry_log.regular_student_id,
+        temporary_student_id=entry_log.temporary_student_id,
+        guest_id=entry_log.guest_id,
+        user_type=entry_log.user_type,
+        entry_time=entry_log.timestamp,
+        entry_log=entry_log,
+        lab_id=entry_log.lab_id,
+    )
+
+
+def exit_log_for(session, timestamp, **fields):
+    """An exit log that closes ``session``, paired with its entry log"""
+    return AccessLog(
+        regular_student_id=session.regular_student_id,
+        temporary_student_id=session.temporary_student_id,
+        guest_id=session.guest_id,
+        user_type=session.user_type,
+        log_type='exit',
+        timestamp=timestamp,
+        lab_id=session.lab_id,
+        session_id=session.entry_log.session_id,
+        paired_log_id=session.entry_log_id,
+        **fields
+    )
+
+
+def close_session(session, exit_log):
+    session.exit_time = exit_log.timestamp
+    session.exit_log = exit_log
+    session.duration = session.exit_time - session.entry_time
+    return session
+
+
+def latest_log_id():
+    return AccessLog.objects.aggregate(last=Max('id'))['last'] or 0
+
+
+def replay(since=None, until=None, last_log_id=None):
+    """
+    Rebuild the sessions that start between ``since`` and ``until`` from the
+    logs, repair the pairing of those logs, and recompute the visit stats of
+    everyone whose sessions changed. Sessions still open at ``until`` are
+    closed by the logs that follow it. Logs after ``last_log_id`` are left to
+    the next catch-up. Replaying everything also moves the checkpoint.
+
+    Returns counts of what was read and written.
+    """
+    if last_log_id is None:
+        last_log_id = latest_log_id()
+    counts = _Replay(last_log_id).run(since, until)
+    if since is None and until is None:
+        advance_checkpoint(last_log_id)
+    return counts
+
+
+def catch_up():
+    """Replay the logs added since the checkpoint and move it past them."""
+    checkpoint, _ = ProjectionCheckpoint.objects.get_or_create(name=CHECKPOINT)
+    last_log_id = latest_log_id()
+    new_logs = AccessLog.objects.filter(id__gt=checkpoint.position, id__lte=last_log_id)
+    since = new_logs.aggregate(since=Min('timestamp'))['since']
+    if since is None:
+        return _Replay.empty_counts()
+
+    counts = replay(since=since, last_log_id=last_log_id)
+    advance_checkpoint(last_log_id)
+    return counts
+
+
+def advance_checkpoint(position):
+    """
+    Note that every log up to ``position`` is reflected in the sessions, for
+    code that writes logs and sessions together in bulk.
+    """
+    checkpoint, _ = ProjectionCheckpoint.objects.get_or_create(name=CHECKPOINT)
+    if position > checkpoint.position:
+        checkpoint.position = position
+        checkpoint.save(update_fields=['position', 'updated_at'])
+
+
+class _Session:
+    """A session as the replay builds it, lighter than a model instance"""
+    __slots__ = ('entry_log_id', 'person', 'user_type', 'lab_id', 'entry_time', 'session_id', 'exit_time',
+                 'exit_log_id')
+
+    def __init__(self, entry_log_id, person, user_type, lab_id, entry_time, session_id):
+        self.entry_log_id = entry_log_id
+        self.person = person
+        self.user_type = user_type
+        self.lab_id = lab_id
+        self.entry_time = entry_time
+        self.session_id = session_id
+        self.exit_time = None
+        self.exit_log_id = None
+
+    def values(self):
+        """The session's SESSION_FIELDS, in that order"""
+        return (
+            *self.person, self.user_type, self.lab_id, self.entry_time, self.exit_time,
+            self.exit_time - self.entry_time if self.exit_time else None, self.exit_log_id,
+        )
+
+
+class _Replay:
+    def __init__(self, last_log_id):
+        self.last_log_id = last_log_id
+        # Person tuple -> their open session, as of the log being applied
+        self.open = {}
+        self.finished = []
+        # Log id -> (session_id, paired_log_id) it should have
+        self.pairings = {}
+        # Exit logs read since the last flush, which must not have opened a session
+        self.exits = []
+        # Person field -> ids of people whose sessions changed
+        self.people = {field: set() for field in PERSON_FIELDS}
+        self.counts = self.empty_counts()
+
+    @staticmethod
+    def empty_counts():
+        return dict.fromkeys(('logs', 'created', 'updated', 'deleted', 'repaired', 'unpaired'), 0)
+
+    def run(self, since, until):
+        period = Q()
+        if since is not None:
+            period &= Q(timestamp__gte=since)
+        if until is not None:
+            period &= Q(timestamp__lt=until)
+
+        if since is not None:
+            self._carry_open(since)
+
+        logs = AccessLog.objects.filter(period, id__lte=self.last_log_id)
+        for row in self._stream(logs):
+            self._apply(*row)
+        if until is not None and self.open:
+            self._close_after(until)
+
+        self.finished.extend(self.open.values())
+        self.open = {}
+        self._flush()
+
+        if since is None and until is None:
+            VisitStats.rebuild()
+        elif any(self.people.values()):
+            VisitStats.rebuild(self.people)
+        return self.counts
+
+    def _stream(self, logs):
+        """
+        The logs in time order, a page at a time. Each page is a query of its
+        own, so no read stays open while sessions are written; on SQLite an
+        open read keeps the write-ahead log from being checkpointed, and it
+        would grow by the size of every write the replay makes.
+        """
+        logs = logs.order_by('timestamp', 'id').values_list(*LOG_FIELDS)
+        page = logs
+        while True:
+            rows = list(page[:PAGE_SIZE])
+            for row in rows:
+                yield row
+                if len(self.finished) >= BATCH_SIZE or len(self.exits) >= BATCH_SIZE:
+                    self._flush()
+            if len(rows) < PAGE_SIZE:
+                return
+            # Carry on after the last log read: a later time, or the same time and a higher id
+            last_id, last_time = rows[-1][0], rows[-1][6]
+            page = logs.filter(timestamp__gte=last_time).exclude(timestamp=last_time, id__lte=last_id)
+
+    def _carry_open(self, since):
+        """Start from the sessions that were open at ``since``"""
+        # Filtering on the entry time in the database would have it walk every
+        # log before ``since``; the sessions open at or closed after it are few
+        candidates = LabSession.objects.filter(Q(exit_time__isnull=True) | Q(exit_time__gte=since)).values_list(
+            'entry_log_id', 'regular_student_id', 'temporary_student_id', 'guest_id', 'user_type', 'lab_id',
+            'entry_log__timestamp', 'entry_log__session_id',
+        )
+        carried = sorted(
+            (row for row in candidates.iterator(chunk_size=BATCH_SIZE) if row[6] < since),
+            key=lambda row: (row[6], row[0]),
+        )
+        for entry_log_id, *person, user_type, lab_id, entry_time, session_id in carried:
+            self._open(_Session(entry_log_id, tuple(person), user_type, lab_id, entry_time, session_id))
+
+    def _apply(self, log_id, regular_id, temporary_id, guest_id, user_type, log_type, timestamp, lab_id,
+               session_id, paired_log_id):
+        self.counts['logs'] += 1
+        person = (regular_id, temporary_id, guest_id)
+        if log_type == 'entry':
+            session = _Session(log_id, person, user_type, lab_id, timestamp, session_id or uuid.uuid4())
+            self._open(session)
+            self._pair(log_id, (session_id, paired_log_id), (session.session_id, None))
+            return
+
+        self.exits.append(log_id)
+        session = self.open.get(person)
+        if session is not None and session.lab_id == lab_id:
+            self._close(session, timestamp, log_id)
+            self._pair(log_id, (session_id, paired_log_id), (session.session_id, session.entry_log_id))
+        else:
+            self.counts['unpaired'] += 1
+            self._pair(log_id, (session_id, paired_log_id), (None, None))
+
+    def _close_after(self, until):
+        """Close the sessions still open at ``until`` with the logs that follow"""
+        people = Q()
+        for index, field in enumerate(PERSON_FIELDS):
+            person_ids = [person[index] for person in self.open if person[index] is not None]
+            if person_ids:
+                people |= Q(**{f'{field}_id__in': person_ids})
+
+        logs = AccessLog.objects.filter(people, timestamp__gte=until, id__lte=self.last_log_id)
+        for log_id, *person, user_type, log_type, timestamp, lab_id, session_id, paired_log_id in self._stream(logs):
+            session = self.open.get(tuple(person))
+            if session is None:
+                continue
+            if log_type == 'entry':
+                self._close(session, timestamp, None)
+            elif session.lab_id == lab_id:
+                self._close(session, timestamp, log_id)
+                self._pair(log_id, (session_id, paired_log_id), (session.session_id, session.entry_log_id))
+            if not self.open:
+                break
+
+    def _open(self, session):
+        previous = self.open.get(session.person)
+        if previous is not None:
+            self._close(previous, session.entry_time, None)
+        self.open[session.person] = session
+
+    def _close(self, session, exit_time, exit_log_id):
+        session.exit_time = exit_time
+        session.exit_log_id = exit_log_id
+        del self.open[session.person]
+        self.finished.append(session)
+
+    def _pair(self, log_id, current, expected):
+        if current != expected:
+            self.pairings[log_id] = expected
+
+    def _changed(self, person):
+        for field, person_id in zip(PERSON_FIELDS, person):
+            if person_id is not None:
+                self.people[field].add(person_id)
+
+    def _flush(self):
+        sessions = {session.entry_log_id: session for session in self.finished}
+        pairings, exits = self.pairings, self.exits
+        self.finished, self.pairings, self.exits = [], {}, []
+
+        with transaction.atomic():
+            # Sessions opened by a log that has since been changed to an exit
+            invalid = list(LabSession.objects.filter(entry_log_id__in=exits).values_list(
+                'id', 'regular_student_id', 'temporary_student_id', 'guest_id'
+            ))
+            if invalid:
+                for _, *person in invalid:
+                    self._changed(person)
+                LabSession.objects.filter(id__in=[row[0] for row in invalid]).delete()
+                self.counts['deleted'] += len(invalid)
+
+            # Compared as plain rows; building a model for every unchanged
+            # session would cost more than the rest of the replay
+            existing = LabSession.objects.select_for_update().filter(entry_log_id__in=list(sessions)).values_list(
+                'entry_log_id', 'id', *SESSION_FIELDS
+            )
+            existing = {entry_log_id: row for entry_log_id, *row in existing}
+            created, updated = [], []
+            for entry_log_id, session in sessions.items():
+                values = session.values()
+                row = existing.get(entry_log_id)
+                if row is None:
+                    created.append(LabSession(entry_log_id=entry_log_id, **dict(zip(SESSION_FIELDS, values))))
+                    self._changed(session.person)
+                    continue
+                pk, *current = row
+                exit_log_id = current[-1]
+                if exit_log_id is not None and exit_log_id > self.last_log_id:
+                    # Closed by a scan since the replay started, which knows better
+                    continue
+                if tuple(current) != values:
+                    updated.append((pk, *values))
+                    self._changed(current[:3])
+                    self._changed(session.person)
+
+            # An exit log or entry may only belong to one session or exit, so
+            # let go of any that are about to move before assigning them
+            exit_log_ids = [session.exit_log_id for session in created if session.exit_log_id is not None]
+            exit_log_ids += [row[-1] for row in updated if row[-1] is not None]
+            if exit_log_ids:
+                LabSession.objects.filter(exit_log_id__in=exit_log_ids).update(exit_log=None)
+            paired_log_ids = [paired_log_id for _, paired_log_id in pairings.values() if paired_log_id is not None]
+            if paired_log_ids:
+                AccessLog.objects.filter(paired_log_id__in=paired_log_ids).update(paired_log=None)
+
+            LabSession.objects.bulk_create(created)
+            _update_rows(LabSession, SESSION_FIELDS, updated)
+            _update_rows(AccessLog, ('session_id', 'paired_log_id'), [
+                (log_id, session_id, paired_log_id) for log_id, (session_id, paired_log_id) in pairings.items()
+            ])
+
+        self.counts['created'] += len(created)
+        self.counts['updated'] += len(updated)
+        self.counts['repaired'] += len(pairings)
+
+
+def _update_rows(model, fields, rows):
+    """
+    Set ``fields`` of each (pk, *values) row. One statement run for every row
+    is much faster than bulk_update's CASE expressions on large batches.
+    """
+    if not rows:
+        return
+    fields = [model._meta.get_field(name) for name in fields]
+    quote = connection.ops.quote_name
+    sql = 'UPDATE {} SET {} WHERE {} = %s'.format(
+        quote(model._meta.db_table),
+        ', '.join(f'{quote(field.column)} = %s' for field in fields),
+        quote(model._meta.pk.column),
+    )
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [
+            [field.get_db_prep_value(value, connection) for field, value in zip(fields, values)] + [pk]
+            for pk, *values in rows
+        ])
@@ -0,0 +1,139 @@
+"""
+Helpers for rendering QR code images.
+
+QR codes are rendered on demand rather than when a person is created. Rendered
+images are kept in a bounded in-memory LRU cache and written through to a disk
+cache, so each payload/format/size combination is only drawn once per server.
+Reading a file from the disk cache marks it as used, and ``prune_disk_cache``
+removes files that haven't been used for a while. ``regenerate_qr_codes``
+fills the disk cache ahead of time with ``write_qr_image``. qrcode, and Pillow
+behind it, is imported on the first render, so workers that never draw a code
+don't load them.
+"""
+from functools import lru_cache
+from io import BytesIO
+import hashlib
+import os
+import tempfile
+import time
+
+from django.conf import settings
+
+FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+DEFAULT_BOX_SIZE = 10
+MAX_BOX_SIZE = 40
+
+ERROR_CORRECTION_LEVELS = ('L', 'M', 'Q', 'H')
+
+
+def render_qr_png(data, box_size=DEFAULT_BOX_SIZE, error_correction=None):
+    """Render ``data`` as a QR code and return the PNG bytes."""
+    qr_io = BytesIO()
+    _make(data, box_size, error_correction).save(qr_io, format="PNG")
+    return qr_io.getvalue()
+
+
+def render_qr_svg(data, box_size=DEFAULT_BOX_SIZE, error_correction=None):
+    """Render ``data`` as a compact single-path SVG QR code."""
+    import qrcode.image.svg
+
+    qr_io = BytesIO()
+    _make(data, box_size, error_correction, image_factory=qrcode.image.svg.SvgPathImage).save(qr_io)
+    return qr_io.getvalue()
+
+
+def write_qr_image(path, data, fmt='png', box_size=DEFAULT_BOX_SIZE, error_correction=None):
+    """
+    Render ``data`` and atomically write the image to ``path``. Module-level
+    so it can run in a worker process.
+    """
+    render = render_qr_svg if fmt == 'svg' else render_qr_png
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomic(path, render(data, box_size, error_correction))
+    return path
+
+
+def write_atomic(path, content):
+    """
+    Write to a temporary file first so readers never see a partial file. The
+    temporary name is unique, so threads writing the same path don't collide.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        # mkstemp creates the file readable by its owner only
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def qr_cache_key(payload, fmt='png', box_size=DEFAULT_BOX_SIZE, error_correction=None):
+    """
+    Stable key for a rendered QR image. It doubles as the HTTP ETag, so it can
+    be checked without rendering anything.
+    """
+    level = error_correction or settings.QR_ERROR_CORRECTION
+    return hashlib.sha256(f'{fmt}:{box_size}:{level}:{payload}'.encode()).hexdigest()[:32]
+
+
+def disk_cache_path(payload, fmt='png', box_size=DEFAULT_BOX_SIZE, error_correction=None):
+    """Where the disk cache keeps this image."""
+    key = qr_cache_key(payload, fmt, box_size, error_correction)
+    return os.path.join(settings.QR_CACHE_DIR, key[:2], f'{key}.{fmt}')
+
+
+@lru_cache(maxsize=getattr(settings, 'QR_MEMORY_CACHE_SIZE', 512))
+def get_qr_image(payload, fmt='png', box_size=DEFAULT_BOX_SIZE):
+    """
+    Return the rendered QR image bytes, reading from and filling the disk
+    cache on a memory cache miss.
+    """
+    path = disk_cache_path(payload, fmt, box_size)
+    try:
+        with open(path, 'rb') as cached:
+            image = cached.read()
+        os.utime(path)
+        return image
+    except FileNotFoundError:
+        pass
+
+    render = render_qr_svg if fmt == 'svg' else render_qr_png
+    image = render(payload, box_size)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomic(path, image)
+    return image
+
+
+def _make(data, box_size, error_correction, **kwargs):
+    import qrcode
+
+    level = getattr(qrcode.constants, f'ERROR_CORRECT_{error_correction or settings.QR_ERROR_CORRECTION}')
+    return qrcode.make(data, box_size=box_size, error_correction=level, **kwargs)
+
+
+def prune_disk_cache(max_age):
+    """Delete cached images not used in the last ``max_age`` seconds. Returns how many were deleted."""
+    cutoff = time.time() - max_age
+    deleted = 0
+    for directory, _, filenames in os.walk(settings.QR_CACHE_DIR):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    deleted += 1
+            except FileNotFoundError:
+                # Pruned or replaced by another process meanwhile
+                pass
+    return deleted
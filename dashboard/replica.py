@@ -0,0 +1,177 @@
+"""
+Read-only analytics replica.
+
+Reports, exports and log changelists read from the ``replica`` database alias
+inside ``use_replica()``, so long queries don't compete with door scans. The
+replica is either a SQLite snapshot of the primary, refreshed by a maintenance
+job with the online backup API, or a PostgreSQL hot standby. Whenever the
+replica is missing or lags more than REPLICA_MAX_LAG seconds, reads fall back
+to the primary. A view that fails to read the replica, e.g. a snapshot taken
+before the latest migrations, is run again against the primary. Writes always
+go to the primary.
+"""
+from contextvars import ContextVar
+from datetime import timedelta
+from functools import wraps
+import logging
+import os
+import sqlite3
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, OperationalError, connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+REPLICA_ALIAS = 'replica'
+
+# How long a PostgreSQL standby's replay lag is trusted before asking again
+STANDBY_LAG_CHECK_INTERVAL = 10
+
+# Alias that reads in the current context are routed to, if not the primary
+_read_alias = ContextVar('replica_read_alias', default=None)
+
+_standby_lag = (0.0, None)
+
+
+class use_replica:
+    """
+    Route reads inside the block, or the decorated view, to the replica if it
+    is fresh enough. The choice is made once so a page never mixes sources.
+
+    A decorated view that hits an OperationalError on the replica (a missing
+    table or column, or a snapshot swapped out mid-read) runs again with every
+    read on the primary. A ``with`` block can't be run again, so it doesn't.
+    """
+    def __enter__(self):
+        self._token = _read_alias.set(REPLICA_ALIAS if replica_is_fresh() else None)
+        return _read_alias.get()
+
+    def __exit__(self, *exc_info):
+        _read_alias.reset(self._token)
+
+    def __call__(self, view):
+        @wraps(view)
+        def inner(*args, **kwargs):
+            with use_replica() as alias:
+                try:
+                    return view(*args, **kwargs)
+                except OperationalError:
+                    if alias is None:
+                        raise
+                    logger.warning("Replica read failed; reading from the primary instead", exc_info=True)
+            return view(*args, **kwargs)
+        return inner
+
+
+def read_alias():
+    """The alias reads in the current context go to."""
+    return _read_alias.get() or DEFAULT_DB_ALIAS
+
+
+def replica_lag():
+    """Seconds the replica is behind the primary, or None if it can't be used."""
+    if REPLICA_ALIAS not in settings.DATABASES:
+        return None
+
+    if connections[REPLICA_ALIAS].vendor == 'sqlite':
+        try:
+            refreshed_at = os.path.getmtime(settings.REPLICA_SQLITE_PATH)
+        except OSError:
+            return None
+        return max(time.time() - refreshed_at, 0.0)
+
+    return _postgres_standby_lag()
+
+
+def replica_is_fresh():
+    lag = replica_lag()
+    return lag is not None and lag <= settings.REPLICA_MAX_LAG
+
+
+def replica_status():
+    """Freshness of the data the current context reads, for display."""
+    lag = replica_lag() if _read_alias.get() else None
+    return {
+        'in_use': lag is not None,
+        'lag': lag,
+        'as_of': timezone.now() - timedelta(seconds=lag) if lag is not None else None,
+    }
+
+
+def refresh_sqlite_replica():
+    """
+    Copy the primary SQLite database to the replica file with the online
+    backup API, then swap it into place. In WAL mode the copy reads a single
+    snapshot without blocking scanners that are writing meanwhile.
+    """
+    path = settings.REPLICA_SQLITE_PATH
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+
+    source = sqlite3.connect(settings.DATABASES[DEFAULT_DB_ALIAS]['NAME'])
+    target = sqlite3.connect(tmp_path)
+    try:
+        source.backup(target)
+        target.execute('PRAGMA journal_mode=DELETE')
+    except BaseException:
+        target.close()
+        os.remove(tmp_path)
+        raise
+    finally:
+        source.close()
+    target.close()
+
+    os.replace(tmp_path, path)
+    # Connections opened before the swap still see the old file
+    connections[REPLICA_ALIAS].close()
+    return os.path.getsize(path)
+
+
+def uses_sqlite_snapshot():
+    """Whether the replica is a snapshot file this process has to refresh."""
+    if REPLICA_ALIAS not in settings.DATABASES:
+        return False
+    return connections[REPLICA_ALIAS].vendor == connections[DEFAULT_DB_ALIAS].vendor == 'sqlite'
+
+
+def _postgres_standby_lag():
+    global _standby_lag
+    checked_at, lag = _standby_lag
+    if time.monotonic() - checked_at < STANDBY_LAG_CHECK_INTERVAL:
+        return lag
+
+    try:
+        with connections[REPLICA_ALIAS].cursor() as cursor:
+            cursor.execute(
+                "SELECT CASE WHEN NOT pg_is_in_recovery() "
+                "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+            )
+            lag = float(cursor.fetchone()[0] or 0)
+    except DatabaseError:
+        lag = None
+
+    _standby_lag = (time.monotonic(), lag)
+    return lag
+
+
+class AnalyticsReplicaRouter:
+    """
+    Sends reads made inside ``use_replica()`` to the replica; everything
+    else, including every write, uses the primary.
+    """
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica's schema comes from the primary
+        if db == REPLICA_ALIAS:
+            return False
+        return None
@@ -0,0 +1,250 @@
+"""
+Bulk import of student rosters from CSV or Excel (.xlsx) files.
+"""
+import csv
+import io
+import os
+from datetime import date, datetime
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import RegularStudent, TemporaryStudent
+from .roster_sync import record_changes
+
+
+class RosterImportError(Exception):
+    """Raised when a roster file cannot be read at all."""
+
+
+class RosterImporter:
+    """
+    Validates every row of a roster up front, then creates all the students
+    with a single batch of inserts. QR codes are rendered on demand later.
+    """
+    MODELS = {
+        'regular': RegularStudent,
+        'temporary': TemporaryStudent,
+    }
+
+    REQUIRED_COLUMNS = {
+        'regular': ('first_name', 'last_name', 'class_status', 'boarding_status', 'year_joined'),
+        'temporary': ('first_name', 'last_name', 'class_status', 'boarding_status', 'year_joined',
+                      'reason', 'valid_until'),
+    }
+
+    BATCH_SIZE = 500
+
+    def __init__(self, created_by, student_type='regular'):
+        if student_type not in self.MODELS:
+            raise ValueError(f"Unknown student type: {student_type}")
+        self.created_by = created_by
+        self.student_type = student_type
+        self.model = self.MODELS[student_type]
+
+    def import_file(self, roster_file, filename=None, dry_run=False):
+        """
+        Import a roster file. Nothing is saved unless every row is valid.
+        """
+        rows = self.read_rows(roster_file, filename)
+        students, errors = self.build_students(rows)
+
+        if errors:
+            return {
+                'status': 'error',
+                'message': f'{len(errors)} of {len(rows)} rows have errors. No students were imported.',
+                'created': [],
+                'errors': errors,
+            }
+
+        if not dry_run:
+            students = self.save_students(students)
+
+        return {
+            'status': 'success',
+            'message': f'{len(students)} students {"validated" if dry_run else "imported"} successfully.',
+            'created': students,
+            'errors': [],
+        }
+
+    def read_rows(self, roster_file, filename=None):
+        """
+        Read the roster into a list of ``(row_number, values)`` pairs, where
+        ``values`` maps normalised column names to cell values.
+        """
+        filename = filename or getattr(roster_file, 'name', '')
+        extension = os.path.splitext(filename)[1].lower()
+
+        if extension == '.xlsx':
+            header, records = self._read_xlsx(roster_file)
+        elif extension in ('.csv', '.txt', ''):
+            header, records = self._read_csv(roster_file)
+        else:
+            raise RosterImportError('Unsupported file type. Upload a .csv or .xlsx file.')
+
+        columns = [self._normalise_column(name) for name in header]
+        missing = [name for name in self.REQUIRED_COLUMNS[self.student_type] if name not in columns]
+        if missing:
+            raise RosterImportError(f'Missing required columns: {", ".join(missing)}')
+
+        rows = []
+        # Row 1 is the header, so data starts on row 2 as in a spreadsheet
+        for row_number, record in enumerate(records, start=2):
+            if not any(str(value).strip() for value in record if value is not None):
+                continue
+            rows.append((row_number, dict(zip(columns, record))))
+        return rows
+
+    def build_students(self, rows):
+        """
+        Build unsaved student objects from parsed rows, collecting every
+        validation error instead of stopping at the first.
+        """
+        students = []
+        errors = []
+        for row_number, values in rows:
+            row_errors = []
+            student = self._build_student(values, row_errors)
+            if row_errors:
+                errors.append({'row': row_number, 'messages': row_errors})
+            else:
+                students.append(student)
+        return students, errors
+
+    def save_students(self, students):
+        """
+        Allocate IDs for the whole batch and insert it.
+        """
+        with transaction.atomic():
+            self.model.allocate_student_ids(students)
+            created = self.model.objects.bulk_create(students, batch_size=self.BATCH_SIZE)
+            # bulk_create sends no post_save signals
+            record_changes(student.student_id for student in created)
+            return created
+
+    def _build_student(self, values, errors):
+        """
+        Validate a single row and return an unsaved student object.
+        """
+        cleaned = {}
+        for name in self.REQUIRED_COLUMNS[self.student_type]:
+            value = values.get(name)
+            if value is None or str(value).strip() == '':
+                errors.append(f'{name.replace("_", " ").capitalize()} is required.')
+            else:
+                cleaned[name] = value.strip() if isinstance(value, str) else value
+
+        if errors:
+            return None
+
+        year_joined = self._parse_year(cleaned['year_joined'], errors)
+        boarding_status = self._parse_boarding_status(cleaned['boarding_status'], errors)
+
+        fields = {
+            'first_name': str(cleaned['first_name']),
+            'last_name': str(cleaned['last_name']),
+            'class_status': str(cleaned['class_status']),
+            'boarding_status': boarding_status,
+            'year_joined': year_joined,
+            'year_completed': year_joined + 3 if year_joined else None,
+            'created_by': self.created_by,
+        }
+
+        for name, max_length in (('first_name', 60), ('last_name', 60), ('class_status', 50)):
+            if len(fields[name]) > max_length:
+                errors.append(f'{name.replace("_", " ").capitalize()} must be at most {max_length} characters.')
+
+        if self.student_type == 'regular':
+            fields['additional_notes'] = str(values.get('additional_notes') or '').strip()
+        else:
+            valid_until = self._parse_date(cleaned['valid_until'], 'Valid until', errors)
+            valid_from = timezone.now()
+            if values.get('valid_from') not in (None, ''):
+                valid_from = self._parse_date(values['valid_from'], 'Valid from', errors)
+
+            if valid_from and valid_until and valid_until < valid_from:
+                errors.append('Valid until must be after valid from.')
+
+            fields.update({
+                'reason': str(cleaned['reason'])[:255],
+                'valid_from': valid_from,
+                'valid_until': valid_until,
+                # TemporaryStudent.save() would do this, but bulk_create skips it
+                'is_active': bool(valid_until and valid_until >= timezone.now()),
+            })
+
+        if errors:
+            return None
+        return self.model(**fields)
+
+    def _parse_year(self, value, errors):
+        try:
+            year = int(float(value))
+        except (TypeError, ValueError):
+            errors.append(f'Year joined "{value}" is not a valid year.')
+            return None
+
+        if not 2000 <= year <= timezone.now().year + 1:
+            errors.append(f'Year joined {year} is out of range.')
+            return None
+        return year
+
+    def _parse_boarding_status(self, value, errors):
+        choices = {key.lower(): key for key, _ in self.model.BOARDING_CHOICES}
+        status = choices.get(str(value).strip().lower())
+        if not status:
+            errors.append(f'Boarding status must be one of: {", ".join(choices.values())}.')
+        return status
+
+    def _parse_date(self, value, label, errors):
+        if isinstance(value, datetime):
+            parsed = value
+        elif isinstance(value, date):
+            parsed = datetime.combine(value, datetime.min.time())
+        else:
+            try:
+                parsed = datetime.strptime(str(value).strip(), '%Y-%m-%d')
+            except ValueError:
+                errors.append(f'{label} "{value}" must be a date in YYYY-MM-DD format.')
+                return None
+
+        if timezone.is_naive(parsed):
+            parsed = parsed.replace(tzinfo=timezone.get_current_timezone())
+        return parsed
+
+    @staticmethod
+    def _normalise_column(name):
+        return str(name or '').strip().lower().replace(' ', '_')
+
+    @staticmethod
+    def _read_csv(roster_file):
+        content = roster_file.read()
+        if isinstance(content, bytes):
+            try:
+                content = content.decode('utf-8-sig')
+            except UnicodeDecodeError:
+                raise RosterImportError('CSV files must be UTF-8 encoded.')
+
+        reader = csv.reader(io.StringIO(content))
+        header = next(reader, None)
+        if not header:
+            raise RosterImportError('The file is empty.')
+        return header, list(reader)
+
+    @staticmethod
+    def _read_xlsx(roster_file):
+        try:
+            import openpyxl
+        except ImportError:
+            raise RosterImportError('Reading .xlsx files requires the openpyxl package.')
+
+        try:
+            workbook = openpyxl.load_workbook(roster_file, read_only=True, data_only=True)
+        except Exception as e:
+            raise RosterImportError(f'Could not read the spreadsheet: {e}')
+
+        records = workbook.active.iter_rows(values_only=True)
+        header = next(records, None)
+        if not header:
+            raise RosterImportError('The file is empty.')
+        return header, [list(record) for record in records]
@@ -0,0 +1,136 @@
+"""
+Roster snapshots and deltas for scanner stations.
+
+A station keeps a copy of every code it may scan, with the person's type,
+name and validity window, so it can show whether a code is good before the
+server answers, or while the server can't be reached. It downloads the whole
+roster once and afterwards only the entries that changed since the version it
+holds. Saving or deleting a person records a RosterChange, and so do the bulk
+paths that skip signals; the newest change's id is the roster version.
+
+Guests registered more than ROSTER_GUEST_DAYS ago are left out of snapshots,
+so a code a station doesn't know is not necessarily invalid. Stations still
+send every scan to ``process_scan``, which has the final say.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from .models import Guest, GuestGroup, RegularStudent, RosterChange, TemporaryStudent
+
+FIELDS = ('code', 'type', 'name', 'valid_from', 'valid_until')
+
+# Model -> (roster type, field holding the scanned code)
+CODE_FIELDS = {
+    RegularStudent: ('regular', 'student_id'),
+    TemporaryStudent: ('temporary', 'student_id'),
+    Guest: ('guest', 'guest_id'),
+    GuestGroup: ('group', 'group_id'),
+}
+
+
+def current_version():
+    return RosterChange.objects.aggregate(version=Max('id'))['version'] or 0
+
+
+def record_changes(codes):
+    """
+    Note that the roster entries for ``codes`` may have changed, once the
+    current transaction commits. Recording after the commit keeps versions
+    in commit order, so a station never skips a change that committed late.
+    """
+    codes = [code for code in codes if code]
+    if codes:
+        transaction.on_commit(lambda: RosterChange.objects.bulk_create([RosterChange(code=code) for code in codes]))
+
+
+def record_reset():
+    """Make every station download the whole roster again."""
+    transaction.on_commit(lambda: RosterChange.objects.create(code=''))
+
+
+def snapshot():
+    """The whole roster, as of the current version."""
+    version = current_version()
+    # Validity windows depend on the date as well as the version
+    key = f'dashboard:roster_snapshot:{version}:{timezone.localdate()}'
+    return cache.get_or_set(key, lambda: _snapshot(version), settings.ROSTER_CACHE_TIMEOUT)
+
+
+def delta(since):
+    """
+    The entries added, changed or removed after version ``since``, or the
+    whole roster when those changes are no longer all on record.
+    """
+    version = current_version()
+    if since == version:
+        return {'version': version, 'full': False, 'since': since, 'fields': FIELDS, 'upsert': [], 'remove': []}
+
+    oldest = RosterChange.objects.aggregate(oldest=Min('id'))['oldest']
+    if since > version or oldest is None or since < oldest - 1:
+        # A newer version than exists means the database was restored
+        return snapshot()
+
+    codes = set(RosterChange.objects.filter(id__gt=since, id__lte=version).values_list('code', flat=True))
+    if '' in codes or len(codes) > settings.ROSTER_DELTA_MAX:
+        return snapshot()
+
+    entries = _entries(codes)
+    return {
+        'version': version,
+        'full': False,
+        'since': since,
+        'fields': FIELDS,
+        'upsert': entries,
+        'remove': sorted(codes - {entry[0] for entry in entries}),
+    }
+
+
+def _snapshot(version):
+    return {'version': version, 'full': True, 'fields': FIELDS, 'entries': _entries()}
+
+
+def _entries(codes=None):
+    """
+    Roster rows for everyone who can scan in now or later, limited to
+    ``codes`` when given.
+    """
+    now = timezone.now()
+    people = {
+        RegularStudent: RegularStudent.objects.filter(is_active=True),
+        TemporaryStudent: TemporaryStudent.objects.filter(is_active=True, valid_until__gte=now),
+        Guest: Guest.objects.all(),
+        GuestGroup: GuestGroup.objects.all(),
+    }
+    if codes is None:
+        recent = now - timedelta(days=settings.ROSTER_GUEST_DAYS)
+        people[Guest] = people[Guest].filter(created_at__gte=recent)
+        people[GuestGroup] = people[GuestGroup].filter(created_at__gte=recent)
+
+    entries = []
+    for model, queryset in people.items():
+        user_type, code_field = CODE_FIELDS[model]
+        if codes is not None:
+            queryset = queryset.filter(**{f'{code_field}__in': codes})
+
+        if model is GuestGroup:
+            rows = queryset.values_list(code_field, 'name')
+            entries.extend([code, user_type, name, None, None] for code, name in rows)
+        elif model is TemporaryStudent:
+            rows = queryset.values_list(code_field, 'first_name', 'last_name', 'valid_from', 'valid_until')
+            entries.extend(
+                [code, user_type, f'{first} {last}', _timestamp(valid_from), _timestamp(valid_until)]
+                for code, first, last, valid_from, valid_until in rows
+            )
+        else:
+            rows = queryset.values_list(code_field, 'first_name', 'last_name')
+            entries.extend([code, user_type, f'{first} {last}', None, None] for code, first, last in rows)
+    return entries
+
+
+def _timestamp(value):
+    return int(value.timestamp()) if value else None
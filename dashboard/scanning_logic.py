@@ -1,21 +1,35 @@
 from django.db import transaction
 from django.utils import timezone
 from .models import (
-    RegularStudent, TemporaryStudent, Guest, AccessLog, LabSession
+    RegularStudent, TemporaryStudent, Guest, GuestGroup, AccessLog, Lab, LabSession, VisitStats
 )
+from .projections import close_session, exit_log_for, open_session
 import uuid
 
 class QRCodeScanner:
     """
     Handles the logic for scanning QR codes and logging access.
+
+    Scans are recorded in the station's lab, or in ``lab``, or in the default
+    lab. Someone is inside if they have an open session in that lab; an open
+    session in another lab is closed when they enter this one, since they
+    evidently left without scanning out.
+
+    Each scan adds access logs and applies them to the lab sessions by the
+    rules in ``projections``, which ``replay_scans`` uses to rebuild them.
     """
-    def __init__(self, supervisor):
+    def __init__(self, supervisor, lab=None, station=None):
         self.supervisor = supervisor
+        self.station = station
+        self.lab = station.lab if station else (lab or Lab.default())
 
     def process_scan(self, qr_code_data):
         """
         Process a QR code scan and determine what action to take
         """
+        if str(qr_code_data or '').startswith(GuestGroup.ID_PREFIX):
+            return self._process_group_scan(qr_code_data)
+
         # Determine the type of QR code (Regular, Temporary, or Guest)
         user_object, user_type = self._identify_user(qr_code_data)
 
@@ -38,22 +52,28 @@ class QRCodeScanner:
                 }
             }
 
-        # Check if the user is currently inside the lab
-        is_inside = self._is_inside_lab(user_object, user_type)
-
-        # Log the entry or exit based on current status
-        log_type = 'exit' if is_inside else 'entry'
         with transaction.atomic():
-            log_entry = self._create_log_entry(user_object, user_type, log_type)
+            # Lock the person so concurrent scans of the same code are applied
+            # one after the other and each sees the previous one's session
+            user_object = type(user_object).objects.select_for_update().get(pk=user_object.pk)
+
+            # Check if the user is currently inside this lab
+            open_sessions = self._open_sessions(user_object, user_type)
+            session = next((s for s in open_sessions if s.lab_id == self.lab.pk), None)
+
+            # Log the entry or exit based on current status
+            log_type = 'exit' if session else 'entry'
 
             # If this is an entry, create a new lab session
             if log_type == 'entry':
-                session = self._create_lab_session(user_object, user_type, log_entry)
+                self._close_sessions(open_sessions)
+                log_entry = self._create_log_entry(user_object, user_type, log_type)
+                session = self._create_lab_session(log_entry)
                 response_message = f"Welcome to the lab, {user_object.first_name}!"
             else:
                 # If this is an exit, update the existing lab session
-                session = self._update_lab_session(user_object, user_type, log_entry)
-                duration_mins = int((timezone.now() - session.entry_time).total_seconds() // 60)
+                self._update_lab_session(session)
+                duration_mins = int(session.duration.total_seconds() // 60)
                 response_message = f"Goodbye, {user_object.first_name}! You spent {duration_mins} minutes in the lab."
 
         return {
@@ -65,10 +85,116 @@ class QRCodeScanner:
                 'user_id': self._get_user_id(user_object, user_type),
                 'log_type': log_type,
                 'timestamp': timezone.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'session_id': str(session.id) if session else None
+                'session_id': str(session.id) if session else None,
+                'lab': self.lab.name
+            }
+        }
+
+    def _process_group_scan(self, group_id):
+        """
+        Check a whole guest group in or out. If any member is inside this lab,
+        the scan checks out everyone still inside it; otherwise every member is
+        checked in.
+        """
+        group = GuestGroup.objects.filter(group_id=group_id).first()
+        if not group:
+            return {
+                'status': 'error',
+                'message': 'Invalid QR code or user not found',
+                'data': None
+            }
+
+        with transaction.atomic():
+            # Lock the group so two scans of its code cannot both check it in
+            group = GuestGroup.objects.select_for_update().get(pk=group.pk)
+            open_sessions = list(
+                LabSession.objects.filter(
+                    guest__group=group,
+                    exit_time__isnull=True
+                ).select_related('entry_log')
+            )
+            inside = [session for session in open_sessions if session.lab_id == self.lab.pk]
+
+            if inside:
+                log_type = 'exit'
+                count = self._close_sessions(inside)
+                response_message = f"Goodbye, {group.name}! {count} guests checked out."
+            else:
+                log_type = 'entry'
+                self._close_sessions(open_sessions)
+                count = self._open_group_sessions(list(group.members.all()))
+                response_message = f"Welcome to the lab, {group.name}! {count} guests checked in."
+
+        if not count:
+            return {
+                'status': 'error',
+                'message': 'This group has no members.',
+                'data': {
+                    'user_type': 'group',
+                    'user_name': group.name,
+                    'user_id': group.group_id
+                }
+            }
+
+        return {
+            'status': 'success',
+            'message': response_message,
+            'data': {
+                'user_type': 'group',
+                'user_name': group.name,
+                'user_id': group.group_id,
+                'log_type': log_type,
+                'timestamp': timezone.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'session_id': None,
+                'member_count': count,
+                'lab': self.lab.name
             }
         }
 
+    def _open_group_sessions(self, guests):
+        """
+        Bulk insert an entry log and an open lab session for every guest
+        """
+        now = timezone.now()
+        entry_logs = AccessLog.objects.bulk_create([
+            AccessLog(
+                guest=guest,
+                user_type='guest',
+                log_type='entry',
+                timestamp=now,
+                session_id=uuid.uuid4(),
+                recorded_by=self.supervisor,
+                lab=self.lab,
+                station=self.station
+            )
+            for guest in guests
+        ])
+        LabSession.objects.bulk_create([open_session(entry_log) for entry_log in entry_logs])
+        return len(guests)
+
+    def _close_sessions(self, sessions):
+        """
+        Bulk insert exit logs and close the given open sessions, each in its
+        own lab
+        """
+        if not sessions:
+            return 0
+        now = timezone.now()
+        exit_logs = AccessLog.objects.bulk_create([
+            exit_log_for(
+                session, now,
+                recorded_by=self.supervisor,
+                station=self.station if session.lab_id == self.lab.pk else None
+            )
+            for session in sessions
+        ])
+
+        for session, exit_log in zip(sessions, exit_logs):
+            close_session(session, exit_log)
+        LabSession.objects.bulk_update(sessions, ['exit_time', 'exit_log', 'duration'])
+        VisitStats.record_visits(sessions)
+        return len(sessions)
+
     def _identify_user(self, qr_code_data):
         """
         Identify the user type and object based on the QR code data
@@ -116,31 +242,17 @@ class QRCodeScanner:
 
         return False
 
-    def _is_inside_lab(self, user_object, user_type):
+    def _open_sessions(self, user_object, user_type):
         """
-        Check if the user is currently inside the lab
+        The user's open sessions in any lab; at most one unless they left a
+        lab without scanning out
         """
-        # Find the most recent session for this user
-        if user_type == 'regular':
-            session = LabSession.objects.filter(
-                regular_student=user_object,
-                exit_time__isnull=True
-            ).first()
-        elif user_type == 'temporary':
-            session = LabSession.objects.filter(
-                temporary_student=user_object,
-                exit_time__isnull=True
-            ).first()
-        elif user_type == 'guest':
-            session = LabSession.objects.filter(
-                guest=user_object,
-                exit_time__isnull=True
-            ).first()
-        else:
-            return False
-
-        # If there's an open session, they're inside
-        return session is not None
+        field = VisitStats.PERSON_FIELDS.get(user_type)
+        if field is None:
+            return []
+        return list(
+            LabSession.objects.filter(**{field: user_object}, exit_time__isnull=True).select_related('entry_log')
+        )
 
     def _create_log_entry(self, user_object, user_type, log_type):
         """
@@ -149,7 +261,9 @@ class QRCodeScanner:
         log_entry = AccessLog(
             user_type=user_type,
             log_type=log_type,
-            recorded_by=self.supervisor
+            recorded_by=self.supervisor,
+            lab=self.lab,
+            station=self.station
         )
 
         # Set the appropriate user field based on type
@@ -167,54 +281,23 @@ class QRCodeScanner:
         log_entry.save()
         return log_entry
 
-    def _create_lab_session(self, user_object, user_type, log_entry):
+    def _create_lab_session(self, log_entry):
         """
         Create a new lab session on entry
         """
-        session = LabSession(
-            user_type=user_type,
-            entry_time=timezone.now(),
-            entry_log=log_entry
-        )
-
-        # Set the appropriate user field based on type
-        if user_type == 'regular':
-            session.regular_student = user_object
-        elif user_type == 'temporary':
-            session.temporary_student = user_object
-        elif user_type == 'guest':
-            session.guest = user_object
-
+        session = open_session(log_entry)
         session.save()
         return session
 
-    def _update_lab_session(self, user_object, user_type, log_entry):
+    def _update_lab_session(self, session):
         """
-        Update an existing lab session on exit
+        Log the exit and close the open lab session with it
         """
-        # Find the open session for this user
-        if user_type == 'regular':
-            session = LabSession.objects.filter(
-                regular_student=user_object,
-                exit_time__isnull=True
-            ).first()
-        elif user_type == 'temporary':
-            session = LabSession.objects.filter(
-                temporary_student=user_object,
-                exit_time__isnull=True
-            ).first()
-        elif user_type == 'guest':
-            session = LabSession.objects.filter(
-                guest=user_object,
-                exit_time__isnull=True
-            ).first()
-
-        if session:
-            # Update the session with exit information
-            session.exit_time = timezone.now()
-            session.exit_log = log_entry
-            session.save()
-
+        log_entry = exit_log_for(session, timezone.now(), recorded_by=self.supervisor, station=self.station)
+        log_entry.save()
+        close_session(session, log_entry)
+        session.save()
+        VisitStats.record_visit(session)
         return session
 
     def _get_user_id(self, user_object, user_type):
@@ -0,0 +1,78 @@
+from django.contrib.auth import user_logged_out
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import log_counts
+from .auth_backends import forget_cached_user
+from .models import AccessLog, Guest, RegularStudent, TemporaryStudent
+from .roster_sync import CODE_FIELDS, record_changes
+from .thumbnails import IMAGE_FIELDS, request_thumbnails
+
+
+@receiver([post_save, post_delete], sender=User)
+def forget_changed_user(sender, instance, **kwargs):
+    """Drop the cached copy when a user's password, status or details change."""
+    forget_cached_user(instance.pk)
+
+
+@receiver(user_logged_out)
+def forget_logged_out_user(sender, request, user, **kwargs):
+    if user is not None:
+        forget_cached_user(user.pk)
+
+
+def queue_thumbnails(sender, instance, **kwargs):
+    """Resize a newly uploaded image once the upload is committed."""
+    field_file = getattr(instance, IMAGE_FIELDS[sender])
+    if field_file:
+        transaction.on_commit(lambda: request_thumbnails(field_file))
+
+
+for model in IMAGE_FIELDS:
+    post_save.connect(queue_thumbnails, sender=model, dispatch_uid=f'queue_thumbnails_{model.__name__}')
+
+
+def record_roster_change(sender, instance, **kwargs):
+    """Let scanner stations know this person's roster entry changed."""
+    record_changes([getattr(instance, CODE_FIELDS[sender][1])])
+
+
+for model in CODE_FIELDS:
+    for signal in (post_save, post_delete):
+        signal.connect(record_roster_change, sender=model, dispatch_uid=f'record_roster_change_{model.__name__}')
+
+
+@receiver(pre_save, sender=AccessLog)
+def remember_counted_day(sender, instance, **kwargs):
+    """An edit can move a log to another day; both days are counted again."""
+    if not instance._state.adding:
+        instance._counted_timestamp = AccessLog.objects.filter(pk=instance.pk).values_list(
+            'timestamp', flat=True
+        ).first()
+
+
+@receiver(post_save, sender=AccessLog)
+def count_saved_log(sender, instance, created, **kwargs):
+    if created:
+        log_counts.logs_added([instance.timestamp])
+    else:
+        previous = getattr(instance, '_counted_timestamp', None)
+        log_counts.logs_changed([instance.timestamp] + ([previous] if previous else []))
+
+
+@receiver(post_delete, sender=AccessLog)
+def count_deleted_log(sender, instance, **kwargs):
+    log_counts.logs_changed([instance.timestamp])
+
+
+def forget_search_counts(sender, instance, created=False, **kwargs):
+    """A renamed or deleted person changes which logs a search matches."""
+    if not created:
+        log_counts.invalidate_searches()
+
+
+for model in (RegularStudent, TemporaryStudent, Guest):
+    for signal in (post_save, post_delete):
+        signal.connect(forget_search_counts, sender=model, dispatch_uid=f'forget_search_counts_{model.__name__}')
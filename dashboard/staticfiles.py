@@ -0,0 +1,157 @@
+"""
+Fingerprinted, precompressed static files.
+
+``collectstatic`` with CompressedManifestStaticFilesStorage copies every asset
+under a content-hashed name and writes ``.gz`` (and, with the brotli package
+installed, ``.br``) siblings next to the text assets. ``serve_static`` then
+sends the smallest variant the browser accepts, and marks hashed names as
+immutable so scanner tablets never download the same bundle twice.
+"""
+import gzip
+import mimetypes
+import os
+import posixpath
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.core.files.base import ContentFile
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.functional import cached_property
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = {
+    '.css', '.js', '.mjs', '.map', '.json', '.svg', '.txt', '.html', '.xml', '.ttf', '.eot', '.ico',
+}
+
+# Smaller files fit in a packet or two either way
+MIN_COMPRESS_SIZE = 512
+
+# Hashed names change whenever their content does, so they can be cached forever
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+UNHASHED_CACHE_CONTROL = 'public, max-age=300'
+
+# Preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Manifest storage that also writes compressed variants of each hashed
+    text asset. A variant is kept only when it is actually smaller.
+    """
+    # A library stylesheet or template that points at a file the build didn't
+    # produce shouldn't abort collectstatic or the page; the reference is left
+    # as it was written and simply 404s
+    manifest_strict = False
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+
+        for name in set(self.hashed_files.values()):
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            for compressed_name in self._compress(name):
+                yield name, compressed_name, True
+
+    def url_converter(self, name, hashed_files, template=None):
+        converter = super().url_converter(name, hashed_files, template)
+
+        def converter_ignoring_missing(matchobj):
+            try:
+                return converter(matchobj)
+            except ValueError:
+                return matchobj.group('matched')
+
+        return converter_ignoring_missing
+
+    def _compress(self, name):
+        with self.open(name) as original:
+            content = original.read()
+        if len(content) < MIN_COMPRESS_SIZE:
+            return []
+
+        variants = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            variants.append(('.br', brotli.compress(content)))
+
+        written = []
+        for suffix, compressed in variants:
+            if len(compressed) >= len(content):
+                continue
+            compressed_name = name + suffix
+            if self.exists(compressed_name):
+                self.delete(compressed_name)
+            self._save(compressed_name, ContentFile(compressed))
+            written.append(compressed_name)
+        return written
+
+    @cached_property
+    def hashed_names(self):
+        """Every fingerprinted name in the manifest, for quick lookups."""
+        return frozenset(self.hashed_files.values())
+
+
+def serve_static(request, path):
+    """
+    Serve a collected static file, choosing a precompressed variant from the
+    request's Accept-Encoding. Hashed names get a year-long immutable cache.
+    """
+    path = posixpath.normpath(path).lstrip('/')
+    try:
+        fullpath = safe_join(staticfiles_storage.location, path)
+    except ValueError:
+        raise Http404
+    if not os.path.isfile(fullpath):
+        raise Http404
+
+    stat = os.stat(fullpath)
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime):
+        return HttpResponseNotModified()
+
+    content_type, _ = mimetypes.guess_type(fullpath)
+    accepted = _accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    encoding, served_path = None, fullpath
+    for candidate, suffix in ENCODINGS:
+        if candidate in accepted and os.path.isfile(fullpath + suffix):
+            encoding, served_path = candidate, fullpath + suffix
+            break
+
+    response = FileResponse(
+        open(served_path, 'rb'),
+        content_type=content_type or 'application/octet-stream',
+        filename=os.path.basename(fullpath),
+    )
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Vary'] = 'Accept-Encoding'
+    response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if _is_hashed(path) else UNHASHED_CACHE_CONTROL
+    if encoding:
+        response['Content-Encoding'] = encoding
+    return response
+
+
+def _accepted_encodings(header):
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def _is_hashed(path):
+    return path in getattr(staticfiles_storage, 'hashed_names', ())
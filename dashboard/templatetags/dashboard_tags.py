@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django import template
+
+from dashboard.thumbnails import thumbnail_url
+
+register = template.Library()
+
+
+@register.filter
+def duration(value):
+    """Format a timedelta as hours and minutes, e.g. "3h 05m" or "42m"."""
+    if not isinstance(value, timedelta):
+        return "-"
+    minutes = int(value.total_seconds() // 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m"
+    return f"{minutes}m"
+
+
+@register.filter
+def thumbnail(field_file, size):
+    """URL of a resized copy of an uploaded image, e.g. ``student.photo|thumbnail:'avatar'``."""
+    return thumbnail_url(field_file, size)
@@ -1,3 +1,968 @@
-from django.test import TestCase
+"""
+Performance regression tests.
 
-# Create your tests here.
+Every page is loaded against the same seeded dataset and has to stay under a
+fixed number of queries, so a per-row lookup or a per-day count loop that
+creeps back in fails here rather than in production. The key queries are also
+EXPLAINed and must be answered from an index, not a full table scan.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from importlib import import_module
+from io import BytesIO, StringIO
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from unittest import mock, skipIf
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.apps import apps
+from django.db import OperationalError, connection
+from django.db.models import Q
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import admission, id_cards, log_counts, maintenance, metrics, projections, qr, thumbnails, views
+from .id_cards import IDCardRenderer, people_for_cards
+from .guest_groups import GuestGroupRegistrar
+from .replica import read_alias, use_replica
+from .auth_backends import user_cache_key
+from .models import (
+    AccessLog, DailyLogCount, Guest, GuestGroup, Lab, LabSession, MaintenanceLock, MaintenanceRun, RegularStudent,
+    StudentIDSequence, SystemSettings, TemporaryStudent, UserProfile, VisitStats,
+)
+
+REGULAR_STUDENTS = 40
+TEMPORARY_STUDENTS = 10
+GUESTS = 10
+GROUP_MEMBERS = 10
+DAYS_OF_TRAFFIC = 7
+OPEN_SESSIONS = 5
+
+
+def seed_dataset():
+    """
+    A small but complete dataset: more rows than any page shows, so a query
+    per row always pushes a page over its limit. Names and visit times are
+    fixed; only "now" moves.
+    """
+    supervisor = User.objects.create_user(
+        'supervisor', 'supervisor@example.com', 'password', is_staff=True, is_superuser=True
+    )
+    UserProfile.objects.create(user=supervisor, user_type='admin')
+
+    regular = [
+        RegularStudent(
+            first_name=f'Regular{number}', last_name='Student', class_status='Form 1',
+            boarding_status='Day', year_joined=2024, created_by=supervisor,
+        )
+        for number in range(REGULAR_STUDENTS)
+    ]
+    RegularStudent.allocate_student_ids(regular)
+    RegularStudent.objects.bulk_create(regular)
+
+    now = timezone.now()
+    temporary = [
+        TemporaryStudent(
+            first_name=f'Temporary{number}', last_name='Student', class_status='Form 2',
+            boarding_status='Boarding', year_joined=2024, created_by=supervisor,
+            valid_until=now + timedelta(days=30), reason='Exchange',
+        )
+        for number in range(TEMPORARY_STUDENTS)
+    ]
+    TemporaryStudent.allocate_student_ids(temporary)
+    TemporaryStudent.objects.bulk_create(temporary)
+
+    group = GuestGroup.objects.create(
+        name='Visiting School', school_or_organization='Hill School', purpose='Tour', created_by=supervisor
+    )
+    guests = []
+    for number in range(GUESTS + GROUP_MEMBERS):
+        guest = Guest(
+            first_name=f'Guest{number}', last_name='Visitor', school_or_organization='Hill School',
+            purpose='Tour', created_by=supervisor, group=group if number >= GUESTS else None,
+        )
+        guest.guest_id = guest.generate_guest_id()
+        guests.append(guest)
+    Guest.objects.bulk_create(guests)
+
+    # One closed visit per regular student per day, then a few people still inside
+    visits = [
+        ('regular', 'regular_student', student, now - timedelta(days=day, hours=3), timedelta(hours=1))
+        for day in range(1, DAYS_OF_TRAFFIC + 1) for student in regular
+    ]
+    visits += [
+        ('temporary', 'temporary_student', student, now - timedelta(days=1, hours=2), timedelta(minutes=30))
+        for student in temporary
+    ]
+    visits += [
+        ('guest', 'guest', guest, now - timedelta(days=2, hours=2), timedelta(minutes=45))
+        for guest in guests
+    ]
+    visits += [
+        ('regular', 'regular_student', student, now - timedelta(minutes=30), None)
+        for student in regular[:OPEN_SESSIONS]
+    ]
+
+    entry_logs = [
+        AccessLog(user_type=user_type, log_type='entry', timestamp=entered, recorded_by=supervisor, **{field: person})
+        for user_type, field, person, entered, _ in visits
+    ]
+    exit_logs = [
+        AccessLog(
+            user_type=user_type, log_type='exit', timestamp=entered + stayed, recorded_by=supervisor,
+            **{field: person}
+        )
+        for user_type, field, person, entered, stayed in visits if stayed
+    ]
+    AccessLog.objects.bulk_create(entry_logs + exit_logs)
+
+    exits = iter(exit_logs)
+    LabSession.objects.bulk_create([
+        LabSession(
+            user_type=user_type, entry_time=entered, entry_log=entry_log, **{field: person},
+            **({'exit_time': entered + stayed, 'duration': stayed, 'exit_log': next(exits)} if stayed else {})
+        )
+        for (user_type, field, person, entered, stayed), entry_log in zip(visits, entry_logs)
+    ])
+    call_command('rebuild_visit_stats', stdout=StringIO())
+
+    return supervisor
+
+
+class QueryCountTestCase(TestCase):
+    """Seeds the dataset once and signs in as the supervisor for each test."""
+    @classmethod
+    def setUpTestData(cls):
+        cls.supervisor = seed_dataset()
+        cls.student = RegularStudent.objects.order_by('pk').first()
+        cls.guest = Guest.objects.order_by('pk').first()
+
+    def setUp(self):
+        # Cached settings, profiles and users would hide queries from one test to the next
+        cache.clear()
+        self.client.force_login(self.supervisor)
+
+    def assertMaxQueries(self, limit, url, method='get', **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, **kwargs)
+        self.assertEqual(response.status_code, 200, url)
+        self.assertLessEqual(
+            len(queries), limit,
+            f"{url} ran {len(queries)} queries (limit {limit}):\n" + '\n'.join(
+                query['sql'] for query in queries.captured_queries
+            )
+        )
+        return response
+
+
+class ViewQueryCountTests(QueryCountTestCase):
+    def test_dashboard(self):
+        self.assertMaxQueries(11, reverse('dashboard'))
+        self.assertMaxQueries(11, reverse('dashboard') + '?lab=main')
+
+    def test_student_list(self):
+        self.assertMaxQueries(7, reverse('student_list'))
+        self.assertMaxQueries(7, reverse('student_list') + '?type=temporary')
+        self.assertMaxQueries(7, reverse('student_list') + '?sort=visits&q=Regular')
+
+    def test_student_detail(self):
+        self.assertMaxQueries(8, reverse('student_detail', args=[self.student.student_id]))
+
+    def test_guest_list(self):
+        self.assertMaxQueries(7, reverse('guest_list'))
+
+    def test_guest_detail(self):
+        self.assertMaxQueries(9, reverse('guest_detail', args=[self.guest.guest_id]))
+
+    def test_access_logs(self):
+        # Counting the days into an empty cache takes two queries more than a COUNT(*) did
+        self.assertMaxQueries(8, reverse('access_logs'))
+        self.assertMaxQueries(7, reverse('access_logs') + '?q=Regular1&log_type=entry&user_type=regular')
+
+    def test_access_log_counts(self):
+        response = self.assertMaxQueries(8, reverse('access_logs'))
+        self.assertEqual(response.context['total_count'], AccessLog.objects.count())
+
+        # Other type filters and pages reuse the cached day buckets
+        with CaptureQueriesContext(connection) as queries:
+            response = self.assertMaxQueries(6, reverse('access_logs'), data={'user_type': 'guest', 'page': 2})
+        self.assertFalse([query for query in queries.captured_queries if 'COUNT(' in query['sql']])
+        self.assertEqual(response.context['total_count'], 2 * (GUESTS + GROUP_MEMBERS))
+        log_types = {choice['label']: choice['count'] for choice in response.context['facets']['log_type']}
+        self.assertEqual(log_types, {'All': 40, 'Entry': 20, 'Exit': 20})
+        user_types = {choice['label']: choice['count'] for choice in response.context['facets']['user_type']}
+        self.assertEqual(user_types['Guest'], 40)
+        self.assertEqual(user_types['All'], AccessLog.objects.count())
+
+        # Closed days stored by the maintenance job give the same counts to a cold cache
+        self.assertEqual(log_counts.store_closed_days(), DAYS_OF_TRAFFIC + 1 - settings.LOG_COUNT_OPEN_DAYS)
+        self.assertTrue(DailyLogCount.objects.exists())
+        # (one query for the stored days and one for the open ones)
+        cache.clear()
+        self.client.force_login(self.supervisor)
+        response = self.assertMaxQueries(9, reverse('access_logs'), data={'user_type': 'guest'})
+        self.assertEqual(response.context['total_count'], 2 * (GUESTS + GROUP_MEMBERS))
+
+        # A new scan is counted in today's bucket; deleting a week-old log recounts its day
+        student = RegularStudent.objects.order_by('-pk').first()
+        self.client.post(
+            reverse('process_scan'), data=json.dumps({'qr_code': student.student_id}),
+            content_type='application/json',
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            AccessLog.objects.filter(log_type='exit').earliest('timestamp').delete()
+        response = self.assertMaxQueries(8, reverse('access_logs'), data={'q': 'Student'})
+        self.assertEqual(response.context['total_count'], AccessLog.objects.exclude(user_type='guest').count())
+        response = self.assertMaxQueries(7, reverse('access_logs'))
+        self.assertEqual(response.context['total_count'], AccessLog.objects.count())
+
+    def test_recount_stored_meanwhile(self):
+        log_counts.store_closed_days()
+        day = DailyLogCount.objects.earliest('day').day
+        expected = sorted(DailyLogCount.objects.filter(day=day).values_list('lab', 'log_type', 'user_type', 'count'))
+
+        other_worker = []
+
+        def store_first(execute, sql, params, many, context):
+            # Another worker stores the same day between our delete and insert
+            if sql.startswith('INSERT INTO "dashboard_dailylogcount"') and not other_worker:
+                other_worker.append(expected[0])
+                lab_id, log_type, user_type, count = expected[0]
+                DailyLogCount.objects.create(day=day, lab_id=lab_id, log_type=log_type, user_type=user_type, count=count)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(store_first):
+            log_counts._store([day])
+        self.assertEqual(
+            sorted(DailyLogCount.objects.filter(day=day).values_list('lab', 'log_type', 'user_type', 'count')),
+            expected,
+        )
+
+    def test_access_log_counts_across_workers(self):
+        student = RegularStudent.objects.order_by('pk').first()
+        self.assertEqual(log_counts.summary()['total'], AccessLog.objects.count())
+        self.assertTrue(log_counts.summary(query=student.first_name)['total'])
+        log_counts.store_closed_days()
+
+        # Another process, with a cache of its own, deletes an old log and
+        # renames a student; this worker's cache is left as it was
+        other_worker = dict(cache._cache), dict(cache._expire_info)
+        with self.captureOnCommitCallbacks(execute=True):
+            AccessLog.objects.filter(log_type='exit').earliest('timestamp').delete()
+            student.first_name = 'Renamed'
+            student.save()
+        cache.clear()
+        cache._cache.update(other_worker[0])
+        cache._expire_info.update(other_worker[1])
+
+        self.assertEqual(log_counts.summary()['total'], AccessLog.objects.count())
+        self.assertEqual(log_counts.summary(query=f'Regular{REGULAR_STUDENTS - 1}')['total'], AccessLog.objects.filter(
+            regular_student__first_name=f'Regular{REGULAR_STUDENTS - 1}'
+        ).count())
+        self.assertEqual(log_counts.summary(query=student.student_id)['total'], AccessLog.objects.filter(
+            regular_student=student
+        ).count())
+
+    def test_scan_roster(self):
+        response = self.assertMaxQueries(7, reverse('scan_roster'))
+        # Everyone, plus the group's own code
+        everyone = REGULAR_STUDENTS + TEMPORARY_STUDENTS + GUESTS + GROUP_MEMBERS + 1
+        self.assertEqual(len(response.json()['data']['entries']), everyone)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.student.save()
+        response = self.assertMaxQueries(9, reverse('scan_roster'), data={'since': 0})
+        self.assertEqual([entry[0] for entry in response.json()['data']['upsert']], [self.student.student_id])
+
+    def test_process_scan(self):
+        student = RegularStudent.objects.order_by('-pk').first()
+        for log_type in ('entry', 'exit'):
+            response = self.assertMaxQueries(
+                13, reverse('process_scan'), method='post',
+                data=json.dumps({'qr_code': student.student_id}), content_type='application/json',
+            )
+            self.assertEqual(response.json()['data']['log_type'], log_type)
+
+    @override_settings(SCAN_REPEAT_WINDOW=3)
+    def test_process_scan_busy(self):
+        student = RegularStudent.objects.order_by('-pk').first()
+        logs = AccessLog.objects.count()
+        gate = admission.Gate(limit=1, queue_size=0, timeout=1)
+        self.addCleanup(setattr, admission, '_gate', admission._gate)
+        admission._gate = gate
+
+        with gate.admit(), CaptureQueriesContext(connection) as queries, self.assertLogs('django.request', 'WARNING'):
+            response = self.client.post(
+                reverse('process_scan'), data=json.dumps({'qr_code': student.student_id}),
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 503)
+        # Only the session and user, nothing that waits on a write lock
+        self.assertLessEqual(len(queries), 2)
+        self.assertEqual(response['Retry-After'], str(settings.SCAN_RETRY_AFTER))
+        self.assertEqual(response.json()['status'], 'retry')
+        self.assertEqual(AccessLog.objects.count(), logs)
+
+        # Turned away before it was claimed, so the retry isn't taken for a repeat
+        response = self.client.post(
+            reverse('process_scan'), data=json.dumps({'qr_code': student.student_id}), content_type='application/json',
+        )
+        self.assertEqual(response.json()['status'], 'success')
+
+
+class AdminQueryCountTests(QueryCountTestCase):
+    CHANGELISTS = {
+        'regularstudent': 10,
+        'temporarystudent': 10,
+        'guest': 9,
+        'guestgroup': 8,
+        'accesslog': 11,
+        'labsession': 10,
+        'visitstats': 8,
+    }
+
+    def test_changelists(self):
+        for model_name, limit in self.CHANGELISTS.items():
+            with self.subTest(model_name):
+                self.assertMaxQueries(limit, reverse(f'admin:dashboard_{model_name}_changelist'))
+
+    def test_log_search_and_month(self):
+        month = timezone.localtime(AccessLog.objects.latest('timestamp').timestamp).strftime('%Y-%m')
+        for model_name in ('accesslog', 'labsession'):
+            with self.subTest(model_name):
+                response = self.assertMaxQueries(
+                    self.CHANGELISTS[model_name],
+                    reverse(f'admin:dashboard_{model_name}_changelist'),
+                    data={'q': 'Regular1 Student', 'month': month},
+                )
+                self.assertTrue(response.context['cl'].result_count)
+
+
+class ReplayTests(QueryCountTestCase):
+    """Lab sessions rebuilt from the access log match what the scanner writes."""
+    def sessions(self):
+        return list(LabSession.objects.order_by('entry_log_id').values_list(
+            'entry_log_id', 'exit_log_id', 'entry_time', 'exit_time', 'duration', 'lab_id'
+        ))
+
+    def test_rebuild(self):
+        sessions = self.sessions()
+        LabSession.objects.all().delete()
+        counts = projections.replay()
+        self.assertEqual(counts['created'], len(sessions))
+        self.assertEqual(self.sessions(), sessions)
+
+        for exit_log in AccessLog.objects.filter(log_type='exit').select_related('paired_log'):
+            self.assertEqual(exit_log.paired_log.log_type, 'entry')
+            self.assertEqual(exit_log.session_id, exit_log.paired_log.session_id)
+
+        # Nothing left to change, and the queries don't grow with the logs
+        with CaptureQueriesContext(connection) as queries:
+            counts = projections.replay(since=timezone.now() - timedelta(days=DAYS_OF_TRAFFIC + 1))
+        self.assertLessEqual(len(queries), 10)
+        self.assertEqual(counts['logs'], AccessLog.objects.count())
+        self.assertEqual([counts['created'], counts['updated'], counts['deleted'], counts['repaired']], [0] * 4)
+
+    def test_fix_and_catch_up(self):
+        projections.replay()
+        student = LabSession.objects.filter(exit_time__isnull=True).first().regular_student
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse('process_scan'), data=json.dumps({'qr_code': student.student_id}),
+                content_type='application/json',
+            )
+        exit_log = AccessLog.objects.latest('id')
+        self.assertEqual(exit_log.log_type, 'exit')
+        counts = projections.catch_up()
+        self.assertEqual([counts['logs'], counts['created'], counts['updated']], [1, 0, 0])
+
+        # The exit was scanned by mistake: removing it reopens the session
+        exit_log.delete()
+        projections.replay(since=timezone.now() - timedelta(hours=1))
+        self.assertTrue(LabSession.objects.filter(regular_student=student, exit_time__isnull=True).exists())
+        self.assertEqual(student.visit_stats.total_visits, DAYS_OF_TRAFFIC)
+
+        # An entry that should have been an exit opened a session that never was
+        entry_log = AccessLog.objects.filter(regular_student=student, log_type='entry').earliest('timestamp')
+        AccessLog.objects.filter(pk=entry_log.pk).update(log_type='exit')
+        counts = projections.replay(since=entry_log.timestamp)
+        self.assertEqual([counts['deleted'], counts['unpaired']], [1, 2])
+        self.assertFalse(LabSession.objects.filter(entry_log=entry_log).exists())
+        self.assertEqual(VisitStats.objects.get(regular_student=student).total_visits, DAYS_OF_TRAFFIC - 1)
+
+
+class GuestGroupTests(TestCase):
+    def setUp(self):
+        self.supervisor = User.objects.create_user('supervisor')
+        self.client.force_login(self.supervisor)
+        self.registrar = GuestGroupRegistrar(self.supervisor)
+
+    def test_parse_members(self):
+        roster = SimpleUploadedFile(
+            'group.csv', b'First Name,Last Name,Email\nCara,Diaz,cara@example.com\nEd,Fox,not-an-email\n'
+        )
+        members, errors = self.registrar.parse_members('Ann Baker\nBen, Cole, 0700000000, ben@example\n', roster)
+        self.assertEqual([member['first_name'] for member in members], ['Ann', 'Cara'])
+        self.assertEqual(members[1]['email'], 'cara@example.com')
+        self.assertEqual(errors, [
+            {'row': 'Line 2', 'messages': ['Enter a valid email address.']},
+            {'row': 'Row 3', 'messages': ['Enter a valid email address.']},
+        ])
+
+    def test_member_limit(self):
+        text = '\n'.join(f'Guest{number} Visitor' for number in range(GuestGroupRegistrar.MAX_MEMBERS + 1))
+        _, errors = self.registrar.parse_members(text)
+        self.assertEqual(errors, [
+            {'row': '-', 'messages': [f'A group can have at most {GuestGroupRegistrar.MAX_MEMBERS} members.']}
+        ])
+
+    def test_register_and_check_in_and_out(self):
+        response = self.client.post(reverse('add_guest_group'), {
+            'name': 'Hill School Trip', 'school_or_organization': 'Hill School', 'purpose': 'Tour',
+            'members': 'Ann Baker\nBen Cole\nCara Diaz',
+        })
+        group = GuestGroup.objects.get()
+        self.assertRedirects(response, reverse('guest_group_detail', args=[group.group_id]))
+        self.assertEqual(sorted(group.members.values_list('first_name', flat=True)), ['Ann', 'Ben', 'Cara'])
+
+        def scan():
+            return self.client.post(
+                reverse('process_scan'), data=json.dumps({'qr_code': group.group_id}), content_type='application/json'
+            ).json()['data']
+
+        inside = LabSession.objects.filter(guest__group=group, exit_time__isnull=True)
+        self.assertEqual((scan()['log_type'], inside.count()), ('entry', 3))
+        self.assertEqual((scan()['log_type'], inside.count()), ('exit', 0))
+        self.assertEqual(AccessLog.objects.filter(guest__group=group).count(), 6)
+
+        # A bad member list adds nobody
+        response = self.client.post(reverse('add_guest_group'), {
+            'name': 'Second Trip', 'school_or_organization': 'Hill School', 'purpose': 'Tour',
+            'members': 'Ann Baker\nBen, Cole, , ben@',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(GuestGroup.objects.count(), 1)
+
+
+@override_settings(SCAN_REPEAT_WINDOW=0)
+class LabScanTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.supervisor = User.objects.create_user('supervisor')
+        self.client.force_login(self.supervisor)
+        self.main = Lab.default()
+        # Created after the migration's main lab, so the id sequence must have moved past it
+        self.science = Lab.objects.create(name='Science Lab', code='science')
+        self.student = RegularStudent(
+            first_name='Ada', last_name='Student', class_status='Form 1', boarding_status='Day',
+            year_joined=2024, created_by=self.supervisor,
+        )
+        RegularStudent.allocate_student_ids([self.student])
+        self.student.save()
+
+    def scan(self, lab):
+        return self.client.post(
+            reverse('process_scan'), data=json.dumps({'qr_code': self.student.student_id, 'lab': lab.code}),
+            content_type='application/json',
+        ).json()
+
+    def test_scans_toggle_per_lab(self):
+        self.assertEqual(self.scan(self.main)['data']['log_type'], 'entry')
+        # Walking into another lab closes the session in the first
+        result = self.scan(self.science)
+        self.assertEqual((result['data']['log_type'], result['data']['lab']), ('entry', 'Science Lab'))
+        self.assertEqual(
+            list(AccessLog.objects.filter(lab=self.main).order_by('pk').values_list('log_type', flat=True)),
+            ['entry', 'exit'],
+        )
+        open_sessions = LabSession.objects.filter(regular_student=self.student, exit_time__isnull=True)
+        self.assertEqual([session.lab for session in open_sessions], [self.science])
+
+        self.assertEqual(self.scan(self.science)['data']['log_type'], 'exit')
+        self.assertFalse(LabSession.objects.filter(regular_student=self.student, exit_time__isnull=True).exists())
+        self.assertEqual(self.scan(self.main)['data']['log_type'], 'entry')
+
+    @override_settings(SCAN_REPEAT_WINDOW=3)
+    def test_repeat_window(self):
+        self.assertEqual(self.scan(self.main)['data']['log_type'], 'entry')
+        self.assertEqual(self.scan(self.main)['message'], 'This code was just scanned. Please wait a moment.')
+        # The window is per lab: moving on to the next lab's door isn't a repeat
+        self.assertEqual(self.scan(self.science)['data']['log_type'], 'entry')
+
+    def test_inactive_lab(self):
+        self.science.is_active = False
+        self.science.save()
+        self.assertEqual(self.scan(self.science)['message'], 'Unknown lab or scanner station.')
+        self.assertFalse(AccessLog.objects.exists())
+
+
+class QRCodeImageTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache_dir = override_settings(QR_CACHE_DIR=directory.name)
+        cache_dir.enable()
+        self.addCleanup(cache_dir.disable)
+        qr.get_qr_image.cache_clear()
+
+        self.client.force_login(User.objects.create_user('supervisor'))
+        self.guest = Guest(first_name='Ann', last_name='Baker', purpose='Tour', created_by=User.objects.get())
+        self.guest.guest_id = self.guest.generate_guest_id()
+        self.guest.save()
+        self.url = reverse('qr_code_image', args=[self.guest.guest_id])
+
+    def cached_files(self):
+        return [name for _, _, names in os.walk(settings.QR_CACHE_DIR) for name in names]
+
+    def test_formats(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue(response.content.startswith(b'\x89PNG'))
+        response = self.client.get(self.url, {'format': 'svg'})
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertIn(b'<svg', response.content)
+        self.assertEqual(self.client.get(self.url, {'format': 'gif'}).status_code, 404)
+        self.assertEqual(len(self.cached_files()), 2)
+
+    def test_etag_and_size_bounds(self):
+        response = self.client.get(self.url, {'size': 1000})
+        self.assertEqual(response['ETag'], f'"{qr.qr_cache_key(self.guest.guest_id, "png", qr.MAX_BOX_SIZE)}"')
+        response = self.client.get(self.url, {'size': 1000}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(self.url, {'size': 0})
+        self.assertEqual(response['ETag'], f'"{qr.qr_cache_key(self.guest.guest_id, "png", 1)}"')
+
+    def test_download_name(self):
+        response = self.client.get(self.url, {'download': 1})
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="qrcode_{self.guest.guest_id}.png"')
+
+    def test_unknown_payload(self):
+        response = self.client.get(reverse('qr_code_image', args=['anything" at all']))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.cached_files(), [])
+
+    def test_warm_cache(self):
+        call_command('regenerate_qr_codes', types=['guest'], workers=1, stdout=StringIO())
+        self.assertEqual(self.cached_files(), [os.path.basename(qr.disk_cache_path(self.guest.guest_id))])
+        # The view serves what the command drew, under the same ETag
+        response = self.client.get(self.url)
+        self.assertEqual(response['ETag'], f'"{qr.qr_cache_key(self.guest.guest_id)}"')
+        with open(qr.disk_cache_path(self.guest.guest_id), 'rb') as cached:
+            self.assertEqual(response.content, cached.read())
+
+        output = StringIO()
+        call_command('regenerate_qr_codes', types=['guest'], workers=1, stdout=output)
+        self.assertIn('Drew 0 QR code images', output.getvalue())
+        call_command('regenerate_qr_codes', types=['guest'], workers=1, error_correction='H', stdout=StringIO())
+        self.assertEqual(len(self.cached_files()), 2)
+        with override_settings(QR_ERROR_CORRECTION='H'):
+            self.assertTrue(os.path.exists(qr.disk_cache_path(self.guest.guest_id)))
+
+    def test_resume_checkpoint(self):
+        checkpoint = os.path.join(settings.QR_CACHE_DIR, 'checkpoint.json')
+        selection = {
+            'types': ['guest'], 'years': [], 'formats': ['svg'], 'size': qr.DEFAULT_BOX_SIZE,
+            'error_correction': settings.QR_ERROR_CORRECTION,
+        }
+        with open(checkpoint, 'w') as file:
+            json.dump({'selection': selection, 'positions': {'guest': self.guest.pk}}, file)
+
+        # The interrupted run drew SVGs; resuming it for PNGs would skip the guest
+        with self.assertRaisesMessage(CommandError, 'different --type, --year, --format'):
+            call_command('regenerate_qr_codes', types=['guest'], resume=True, checkpoint=checkpoint, workers=1)
+
+        output = StringIO()
+        call_command(
+            'regenerate_qr_codes', types=['guest'], formats=['svg'], resume=True, checkpoint=checkpoint, workers=1,
+            stdout=output,
+        )
+        self.assertIn('Drew 0 QR code images', output.getvalue())
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_concurrent_writes(self):
+        path = os.path.join(settings.QR_CACHE_DIR, 'same.png')
+        images = [bytes([number]) * 100_000 for number in range(8)]
+        with ThreadPoolExecutor(max_workers=len(images)) as pool:
+            list(pool.map(lambda image: qr.write_atomic(path, image), images))
+        with open(path, 'rb') as written:
+            self.assertIn(written.read(), images)
+        self.assertEqual(self.cached_files(), ['same.png'])
+
+    def test_prune(self):
+        self.client.get(self.url)
+        self.client.get(self.url, {'format': 'svg'})
+        old = time.time() - timedelta(days=settings.QR_CACHE_MAX_AGE_DAYS + 1).total_seconds()
+        for directory, _, names in os.walk(settings.QR_CACHE_DIR):
+            for name in names:
+                if name.endswith('.png'):
+                    os.utime(os.path.join(directory, name), (old, old))
+        self.assertEqual(maintenance.prune_qr_cache(timezone.now()), 1)
+        self.assertEqual([name.rsplit('.', 1)[1] for name in self.cached_files()], ['svg'])
+
+
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media = override_settings(
+            MEDIA_ROOT=directory.name, THUMBNAIL_DIR=os.path.join(directory.name, 'thumbnails')
+        )
+        media.enable()
+        self.addCleanup(media.disable)
+        self.addCleanup(cache.clear)
+        self.logo = SystemSettings.load().school_logo
+
+    def save_logo(self, content):
+        self.logo.save('logo.png', ContentFile(content), save=False)
+
+    def wait_for_worker(self):
+        deadline = time.monotonic() + 10
+        while thumbnails._pending and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(thumbnails._pending)
+
+    def test_thumbnail_url(self):
+        from PIL import Image
+
+        image = BytesIO()
+        Image.new('RGB', (800, 600), 'red').save(image, format='PNG')
+        self.save_logo(image.getvalue())
+        self.assertEqual(thumbnails.thumbnail_url(self.logo, 'avatar'), self.logo.url)
+        self.wait_for_worker()
+
+        url = thumbnails.thumbnail_url(self.logo, 'avatar')
+        self.assertTrue(url.endswith('-avatar.webp'))
+        with Image.open(os.path.join(settings.MEDIA_ROOT, url[len(settings.MEDIA_URL):])) as avatar:
+            self.assertEqual(avatar.size, (96, 96))
+        with Image.open(thumbnails.thumbnail_path(thumbnails.request_thumbnails(self.logo), 'logo')) as logo:
+            self.assertEqual(logo.size, (240, 180))
+
+    def test_failures_are_not_retried(self):
+        self.save_logo(b'not an image')
+        with self.assertLogs('dashboard.thumbnails', 'ERROR'):
+            self.assertEqual(thumbnails.thumbnail_url(self.logo, 'avatar'), self.logo.url)
+            self.wait_for_worker()
+
+        with mock.patch.object(thumbnails, 'schedule') as schedule:
+            self.assertEqual(thumbnails.thumbnail_url(self.logo, 'avatar'), self.logo.url)
+            schedule.assert_not_called()
+
+            # A replaced file has a new modification time, so it is tried again
+            modified = os.path.getmtime(self.logo.path) + 1
+            os.utime(self.logo.path, (modified, modified))
+            thumbnails.thumbnail_url(self.logo, 'avatar')
+            schedule.assert_called_once_with(self.logo.path)
+
+
+class IDCardSheetTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media = override_settings(MEDIA_ROOT=directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        supervisor = User.objects.create_user('supervisor')
+        self.client.force_login(supervisor)
+        students = [
+            RegularStudent(
+                first_name=f'Regular{number}', last_name='Student', class_status='Form 1',
+                boarding_status='Day', year_joined=2024, created_by=supervisor,
+            )
+            for number in range(3)
+        ]
+        RegularStudent.allocate_student_ids(students)
+        RegularStudent.objects.bulk_create(students)
+        self.url = reverse('id_card_sheets') + '?type=regular&year=2024'
+
+    @mock.patch.object(views, 'queue_render')
+    def test_missing_cards_are_queued(self, queue_render):
+        response = self.client.get(self.url)
+        self.assertRedirects(response, reverse('student_list'), fetch_redirect_response=False)
+        queue_render.assert_called_once_with('regular', [2024], None)
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, 'id_cards')))
+
+        IDCardRenderer(workers=1).render(people_for_cards('regular', [2024]))
+        response = self.client.get(self.url)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+        queue_render.assert_called_once()
+
+    @mock.patch.object(id_cards, 'connection')
+    @mock.patch.object(id_cards, 'ProcessPoolExecutor', side_effect=AssertionError('no process pool in a web worker'))
+    def test_background_render(self, pool, connection):
+        id_cards._render_selection(('regular', (2024,), None))
+        pool.assert_not_called()
+        self.assertEqual(IDCardRenderer().current_cards(people_for_cards('regular', [2024]))[1], 0)
+
+    @override_settings(ID_CARD_SHEET_MAX_CARDS=2)
+    @mock.patch.object(views, 'queue_render')
+    def test_selection_cap(self, queue_render):
+        response = self.client.get(self.url)
+        self.assertRedirects(response, reverse('student_list'), fetch_redirect_response=False)
+        queue_render.assert_not_called()
+
+
+class ReplicaTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.snapshot = os.path.join(directory.name, 'replica.sqlite3')
+        snapshot_path = override_settings(REPLICA_SQLITE_PATH=self.snapshot)
+        snapshot_path.enable()
+        self.addCleanup(snapshot_path.disable)
+
+    def refresh(self, age=0):
+        open(self.snapshot, 'w').close()
+        refreshed_at = time.time() - age
+        os.utime(self.snapshot, (refreshed_at, refreshed_at))
+
+    def test_missing_or_stale_replica(self):
+        with use_replica() as alias:
+            self.assertEqual((alias, read_alias()), (None, 'default'))
+        self.refresh(age=settings.REPLICA_MAX_LAG + 60)
+        with use_replica() as alias:
+            self.assertIsNone(alias)
+        self.refresh()
+        with use_replica() as alias:
+            self.assertEqual((alias, read_alias()), ('replica', 'replica'))
+
+    def test_writes_go_to_primary(self):
+        self.refresh()
+        with use_replica():
+            lab = Lab.objects.create(name='Science Lab', code='science')
+        self.assertEqual(lab._state.db, 'default')
+
+    def test_failed_replica_read_falls_back(self):
+        self.refresh()
+        aliases = []
+
+        @use_replica()
+        def report():
+            aliases.append(read_alias())
+            if read_alias() == 'replica':
+                raise OperationalError('no such column: dashboard_accesslog.lab_id')
+            return 'report'
+
+        with self.assertLogs('dashboard.replica', 'WARNING'):
+            self.assertEqual(report(), 'report')
+        self.assertEqual(aliases, ['replica', 'default'])
+
+
+@skipIf(metrics.prometheus_client is None, 'prometheus_client is not installed')
+class MetricsTests(TestCase):
+    @override_settings(DEBUG=False, METRICS_TOKEN='')
+    def test_local_only_without_token(self):
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='192.0.2.1').status_code, 403)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+    @override_settings(DEBUG=False, METRICS_TOKEN='secret')
+    def test_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 401)
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='192.0.2.1', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'smartcheck_occupancy', response.content)
+
+
+@override_settings(AUTH_USER_CACHE=True, PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class CachedUserTests(TestCase):
+    """The cached signed-in user must never outlive a logout, password change or deactivation."""
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('staff', password='old-password')
+        self.client.login(username='staff', password='old-password')
+        self.assertEqual(self.client.get(reverse('scan_qr_code')).status_code, 200)
+        self.assertIsNotNone(cache.get(user_cache_key(self.user.pk)))
+
+    def assertSignedOut(self):
+        response = self.client.get(reverse('scan_qr_code'))
+        self.assertRedirects(response, f"{reverse('login')}?next={reverse('scan_qr_code')}", fetch_redirect_response=False)
+
+    def test_logout(self):
+        self.client.get(reverse('logout'))
+        self.assertIsNone(cache.get(user_cache_key(self.user.pk)))
+        self.assertSignedOut()
+
+    def test_password_change(self):
+        self.user.set_password('new-password')
+        self.user.save()
+        self.assertSignedOut()
+
+    def test_deactivation(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertSignedOut()
+
+    @override_settings(AUTH_USER_CACHE=False)
+    def test_off_for_per_process_cache(self):
+        cache.clear()
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('scan_qr_code')).status_code, 200)
+        self.assertIsNone(cache.get(user_cache_key(self.user.pk)))
+
+
+class MaintenanceLockTests(TransactionTestCase):
+    """Runs in real transactions, so a second run sees the lock a running job holds."""
+    def setUp(self):
+        self.started, self.release = threading.Event(), threading.Event()
+
+        def slow(now):
+            self.started.set()
+            self.release.wait(10)
+            return 1
+
+        jobs = mock.patch.dict(
+            maintenance.JOBS, {'slow': maintenance.MaintenanceJob('slow', slow, timedelta(hours=1), '')}, clear=True
+        )
+        jobs.start()
+        self.addCleanup(jobs.stop)
+
+    def test_overlapping_runs(self):
+        def run():
+            try:
+                return maintenance.run_job('slow')
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            running = pool.submit(run)
+            self.assertTrue(self.started.wait(10))
+            self.assertIsNone(maintenance.run_job('slow'))
+            self.assertEqual(maintenance.run_due_jobs(), [])
+            self.release.set()
+            self.assertEqual(running.result().rows_affected, 1)
+
+        # A scheduler that found the job due before that run finished doesn't repeat it
+        self.assertIsNone(maintenance.run_job('slow', due_at=timezone.now()))
+        self.assertEqual(MaintenanceRun.objects.count(), 1)
+        self.assertFalse(MaintenanceLock.objects.get(job='slow').locked_until)
+
+    def test_abandoned_lock(self):
+        self.release.set()
+        MaintenanceLock.objects.create(job='slow', owner='gone', locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(len(maintenance.run_due_jobs()), 1)
+
+
+class StudentIDSequenceTests(TransactionTestCase):
+    """Runs in real transactions, so concurrent allocations contend as they would in production."""
+    def test_concurrent_allocation(self):
+        scanners = 8
+        barrier = threading.Barrier(scanners)
+
+        def allocate(_):
+            try:
+                barrier.wait()
+                return [StudentIDSequence.allocate(2030, 'TMP', count=2) for _ in range(10)]
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=scanners) as pool:
+            firsts = sorted(number for numbers in pool.map(allocate, range(scanners)) for number in numbers)
+        self.assertEqual(firsts, list(range(1, 2 * 10 * scanners, 2)))
+
+    def test_sequence_created_by_someone_else(self):
+        def create_first(execute, sql, params, many, context):
+            # Another process inserts the row after our update found none,
+            # just before we try to create it
+            if sql.startswith('SAVEPOINT') and not StudentIDSequence.objects.exists():
+                StudentIDSequence.objects.create(year_joined=2030, type_prefix='', last_number=5)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(create_first):
+            first = StudentIDSequence.allocate(2030, '', count=3)
+        self.assertEqual(first, 6)
+        self.assertEqual(StudentIDSequence.objects.get(year_joined=2030, type_prefix='').last_number, 8)
+
+    def test_benchmark_ids(self):
+        call_command('bench_scans', threads=2, scans=5, people=4, keep=True, stdout=StringIO())
+        self.assertFalse(StudentIDSequence.objects.exists())
+        students = RegularStudent.objects.filter(created_by__username='scan-benchmark')
+        self.assertEqual(len(students), 4)
+        self.assertTrue(all(student.student_id.startswith('BENCH-') for student in students))
+        self.assertEqual(AccessLog.objects.count(), 10)
+
+    def test_migration_continues_existing_ids(self):
+        supervisor = User.objects.create_user('supervisor')
+        for student_id, year_joined in (('PRPC27-AB007', 2024), ('PRPC27-CD012', 2024), ('PRPC28-EF003', 2025)):
+            RegularStudent.objects.create(
+                first_name='Old', last_name='Student', student_id=student_id, year_joined=year_joined,
+                class_status='Form 1', boarding_status='Day', created_by=supervisor,
+            )
+        TemporaryStudent.objects.create(
+            first_name='Old', last_name='Visitor', student_id='PRPC27-TMPOV004', year_joined=2024,
+            class_status='Form 1', boarding_status='Day', created_by=supervisor,
+            valid_until=timezone.now() + timedelta(days=1), reason='Exchange',
+        )
+        StudentIDSequence.objects.all().delete()
+
+        import_module('dashboard.migrations.0002_student_id_sequence').seed_sequences(apps, None)
+
+        self.assertEqual(StudentIDSequence.allocate(2024, ''), 13)
+        self.assertEqual(StudentIDSequence.allocate(2025, ''), 4)
+        self.assertEqual(StudentIDSequence.allocate(2024, 'TMP'), 5)
+        self.assertEqual(StudentIDSequence.allocate(2026, ''), 1)
+
+
+class QueryPlanTests(QueryCountTestCase):
+    """The queries behind the busiest pages must use an index."""
+    def assertUsesIndex(self, queryset):
+        plan = self._explain(queryset)
+        if connection.vendor == 'sqlite':
+            full_scans = re.findall(r'\bSCAN (?:TABLE )?(\w+)(?! USING)\s*$', plan, re.MULTILINE)
+        else:
+            full_scans = re.findall(r'Seq Scan on (\w+)', plan)
+        self.assertFalse(full_scans, f"Full table scan of {', '.join(full_scans)}:\n{plan}\n\n{queryset.query}")
+
+    def _explain(self, queryset):
+        if connection.vendor != 'postgresql':
+            return queryset.explain()
+        # Tiny test tables are cheaper to scan; ask whether an index could be used at all
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+        try:
+            return queryset.explain()
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = on')
+
+    def test_open_sessions(self):
+        self.assertUsesIndex(LabSession.objects.filter(exit_time__isnull=True))
+        # Where a replay starts from
+        self.assertUsesIndex(LabSession.objects.filter(
+            Q(exit_time__isnull=True) | Q(exit_time__gte=timezone.now() - timedelta(days=1))
+        ))
+
+    def test_recent_access_logs(self):
+        self.assertUsesIndex(AccessLog.objects.filter(timestamp__gte=timezone.now() - timedelta(days=7)))
+        self.assertUsesIndex(AccessLog.objects.order_by('-timestamp')[:50])
+
+    def test_person_access_logs(self):
+        self.assertUsesIndex(AccessLog.objects.filter(regular_student=self.student).order_by('-timestamp'))
+        self.assertUsesIndex(AccessLog.objects.filter(guest=self.guest).order_by('-timestamp'))
+
+    def test_scan_lookups(self):
+        self.assertUsesIndex(RegularStudent.objects.filter(student_id=self.student.student_id))
+        self.assertUsesIndex(Guest.objects.filter(guest_id=self.guest.guest_id))
+        self.assertUsesIndex(LabSession.objects.filter(regular_student=self.student, exit_time__isnull=True))
+
+    def test_lab_occupancy(self):
+        lab = Lab.default()
+        self.assertUsesIndex(LabSession.objects.filter(lab=lab, exit_time__isnull=True))
+        self.assertUsesIndex(AccessLog.objects.filter(lab=lab).order_by('-timestamp')[:5])
+
+    def test_recent_guests(self):
+        self.assertUsesIndex(Guest.objects.order_by('-created_at')[:20])
+        self.assertUsesIndex(Guest.objects.filter(created_at__gte=timezone.now() - timedelta(days=30)))
+
+    def test_valid_temporary_students(self):
+        self.assertUsesIndex(TemporaryStudent.objects.filter(is_active=True, valid_until__gte=timezone.now()))
@@ -0,0 +1,176 @@
+"""
+Resized copies of uploaded photos and logos.
+
+Phones upload multi-megapixel photos, but avatars and logo previews are drawn
+at a few dozen pixels. After an upload a background thread writes a
+re-encoded copy of the image for every size in SIZES, named after the
+original's content hash, so identical uploads share one set of files and a
+replaced photo never shows a stale thumbnail. ``thumbnail_url`` returns the
+resized copy once it exists and the original until then. An image that can't
+be resized is remembered for a day, by path and modification time, so it isn't
+queued again on every page view.
+"""
+from io import BytesIO
+import hashlib
+import logging
+import os
+import queue
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import RegularStudent, SystemSettings, TemporaryStudent, UserProfile
+from .qr import write_atomic
+
+logger = logging.getLogger(__name__)
+
+# Name -> (width, height, cropped to fill)
+SIZES = {
+    'avatar': (96, 96, True),
+    'thumb': (320, 320, False),
+    'logo': (240, 240, False),
+}
+
+# Models with uploaded images that are shown at thumbnail size
+IMAGE_FIELDS = {
+    RegularStudent: 'photo',
+    TemporaryStudent: 'photo',
+    UserProfile: 'profile_photo',
+    SystemSettings: 'school_logo',
+}
+
+FORMAT = 'webp'
+QUALITY = 82
+
+# How long an image that couldn't be resized is left alone; replacing it retries at once
+FAILURE_TIMEOUT = 24 * 60 * 60
+# Cached in place of a digest for such images
+FAILED = ''
+
+_queue = queue.Queue()
+_pending = set()
+_lock = threading.Lock()
+_worker = None
+
+
+def thumbnail_url(field_file, size):
+    """
+    URL of the ``size`` copy of an uploaded image, or of the original while
+    that copy is still being made.
+    """
+    if not field_file:
+        return ''
+    digest = request_thumbnails(field_file)
+    if digest and os.path.exists(thumbnail_path(digest, size)):
+        return settings.MEDIA_URL + os.path.relpath(
+            thumbnail_path(digest, size), settings.MEDIA_ROOT
+        ).replace(os.sep, '/')
+    return field_file.url
+
+
+def request_thumbnails(field_file):
+    """
+    Content digest of an uploaded image if its thumbnails are known to exist;
+    otherwise queue them and return None.
+    """
+    try:
+        path = field_file.path
+        modified = os.path.getmtime(path)
+    except (NotImplementedError, OSError):
+        # Remote storage or a missing file; nothing to resize locally
+        return None
+
+    digest = cache.get(_digest_cache_key(path, modified))
+    if digest is None:
+        schedule(path)
+    return digest or None
+
+
+def thumbnail_path(digest, size):
+    return os.path.join(settings.THUMBNAIL_DIR, digest[:2], f'{digest}-{size}.{FORMAT}')
+
+
+def schedule(path):
+    """Queue an image for resizing in the background; repeated calls are ignored."""
+    global _worker
+    with _lock:
+        if path in _pending:
+            return
+        _pending.add(path)
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_work, name='thumbnails', daemon=True)
+            _worker.start()
+    _queue.put(path)
+
+
+def make_thumbnails(path):
+    """
+    Write every missing size of the image at ``path``. Returns the content
+    digest the copies are stored under.
+    """
+    modified = os.path.getmtime(path)
+    digest = _content_digest(path)
+    for size in SIZES:
+        target = thumbnail_path(digest, size)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            write_atomic(target, render_thumbnail(path, size))
+
+    # The key includes the modification time, so it never goes stale
+    cache.set(_digest_cache_key(path, modified), digest, None)
+    return digest
+
+
+def render_thumbnail(path, size):
+    """Resize the image at ``path`` to ``size`` and return the encoded bytes."""
+    from PIL import Image, ImageOps
+
+    width, height, cropped = SIZES[size]
+    with Image.open(path) as image:
+        # Phone cameras store rotation in EXIF rather than in the pixels
+        image = ImageOps.exif_transpose(image)
+        if cropped:
+            image = ImageOps.fit(image, (width, height), Image.Resampling.LANCZOS)
+        else:
+            image.thumbnail((width, height), Image.Resampling.LANCZOS)
+        has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+        output = BytesIO()
+        image.save(output, format=FORMAT, quality=QUALITY, method=4)
+    return output.getvalue()
+
+
+def _work():
+    while True:
+        path = _queue.get()
+        try:
+            make_thumbnails(path)
+        except Exception:
+            logger.exception("Could not create thumbnails for %s", path)
+            _record_failure(path)
+        finally:
+            with _lock:
+                _pending.discard(path)
+
+
+def _record_failure(path):
+    try:
+        modified = os.path.getmtime(path)
+    except OSError:
+        return
+    cache.set(_digest_cache_key(path, modified), FAILED, FAILURE_TIMEOUT)
+
+
+def _content_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as image:
+        for chunk in iter(lambda: image.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:32]
+
+
+def _digest_cache_key(path, modified):
+    source = hashlib.sha1(f'{path}:{modified}'.encode()).hexdigest()
+    return f'dashboard:thumbnail_digest:{source}'
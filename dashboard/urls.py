@@ -1,5 +1,8 @@
-from django.urls import path
+from django.urls import path, re_path
 from . import views
+from .metrics import metrics
+from .profiling import query_profile
+from .staticfiles import serve_static
 from django.conf import settings
 from django.conf.urls.static import static
 
@@ -13,20 +16,31 @@ urlpatterns = [
     path('students/', views.student_list, name='student_list'),
     path('students/add-regular/', views.add_regular_student, name='add_regular_student'),
     path('students/add-temporary/', views.add_temporary_student, name='add_temporary_student'),
+    path('students/import/', views.import_students, name='import_students'),
+    path('students/id-cards/', views.id_card_sheets, name='id_card_sheets'),
     path('students/<str:student_id>/', views.student_detail, name='student_detail'),
 
 
     # Guest URLS
     path('guests/', views.guest_list, name='guest_list'),
     path('guests/add/', views.add_guest, name='add_guest'),
+    path('guests/groups/', views.guest_group_list, name='guest_group_list'),
+    path('guests/groups/add/', views.add_guest_group, name='add_guest_group'),
+    path('guests/groups/<str:group_id>/', views.guest_group_detail, name='guest_group_detail'),
     path('guests/<str:guest_id>/', views.guest_detail, name='guest_detail'),
 
     # Access URLS
     path('access/', views.access_logs, name='access_logs'),
+    path('access/export/', views.export_access_logs, name='export_access_logs'),
     path('settings/', views.system_settings, name='system_settings'),
     path('scan/', views.scan_qr, name='scan_qr_code'),
     path('scan/process/', views.process_scan, name='process_scan'),
+    path('scan/roster/', views.roster, name='scan_roster'),
+    path('qr/<str:payload>/', views.qr_code_image, name='qr_code_image'),
+    path('internal/queries/', query_profile, name='query_profile'),
+    path('metrics', metrics, name='metrics'),
 
-]+ static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
+    re_path(r'^%s(?P<path>.*)$' % settings.STATIC_URL.lstrip('/'), serve_static, name='static'),
+]
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
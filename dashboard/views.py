@@ -1,25 +1,47 @@
 from django.shortcuts import get_object_or_404, redirect, render
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout
-from django.http import HttpResponse, JsonResponse
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.contrib import messages
 from django.urls import reverse
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from datetime import timedelta, datetime
 from django.utils import timezone
-from django.db.models import Q
+from django.db import OperationalError
+from django.db.models import Count, Exists, F, OuterRef, Q
+from django.db.models.functions import TruncDate
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition
+from django.utils.cache import patch_cache_control
+from django.utils.http import content_disposition_header
+from django.core.cache import cache
+from django.conf import settings as django_settings
 import json
 import uuid
 import csv
+import hashlib
+import logging
+import tempfile
+import time
 
+from dashboard.admission import Overloaded, scan_gate
 from dashboard.scanning_logic import QRCodeScanner
+from dashboard.roster_import import RosterImporter, RosterImportError
+from dashboard.guest_groups import GuestGroupImportError, GuestGroupRegistrar
+from dashboard import log_counts, qr, roster_sync
+from dashboard.id_cards import IDCardRenderer, people_for_cards, queue_render
+from dashboard.replica import read_alias, replica_status, use_replica
+from dashboard.metrics import record_scan, scan_result
+from dashboard.pagination import KnownCountPaginator
 
 from .models import (
-    RegularStudent, TemporaryStudent, Guest, AccessLog,
-    LabSession, SystemSettings
+    RegularStudent, TemporaryStudent, Guest, GuestGroup, AccessLog,
+    Lab, LabSession, ScannerStation, SystemSettings, person_search
 )
 
+logger = logging.getLogger(__name__)
+
 # Create your views here.
 def landing(request):
     if request.user.is_authenticated:
@@ -28,49 +50,51 @@ def landing(request):
 
 @login_required
 def dashboard(request):
-    username = request.user.username
-    profile = request.user.profile
+    labs = [lab for lab in Lab.load_all() if lab.is_active]
+    # One lab when ?lab=<code> is given, otherwise every lab together
+    lab = Lab.for_code(request.GET.get('lab'))
+    in_lab = {'lab': lab} if lab else {}
 
  # Get recent access logs (last 20 entries)
-    recent_logs = AccessLog.objects.select_related(
+    recent_logs = AccessLog.objects.filter(**in_lab).select_related(
         'regular_student', 'temporary_student', 'guest'
     ).order_by('-timestamp')[:5]
     
     # Get current lab occupants (people who have entered but not exited)
-    current_sessions = LabSession.objects.filter(
-        exit_time__isnull=True
+    current_sessions = list(LabSession.objects.filter(
+        exit_time__isnull=True, **in_lab
     ).select_related(
         'regular_student', 'temporary_student', 'guest'
+    ))
+
+    # Occupancy of every lab, read from the index of open sessions
+    occupancy = dict(
+        LabSession.objects.filter(exit_time__isnull=True).values('lab').annotate(
+            count=Count('id')
+        ).values_list('lab', 'count').order_by()
     )
-    
+    lab_occupancy = [
+        {'lab': item, 'occupants': occupancy.get(item.pk, 0), 'selected': item == lab}
+        for item in labs
+    ]
+
     # Prepare data for charts
-    # Weekly access data
-    today = timezone.now().date()
+    # Weekly access data, counted per day and log type in a single query
+    today = timezone.localdate()
     week_dates = [today - timedelta(days=i) for i in range(6, -1, -1)]
-    
+    week_start = timezone.make_aware(datetime.combine(week_dates[0], datetime.min.time()))
+
+    daily_counts = AccessLog.objects.filter(timestamp__gte=week_start, **in_lab).annotate(
+        day=TruncDate('timestamp')
+    ).values('day', 'log_type').annotate(count=Count('id')).order_by()
+    counts = {(row['day'], row['log_type']): row['count'] for row in daily_counts}
+
     weekly_data = {
         'dates': [d.strftime('%a') for d in week_dates],
-        'entries': [],
-        'exits': []
+        'entries': [counts.get((d, 'entry'), 0) for d in week_dates],
+        'exits': [counts.get((d, 'exit'), 0) for d in week_dates]
     }
-    
-    for date in week_dates:
-        start = timezone.make_aware(timezone.datetime.combine(date, timezone.datetime.min.time()))
-        end = timezone.make_aware(timezone.datetime.combine(date, timezone.datetime.max.time()))
-        
-        entries = AccessLog.objects.filter(
-            timestamp__range=(start, end),
-            log_type='entry'
-        ).count()
-        
-        exits = AccessLog.objects.filter(
-            timestamp__range=(start, end),
-            log_type='exit'
-        ).count()
-        
-        weekly_data['entries'].append(entries)
-        weekly_data['exits'].append(exits)
-    
+
     # Lab occupancy stats
     total_students = RegularStudent.objects.filter(is_active=True).count()
     total_temporary = TemporaryStudent.objects.filter(is_active=True, valid_until__gte=timezone.now()).count()
@@ -85,20 +109,28 @@ def dashboard(request):
         'total_students': total_students,
         'total_temporary': total_temporary,
         'total_guests_last_month': total_guests_last_month,
-        'current_occupants': current_sessions.count(),
-        'username': username,
-        'profile': profile
+        'current_occupants': len(current_sessions),
+        'lab': lab,
+        'lab_occupancy': lab_occupancy,
+        'capacity': lab.capacity if lab else sum(item.capacity for item in labs) or 50,
     }
     return render(request, 'index.html', context)
 
+# student_list sort options, read from the per-person visit statistics
+STUDENT_SORTS = {
+    'visits': F('visit_stats__total_visits').desc(nulls_last=True),
+    'time': F('visit_stats__total_duration').desc(nulls_last=True),
+    'last_seen': F('visit_stats__last_seen').desc(nulls_last=True),
+    'name': F('last_name').asc(),
+}
+
 @login_required
 def student_list(request):
-    username = request.user.username
-    profile = request.user.profile
-
     query = request.GET.get('q', '')
     student_type = request.GET.get('type', 'regular')
 
+    sort = request.GET.get('sort', '')
+
     if student_type == 'regular':
         students = RegularStudent.objects.all()
     elif student_type == 'temporary':
@@ -108,6 +140,13 @@ def student_list(request):
         students = RegularStudent.objects.all()
         student_type = 'regular'
 
+    students = students.select_related('visit_stats')
+    if sort in STUDENT_SORTS:
+        students = students.order_by(STUDENT_SORTS[sort], 'last_name')
+    else:
+        sort = ''
+        students = students.order_by('pk')
+
     if query:
         students = students.filter(
             Q(first_name__icontains=query) |
@@ -131,20 +170,18 @@ def student_list(request):
         'students': students,
         'student_type': student_type,
         'query': query,
-        'username': username,
-        'profile': profile,
+        'sort': sort,
     }
 
     return render(request, 'students/student_list.html', context)
 
 @login_required
 def student_detail(request, student_id):
-    username = request.user.username
-    profile = request.user.profile
-
     # Try to find the student in either regular or temporary students
-    regular_student = RegularStudent.objects.filter(student_id=student_id).first()
-    temporary_student = TemporaryStudent.objects.filter(student_id=student_id).first()
+    regular_student = RegularStudent.objects.select_related('visit_stats').filter(student_id=student_id).first()
+    temporary_student = None if regular_student else (
+        TemporaryStudent.objects.select_related('visit_stats').filter(student_id=student_id).first()
+    )
 
     if regular_student:
         student = regular_student
@@ -158,10 +195,11 @@ def student_detail(request, student_id):
         return redirect('student_list')
 
     # Get access logs for this student
+    logs = AccessLog.objects.select_related('recorded_by').order_by('-timestamp')
     if student_type == 'regular':
-        logs = AccessLog.objects.filter(regular_student=student).order_by('-timestamp')
+        logs = logs.filter(regular_student=student)
     else:
-        logs = AccessLog.objects.filter(temporary_student=student).order_by('-timestamp')
+        logs = logs.filter(temporary_student=student)
 
     # Paginate logs
     paginator = Paginator(logs, 20)  # 20 logs per page
@@ -178,18 +216,14 @@ def student_detail(request, student_id):
         'page_title': f'Student: {student.first_name} {student.last_name}',
         'student': student,
         'student_type': student_type,
-        'logs': logs,
-        'username': username,
-        'profile': profile
+        'stats': getattr(student, 'visit_stats', None),
+        'logs': logs
     }
 
     return render(request, 'students/student_detail.html', context)
 
 @login_required
 def add_regular_student(request):
-    username = request.user.username
-    profile = request.user.profile
-
     if request.method == 'POST':
         first_name = request.POST.get('first_name')
         last_name = request.POST.get('last_name')
@@ -232,17 +266,12 @@ def add_regular_student(request):
     current_year = timezone.now().year
     context = {
         'page_title': 'Add Regular Student',
-        'current_year': current_year,
-        'username': username,
-        'profile': profile
+        'current_year': current_year
     }
     return render(request, 'students/add_regular_student.html', context)
 
 @login_required
 def add_temporary_student(request):
-    username = request.user.username
-    profile = request.user.profile
-
     if request.method == 'POST':
         first_name = request.POST.get('first_name')
         last_name = request.POST.get('last_name')
@@ -294,17 +323,85 @@ def add_temporary_student(request):
     context = {
         'page_title': 'Add Temporary Student',
         'current_year': current_year,
-        'default_expiry': default_expiry,
-        'username': username,
-        'profile': profile
+        'default_expiry': default_expiry
     }
     return render(request, 'students/add_temp_student.html', context)
 
 @login_required
-def guest_list(request):
-    username = request.user.username
-    profile = request.user.profile
+def import_students(request):
+    student_type = request.POST.get('student_type', request.GET.get('type', 'regular'))
+    if student_type not in RosterImporter.MODELS:
+        student_type = 'regular'
+
+    errors = []
+    if request.method == 'POST':
+        roster = request.FILES.get('roster')
+
+        if not roster:
+            messages.error(request, 'Please choose a roster file to import.')
+            return redirect('import_students')
+
+        try:
+            importer = RosterImporter(request.user, student_type)
+            result = importer.import_file(roster, roster.name)
+        except RosterImportError as e:
+            messages.error(request, f'Error importing roster: {str(e)}')
+            return redirect('import_students')
+
+        if result['status'] == 'success':
+            messages.success(request, result['message'])
+            return redirect(f"{reverse('student_list')}?type={student_type}")
+
+        messages.error(request, result['message'])
+        errors = result['errors']
+
+    context = {
+        'page_title': 'Import Students',
+        'student_type': student_type,
+        'required_columns': RosterImporter.REQUIRED_COLUMNS[student_type],
+        'errors': errors
+    }
+    return render(request, 'students/import_students.html', context)
+
+@login_required
+def id_card_sheets(request):
+    person_type = request.GET.get('type', 'regular')
+    if person_type not in ('regular', 'temporary', 'guest'):
+        person_type = 'regular'
+
+    years = [int(year) for year in request.GET.getlist('year') if year.isdigit()]
+    group_id = request.GET.get('group') if person_type == 'guest' else None
+    people = people_for_cards(person_type, years, group_id=group_id)
+    back = redirect('guest_group_detail', group_id=group_id) if group_id else redirect('student_list')
+    count = people.count()
+    if not count:
+        messages.error(request, 'There are no cards to print for that selection.')
+        return back
+    if count > django_settings.ID_CARD_SHEET_MAX_CARDS:
+        messages.error(
+            request,
+            f'That selection has {count} cards; this page prints at most {django_settings.ID_CARD_SHEET_MAX_CARDS}. '
+            'Pick a year, or run "python manage.py render_id_cards" for the whole cohort.'
+        )
+        return back
+
+    # Cards are drawn in the background, never while the request waits
+    renderer = IDCardRenderer()
+    card_paths, missing = renderer.current_cards(people)
+    if missing:
+        queue_render(person_type, years, group_id)
+        messages.info(request, f'{missing} cards are being drawn. Download the sheets again in a minute.')
+        return back
+
+    sheets = tempfile.TemporaryFile(suffix='.pdf')
+    renderer.write_sheets(card_paths, sheets)
+    sheets.seek(0)
 
+    filename = f"id_cards_{group_id or person_type}{'_' + '_'.join(map(str, years)) if years else ''}.pdf"
+    return FileResponse(sheets, as_attachment=True, filename=filename, content_type='application/pdf')
+
+@login_required
+def guest_list(request):
     query = request.GET.get('q', '')
     guests = Guest.objects.all().order_by('-created_at')
 
@@ -330,18 +427,13 @@ def guest_list(request):
     context = {
         'page_title': 'Guest Management',
         'guests': guests,
-        'query': query,
-        'username': username,
-        'profile': profile
+        'query': query
     }
 
     return render(request, 'guests/guest_list.html', context)
 
 @login_required
 def add_guest(request):
-    username = request.user.username
-    profile = request.user.profile
-
     if request.method == 'POST':
         first_name = request.POST.get('first_name')
         last_name = request.POST.get('last_name')
@@ -388,18 +480,13 @@ def add_guest(request):
 
     # GET request - show the form
     context = {
-        'page_title': 'Add Guest',
-        'username': username,
-        'profile': profile
+        'page_title': 'Add Guest'
     }
     return render(request, 'guests/add_guest.html', context)
 
 @login_required
 def guest_detail(request, guest_id):
-    username = request.user.username
-    profile = request.user.profile
-
-    guest = get_object_or_404(Guest, guest_id=guest_id)
+    guest = get_object_or_404(Guest.objects.select_related('visit_stats', 'group'), guest_id=guest_id)
 
     # Get access logs for this guest
     logs = AccessLog.objects.filter(guest=guest).order_by('-timestamp')
@@ -418,43 +505,127 @@ def guest_detail(request, guest_id):
     context = {
         'page_title': f'Guest: {guest.first_name} {guest.last_name}',
         'guest': guest,
-        'logs': logs,
-        'username': username,
-        'profile': profile
+        'stats': getattr(guest, 'visit_stats', None),
+        'logs': logs
     }
 
     return render(request, 'guests/guest_detail.html', context)
 
-# ACCESS CONTROL
 @login_required
-def access_logs(request):
-    username = request.user.username
-    profile = request.user.profile   
-    # Get filter parameters
+def guest_group_list(request):
+    query = request.GET.get('q', '')
+    groups = GuestGroup.objects.annotate(member_count=Count('members')).order_by('-created_at')
+
+    if query:
+        groups = groups.filter(
+            Q(name__icontains=query) |
+            Q(school_or_organization__icontains=query) |
+            Q(group_id__icontains=query)
+        )
+
+    paginator = Paginator(groups, 20)
+    page = request.GET.get('page')
+
+    try:
+        groups = paginator.page(page)
+    except PageNotAnInteger:
+        groups = paginator.page(1)
+    except EmptyPage:
+        groups = paginator.page(paginator.num_pages)
+
+    context = {
+        'page_title': 'Guest Groups',
+        'groups': groups,
+        'query': query
+    }
+
+    return render(request, 'guests/guest_group_list.html', context)
+
+@login_required
+def add_guest_group(request):
+    errors = []
+    if request.method == 'POST':
+        name = request.POST.get('name')
+        school_or_organization = request.POST.get('school_or_organization')
+        purpose = request.POST.get('purpose')
+
+        if not all([name, school_or_organization, purpose]):
+            messages.error(request, 'Please fill in all required fields.')
+            return redirect('add_guest_group')
+
+        registrar = GuestGroupRegistrar(request.user)
+        try:
+            members, errors = registrar.parse_members(request.POST.get('members', ''), request.FILES.get('roster'))
+        except GuestGroupImportError as e:
+            messages.error(request, f'Error reading member list: {str(e)}')
+            return redirect('add_guest_group')
+
+        if errors:
+            messages.error(request, f'{len(errors)} members have errors. No guests were added.')
+        else:
+            group = registrar.register(name, school_or_organization, purpose, members)
+            messages.success(request, f'Group {group.name} added with {len(members)} guests. Group ID: {group.group_id}')
+            return redirect('guest_group_detail', group_id=group.group_id)
+
+    context = {
+        'page_title': 'Add Guest Group',
+        'errors': errors,
+        'form': request.POST,
+        'max_members': GuestGroupRegistrar.MAX_MEMBERS
+    }
+    return render(request, 'guests/add_guest_group.html', context)
+
+@login_required
+def guest_group_detail(request, group_id):
+    group = get_object_or_404(GuestGroup, group_id=group_id)
+    members = group.members.annotate(
+        inside=Exists(LabSession.objects.filter(guest=OuterRef('pk'), exit_time__isnull=True))
+    ).order_by('last_name', 'first_name')
+
+    context = {
+        'page_title': f'Guest Group: {group.name}',
+        'group': group,
+        'members': members,
+        'inside_count': sum(1 for member in members if member.inside)
+    }
+
+    return render(request, 'guests/guest_group_detail.html', context)
+
+# ACCESS CONTROL
+def _parse_day(value):
+    """A YYYY-MM-DD query string value as a date, or None if it's missing or invalid."""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+def _filter_access_logs(request):
+    """Apply the access log filters in the query string. Returns the logs and the filter values."""
     start_date_str = request.GET.get('start_date', '')
     end_date_str = request.GET.get('end_date', '')
     user_type = request.GET.get('user_type', '')
     log_type = request.GET.get('log_type', '')
+    lab_code = request.GET.get('lab', '')
     query = request.GET.get('q', '')
 
     # Apply filters
-    logs = AccessLog.objects.all().order_by('-timestamp')
+    logs = AccessLog.objects.select_related(
+        'regular_student', 'temporary_student', 'guest', 'recorded_by', 'lab'
+    ).order_by('-timestamp')
 
-    if start_date_str:
-        try:
-            start_date = datetime.strptime(start_date_str, '%Y-%m-%d').replace(tzinfo=timezone.get_current_timezone())
-            logs = logs.filter(timestamp__gte=start_date)
-        except ValueError:
-            pass  # Invalid date format, ignore filter
+    lab = Lab.for_code(lab_code, include_inactive=True)
+    if lab:
+        logs = logs.filter(lab=lab)
 
-    if end_date_str:
-        try:
-            end_date = datetime.strptime(end_date_str, '%Y-%m-%d').replace(tzinfo=timezone.get_current_timezone())
-            # Add one day to include the end date fully
-            end_date = end_date + timedelta(days=1)
-            logs = logs.filter(timestamp__lt=end_date)
-        except ValueError:
-            pass  # Invalid date format, ignore filter
+    # Invalid dates are ignored
+    start_day = _parse_day(start_date_str)
+    if start_day:
+        logs = logs.filter(timestamp__gte=log_counts.day_start(start_day))
+
+    end_day = _parse_day(end_date_str)
+    if end_day:
+        # Up to the start of the next day, to include the end date fully
+        logs = logs.filter(timestamp__lt=log_counts.day_start(end_day + timedelta(days=1)))
 
     if user_type:
         logs = logs.filter(user_type=user_type)
@@ -463,34 +634,33 @@ def access_logs(request):
         logs = logs.filter(log_type=log_type)
 
     if query:
-        # Complex query across multiple related models
-        regular_ids = RegularStudent.objects.filter(
-            Q(first_name__icontains=query) |
-            Q(last_name__icontains=query) |
-            Q(student_id__icontains=query)
-        ).values_list('id', flat=True)
+        logs = logs.filter(person_search(query))
 
-        temp_ids = TemporaryStudent.objects.filter(
-            Q(first_name__icontains=query) |
-            Q(last_name__icontains=query) |
-            Q(student_id__icontains=query)
-        ).values_list('id', flat=True)
+    filters = {
+        'start_date': start_date_str,
+        'end_date': end_date_str,
+        'user_type': user_type,
+        'log_type': log_type,
+        'lab_code': lab_code,
+        'query': query,
+    }
+    return logs, filters
 
-        guest_ids = Guest.objects.filter(
-            Q(first_name__icontains=query) |
-            Q(last_name__icontains=query) |
-            Q(guest_id__icontains=query) |
-            Q(school_or_organization__icontains=query)
-        ).values_list('id', flat=True)
-
-        logs = logs.filter(
-            Q(regular_student_id__in=regular_ids) |
-            Q(temporary_student_id__in=temp_ids) |
-            Q(guest_id__in=guest_ids)
-        )
+@login_required
+@use_replica()
+def access_logs(request):
+    logs, filters = _filter_access_logs(request)
+    counts = log_counts.summary(
+        lab=Lab.for_code(filters['lab_code'], include_inactive=True),
+        query=filters['query'],
+        start=_parse_day(filters['start_date']),
+        end=_parse_day(filters['end_date']),
+        user_type=filters['user_type'],
+        log_type=filters['log_type'],
+    )
 
-    # Pagination
-    paginator = Paginator(logs, 50)  # 50 logs per page
+    # Pagination, with the total from the cached counts instead of a COUNT(*)
+    paginator = KnownCountPaginator(logs, 50, counts['total'])  # 50 logs per page
     page = request.GET.get('page')
 
     try:
@@ -500,57 +670,230 @@ def access_logs(request):
     except EmptyPage:
         logs = paginator.page(paginator.num_pages)
 
+    # Links to the two pages either side; looping over every page in the
+    # template took seconds for a few million logs
+    page_numbers = range(max(logs.number - 2, 1), min(logs.number + 2, paginator.num_pages) + 1)
+
+    # Facet links keep every other filter and go back to the first page
+    page_query = request.GET.copy()
+    page_query.pop('page', None)
+    facets = {}
+    for field, choices, counted in (
+        ('log_type', AccessLog.LOG_TYPES, counts['log_types']),
+        ('user_type', AccessLog.USER_TYPES, counts['user_types']),
+    ):
+        facet_query = page_query.copy()
+        facet_query.pop(field, None)
+        facets[field] = [
+            {
+                'label': label,
+                'count': sum(counted.values()) if not value else counted.get(value, 0),
+                'selected': filters[field] == value,
+                'query': f'{facet_query.urlencode()}&{field}={value}'.lstrip('&') if value else facet_query.urlencode(),
+            }
+            for value, label in [('', 'All'), *choices]
+        ]
+
     context = {
         'page_title': 'Access Logs',
         'logs': logs,
-        'start_date': start_date_str,
-        'end_date': end_date_str,
-        'user_type': user_type,
-        'log_type': log_type,
-        'query': query,
-        'username': username,
-        'profile': profile
+        **filters,
+        'total_count': counts['total'],
+        'facets': facets,
+        'page_numbers': page_numbers,
+        'page_query': page_query.urlencode(),
+        'export_query': request.GET.urlencode(),
+        'replica_status': replica_status(),
+        'labs': Lab.load_all(),
     }
 
     return render(request, 'control/access_logs.html', context)
 
+class _Echo:
+    """File-like object that hands each CSV line straight back to the response."""
+    def write(self, value):
+        return value
+
 @login_required
-def scan_qr(request):
-    username = request.user.username
-    profile = request.user.profile
+@use_replica()
+def export_access_logs(request):
+    logs, _ = _filter_access_logs(request)
+    # Pin the export to the database chosen now; the rows are streamed later,
+    # so make sure they can be read from it while a fallback is still possible
+    logs = logs.using(read_alias())
+    logs.exists()
+
+    def rows():
+        writer = csv.writer(_Echo())
+        yield writer.writerow(['Timestamp', 'Name', 'ID', 'User Type', 'Log Type', 'Lab', 'Recorded By'])
+        for log in logs.iterator(chunk_size=2000):
+            yield writer.writerow([
+                timezone.localtime(log.timestamp).strftime('%Y-%m-%d %H:%M:%S'),
+                log.get_user_name(),
+                log.get_user_id(),
+                log.get_user_type_display(),
+                log.get_log_type_display(),
+                log.lab.name,
+                log.recorded_by.get_full_name() or log.recorded_by.username,
+            ])
+
+    response = StreamingHttpResponse(rows(), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="access_logs_{timezone.localdate():%Y%m%d}.csv"'
+    return response
 
+@login_required
+def scan_qr(request):
     context = {
         'page_title': 'Scan QR Code',
         'scan_endpoint': reverse('process_scan'),
-        'username': username,
-        'profile': profile
+        'roster_endpoint': reverse('scan_roster'),
+        'labs': [lab for lab in Lab.load_all() if lab.is_active],
+        'stations': ScannerStation.objects.filter(is_active=True, lab__is_active=True),
     }
     return render(request, 'control/scan_qr.html', context)
 
+def _qr_image_options(request):
+    """Read and validate the format and size of a requested QR image."""
+    fmt = request.GET.get('format', 'png').lower()
+    if fmt not in qr.FORMATS:
+        raise Http404('Unsupported QR code format')
+
+    try:
+        box_size = int(request.GET.get('size', qr.DEFAULT_BOX_SIZE))
+    except ValueError:
+        box_size = qr.DEFAULT_BOX_SIZE
+    return fmt, min(max(box_size, 1), qr.MAX_BOX_SIZE)
+
+
+def _qr_image_etag(request, payload):
+    fmt, box_size = _qr_image_options(request)
+    return qr.qr_cache_key(payload, fmt, box_size)
+
+
+@login_required
+@condition(etag_func=_qr_image_etag)
+def qr_code_image(request, payload):
+    fmt, box_size = _qr_image_options(request)
+    # Only codes people actually carry are drawn, so the disk cache can't be
+    # filled with arbitrary payloads
+    if not _qr_payload_exists(payload):
+        raise Http404('Unknown QR code')
+
+    response = HttpResponse(qr.get_qr_image(payload, fmt, box_size), content_type=qr.FORMATS[fmt])
+    # The image for a given payload and size never changes
+    patch_cache_control(response, private=True, max_age=365 * 24 * 60 * 60, immutable=True)
+    if request.GET.get('download'):
+        response['Content-Disposition'] = content_disposition_header(True, f'qrcode_{payload}.{fmt}')
+    return response
+
+
+def _qr_payload_exists(payload):
+    """Whether ``payload`` is the ID of a student, guest or guest group, in one query."""
+    return RegularStudent.objects.filter(student_id=payload).values('pk').union(
+        TemporaryStudent.objects.filter(student_id=payload).values('pk'),
+        Guest.objects.filter(guest_id=payload).values('pk'),
+        GuestGroup.objects.filter(group_id=payload).values('pk'),
+        all=True,
+    ).exists()
+
+def _roster_since(request):
+    """The roster version a station already has, or None for the whole roster."""
+    since = request.GET.get('since', '')
+    return int(since) if since.isdigit() else None
+
+
+def _roster_etag(request):
+    # Validity windows depend on the date, so the same version changes daily
+    return f'roster-{_roster_since(request)}-{roster_sync.current_version()}-{timezone.localdate():%Y%m%d}'
+
+
+@login_required
+@gzip_page
+@condition(etag_func=_roster_etag)
+def roster(request):
+    """
+    Codes scanner stations can check locally. Without ``since`` this is the
+    whole roster; with it, only what changed after that version.
+    """
+    since = _roster_since(request)
+    data = roster_sync.snapshot() if since is None else roster_sync.delta(since)
+    response = JsonResponse({'status': 'success', 'message': '', 'data': data})
+    # Always revalidate; an unchanged roster costs a 304
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def _scan_key(qr_code_data, lab):
+    digest = hashlib.sha1(str(qr_code_data).encode()).hexdigest()
+    return f'dashboard:recent_scan:{lab.pk}:{digest}'
+
+
+def _claim_scan(key):
+    """
+    False if the same code was already scanned in the same lab in the last
+    SCAN_REPEAT_WINDOW seconds. cache.add is atomic, so with a shared cache
+    only one worker wins; with the per-process cache, only within a worker.
+    """
+    if not django_settings.SCAN_REPEAT_WINDOW:
+        return True
+    return cache.add(key, True, django_settings.SCAN_REPEAT_WINDOW)
+
+
+def _scan_location(data):
+    """The lab and scanner station a scan request names, each None if absent or unknown."""
+    station_id = str(data.get('station') or '')
+    if station_id.isdigit():
+        station = ScannerStation.objects.select_related('lab').filter(
+            pk=station_id, is_active=True, lab__is_active=True
+        ).first()
+        return (station.lab, station) if station else (None, None)
+    return Lab.for_code(data.get('lab')), None
+
+
+def _release_scan(key):
+    """Let the same code be scanned again straight away, after a scan that recorded nothing."""
+    if key and django_settings.SCAN_REPEAT_WINDOW:
+        cache.delete(key)
+
+
+def _retry_response(retry_after):
+    """Tell the station nothing was recorded and to send the scan again shortly."""
+    response = JsonResponse({
+        'status': 'retry',
+        'message': 'The scanner is busy. Retrying...',
+        'data': {'retry_after': retry_after}
+    }, status=503)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
 # Process QR code scan
 @login_required
 @csrf_exempt  # Note: In production, use proper CSRF protection
 def process_scan(request):
     if request.method == 'POST':
+        started = time.perf_counter()
         try:
             data = json.loads(request.body)
-            qr_code_data = data.get('qr_code')
-
-            # Initialize the scanner with the current user
-            scanner = QRCodeScanner(request.user)
-
-            # Process the scan
-            result = scanner.process_scan(qr_code_data)
-
-            return JsonResponse(result)
-
-        except Exception as e:
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            record_scan('error', time.perf_counter() - started)
             return JsonResponse({
                 'status': 'error',
-                'message': f'Error processing scan: {str(e)}',
+                'message': 'Invalid scan request.',
                 'data': None
             })
 
+        # Turned away scans are answered at once rather than queued behind
+        # the database, and the station sends them again
+        try:
+            with scan_gate().admit():
+                return _handle_scan(request, data, started)
+        except Overloaded as overloaded:
+            record_scan('busy', time.perf_counter() - started)
+            return _retry_response(overloaded.retry_after)
+
     return JsonResponse({
         'status': 'error',
         'message': 'Invalid request method',
@@ -558,19 +901,67 @@ def process_scan(request):
     })
 
 
+def _handle_scan(request, data, started):
+    qr_code_data = data.get('qr_code')
+    claimed = None
+
+    try:
+        lab, station = _scan_location(data)
+        if lab is None and station is None and (data.get('lab') or data.get('station')):
+            record_scan('error', time.perf_counter() - started)
+            return JsonResponse({
+                'status': 'error',
+                'message': 'Unknown lab or scanner station.',
+                'data': None
+            })
+
+        # Initialize the scanner with the current user
+        scanner = QRCodeScanner(request.user, lab=lab, station=station)
+
+        # Two scanners at one door, or one camera reading twice, can send the
+        # same code at once; only the first should count as an entry or exit
+        key = _scan_key(qr_code_data, scanner.lab)
+        if not _claim_scan(key):
+            record_scan('suppressed', time.perf_counter() - started)
+            return JsonResponse({
+                'status': 'error',
+                'message': 'This code was just scanned. Please wait a moment.',
+                'data': None
+            })
+        claimed = key
+
+        # Process the scan
+        result = scanner.process_scan(qr_code_data)
+    except OperationalError:
+        # The database was locked or out of connections for too long. The
+        # scan's transaction rolled back, so it is safe to send again.
+        logger.warning("Scan could not get through to the database", exc_info=True)
+        _release_scan(claimed)
+        raise Overloaded(django_settings.SCAN_RETRY_AFTER)
+    except Exception:
+        # The details are for the log, not for whoever is at the scanner
+        logger.exception("Scan failed")
+        _release_scan(claimed)
+        record_scan('error', time.perf_counter() - started)
+        return JsonResponse({
+            'status': 'error',
+            'message': 'The scan could not be recorded. Please scan again.',
+            'data': None
+        })
+
+    record_scan(scan_result(result), time.perf_counter() - started)
+    return JsonResponse(result)
+
+
 @login_required
 def system_settings(request):
-    username = request.user.username
-    profile = request.user.profile
-
     # Only allow staff/admin to access settings
     if not request.user.is_staff:
         messages.error(request, 'You do not have permission to access system settings.')
         print(f'You do not have permission to access system settings.')
         return redirect('dashboard')
 
-    # Get or create settings
-    settings, created = SystemSettings.objects.get_or_create(id=1)
+    settings = SystemSettings.load()
 
     if request.method == 'POST':
         settings.school_name = request.POST.get('school_name', settings.school_name)
@@ -587,9 +978,7 @@ def system_settings(request):
 
     context = {
         'page_title': 'System Settings',
-        'settings': settings,
-        'username': username,
-        'profile': profile
+        'settings': settings
     }
 
     return render(request, 'control/system_settings.html', context)
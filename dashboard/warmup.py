@@ -0,0 +1,80 @@
+"""
+Warm-up for a freshly started worker.
+
+The first requests a new worker serves would otherwise pay for connecting to
+the database, building the URL resolver, compiling templates and filling the
+settings, user and profile caches. ``warm_up`` does that before the worker
+takes traffic: ``wsgi.py`` calls it when WARM_UP_ON_START is set, and the
+``warm_up`` command runs it by hand, e.g. to fill a shared cache after a
+deploy.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connections
+from django.template.loader import get_template
+from django.urls import get_resolver, reverse
+
+from .auth_backends import user_cache_key
+from .models import SystemSettings, UserProfile
+
+logger = logging.getLogger(__name__)
+
+# Compiled up front; the scan page and dashboard are what staff open first
+TEMPLATES = ('control/scan_qr.html', 'index.html', 'pages/landing.html')
+
+
+def warm_up():
+    """Run every warm-up step and return how long each took, in milliseconds."""
+    timings = {}
+    for name, step in STEPS:
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception:
+            # A cold cache is slower, not broken; never keep a worker from starting
+            logger.exception("Warm-up step %s failed", name)
+        timings[name] = round((time.perf_counter() - started) * 1000, 2)
+
+    # Connections must not be shared with processes forked after a preload
+    connections.close_all()
+    logger.info("Warm-up finished: %s", ', '.join(f'{name} {ms}ms' for name, ms in timings.items()))
+    return timings
+
+
+def _warm_urls():
+    get_resolver().url_patterns
+    reverse('process_scan')
+
+
+def _warm_templates():
+    for template_name in TEMPLATES:
+        get_template(template_name)
+
+
+def _warm_settings():
+    SystemSettings.load()
+
+
+def _warm_users():
+    """Put the staff most likely to scan next into the user and profile caches."""
+    users = User.objects.filter(is_active=True, last_login__isnull=False).order_by('-last_login')
+    users = list(users[:settings.WARM_UP_USERS])
+    profiles = {profile.user_id: profile for profile in UserProfile.objects.filter(user__in=users)}
+    if settings.AUTH_USER_CACHE:
+        cache.set_many({user_cache_key(user.pk): user for user in users}, settings.AUTH_USER_CACHE_TIMEOUT)
+    cache.set_many(
+        {UserProfile.cache_key(user.pk): profiles.get(user.pk, False) for user in users},
+        UserProfile.CACHE_TIMEOUT,
+    )
+
+
+STEPS = (
+    ('urls', _warm_urls),
+    ('templates', _warm_templates),
+    ('settings', _warm_settings),
+    ('users', _warm_users),
+)
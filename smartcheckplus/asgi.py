@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'smartcheckplus.settings')
 
 application = get_asgi_application()
+
+if settings.WARM_UP_ON_START:
+    from dashboard.warmup import warm_up
+
+    warm_up()